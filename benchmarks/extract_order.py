@@ -0,0 +1,119 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+# Run from the repository root or the benchmarks folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.extent_reader import ExtentReader
+from core.flasher import ISOFlasher
+from core.iso_handler import SECTOR_SIZE, iter_iso_entries
+from core.scheduler import DEFAULT_WORKERS
+
+
+def drop_cache(iso_path):
+    """Ask the OS to forget cached pages of the ISO so every run reads the source"""
+    if not hasattr(os, 'posix_fadvise'):
+        return False
+    fd = os.open(iso_path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+    return True
+
+
+def seek_stats(offsets):
+    """Count backward jumps and total head travel for a sequence of (offset, length) reads"""
+    position = 0
+    backward = 0
+    travel = 0
+    for offset, length in offsets:
+        if offset < position:
+            backward += 1
+        travel += abs(offset - position)
+        position = offset + length
+    return backward, travel
+
+
+def directory_order(iso_path, output_path, flasher):
+    """Extract files in directory order, one file after another"""
+    offsets = []
+    with open(iso_path, 'rb') as iso_file, ExtentReader(iso_file) as reader:
+        for entry in iter_iso_entries(iso_file):
+            full_path = os.path.join(output_path, *entry.path.split('/'))
+            if entry.is_dir:
+                os.makedirs(full_path, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            with open(full_path, 'wb') as output_file:
+                for lba, size in entry.extents:
+                    offsets.append((lba * SECTOR_SIZE, size))
+                    reader.copy_extent(lba * SECTOR_SIZE, size, output_file)
+    return offsets
+
+
+def lba_order(iso_path, output_path, flasher, workers=1):
+    """Extract files through the LBA ordered scheduler, single threaded unless workers is given"""
+    flasher.extract_workers = workers
+    with open(iso_path, 'rb') as iso_file:
+        # One directory walk, as in directory order, the scheduler keeps the extents it read
+        scheduler = flasher._create_scheduler(iso_file, output_path, 0, 100, "Extracting files...")
+        for entry in iter_iso_entries(iso_file):
+            scheduler.add_iso_entry(entry)
+        flasher._run_scheduler(scheduler)
+    return [(source_offset, length) for source_offset, _, length, _ in scheduler.extents]
+
+
+def lba_order_pooled(iso_path, output_path, flasher):
+    """LBA order with the small file pool, the pool's workers read in their own order"""
+    return lba_order(iso_path, output_path, flasher, DEFAULT_WORKERS)
+
+
+def run(iso_path, repeat, work_dir):
+    flasher = ISOFlasher()
+    # Ordering and pooling are measured apart, seeks are only known for single threaded reads
+    modes = [('directory order', directory_order, True), ('LBA order', lba_order, True),
+             ('LBA order+pool', lba_order_pooled, False)]
+    results = {name: [] for name, _, _ in modes}
+    cold = True
+
+    for _ in range(repeat):
+        for name, function, _ in modes:
+            output_path = tempfile.mkdtemp(prefix='extract_bench_', dir=work_dir)
+            try:
+                cold = drop_cache(iso_path) and cold
+                start = time.perf_counter()
+                offsets = function(iso_path, output_path, flasher)
+                elapsed = time.perf_counter() - start
+            finally:
+                shutil.rmtree(output_path, ignore_errors=True)
+
+            total_bytes = sum(length for _, length in offsets)
+            results[name].append((elapsed, total_bytes, seek_stats(offsets)))
+
+    print(f"ISO: {iso_path}")
+    if not cold:
+        print("Note: page cache could not be dropped, throughput reflects cached reads")
+    print(f"{'mode':<16} {'MB/s':>10} {'seconds':>10} {'backward seeks':>16} {'travel (MB)':>12}")
+    for name, _, ordered in modes:
+        elapsed = min(result[0] for result in results[name])
+        total_bytes = results[name][0][1]
+        backward, travel = results[name][0][2]
+        throughput = total_bytes / elapsed / 1e6 if elapsed > 0 else 0
+        if ordered:
+            print(f"{name:<16} {throughput:>10.1f} {elapsed:>10.3f} {backward:>16} {travel / 1e6:>12.1f}")
+        else:
+            print(f"{name:<16} {throughput:>10.1f} {elapsed:>10.3f} {'-':>16} {'-':>12}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare directory order and LBA order ISO extraction")
+    parser.add_argument("iso", help="ISO image to extract")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per mode, the best one is reported")
+    parser.add_argument("--work-dir", default=None, help="where to extract (defaults to the temp folder)")
+    args = parser.parse_args()
+    run(args.iso, args.repeat, args.work_dir)
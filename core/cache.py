@@ -0,0 +1,65 @@
+import os
+import json
+import threading
+
+
+def get_cache_dir():
+    """Get the per-user cache directory of the application"""
+    base = os.environ.get('LOCALAPPDATA') or os.environ.get('XDG_CACHE_HOME')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'LahiriISOFlasher')
+
+
+def file_cache_key(path, stat=None):
+    """Build a cache key that changes whenever the file does"""
+    if stat is None:
+        stat = os.stat(path)
+    return f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}|{stat.st_ino}"
+
+
+class MetadataCache:
+    """Small persistent JSON cache of per-file metadata"""
+
+    def __init__(self, name, max_entries=256, cache_dir=None):
+        self.path = os.path.join(cache_dir or get_cache_dir(), name)
+        self.max_entries = max_entries
+        self._entries = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self._entries = json.load(f)
+            if not isinstance(self._entries, dict):
+                self._entries = {}
+        except Exception:
+            self._entries = {}
+
+    def get(self, key):
+        """Get a cached value, or None"""
+        with self._lock:
+            self._load()
+            return self._entries.get(key)
+
+    def put(self, key, value):
+        """Store a value and write the cache file"""
+        with self._lock:
+            self._load()
+            self._entries.pop(key, None)
+            self._entries[key] = value
+
+            # Drop the oldest entries (dicts keep insertion order)
+            while len(self._entries) > self.max_entries:
+                del self._entries[next(iter(self._entries))]
+
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                temp_path = self.path + '.tmp'
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump(self._entries, f)
+                os.replace(temp_path, self.path)
+            except Exception as e:
+                print(f"Error writing cache {self.path}: {e}")
@@ -0,0 +1,233 @@
+import os
+import re
+import time
+import queue
+import hashlib
+import threading
+
+from core.cache import MetadataCache, file_cache_key
+from core.scheduler import PROGRESS_INTERVAL
+
+# Fast non-cryptographic hashes first, the first available one is the default
+PREFERRED_ALGORITHMS = ('xxh3', 'blake3', 'blake2b')
+
+
+def _xxh3():
+    import xxhash
+    return xxhash.xxh3_128
+
+
+def _blake3():
+    from blake3 import blake3
+    return blake3
+
+
+# Name -> function returning the hash constructor, optional packages are imported on use
+HASH_ALGORITHMS = {
+    'xxh3': _xxh3,
+    'blake3': _blake3,
+    'blake2b': lambda: hashlib.blake2b,
+    'sha256': lambda: hashlib.sha256,
+    'sha512': lambda: hashlib.sha512,
+    'sha1': lambda: hashlib.sha1,
+    'md5': lambda: hashlib.md5,
+}
+
+# Packages providing the optional algorithms
+HASH_PACKAGES = {'xxh3': 'xxhash', 'blake3': 'blake3'}
+
+
+def get_hash(name):
+    """Get the constructor of a hash algorithm by name"""
+    loader = HASH_ALGORITHMS.get(name)
+    if loader is None:
+        raise Exception(f"Unknown hash algorithm: {name}")
+    try:
+        return loader()
+    except ImportError:
+        raise Exception(f"Hash algorithm {name} needs the {HASH_PACKAGES[name]} package")
+
+
+def available_hashes():
+    """Names of the hash algorithms usable in this environment"""
+    names = []
+    for name, loader in HASH_ALGORITHMS.items():
+        try:
+            loader()
+            names.append(name)
+        except ImportError:
+            continue
+    return names
+
+
+def default_hash():
+    """Fastest available algorithm for comparing data"""
+    available = available_hashes()
+    for name in PREFERRED_ALGORITHMS:
+        if name in available:
+            return name
+    return 'sha256'
+
+
+# Algorithms compared against vendor checksum files
+SOURCE_ALGORITHMS = ('sha256', 'sha1', 'md5')
+
+# Read size of the single checksum pass
+CHECKSUM_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Chunks queued per algorithm ahead of its hashing thread
+CHECKSUM_QUEUE_DEPTH = 4
+
+# Checksum files looked for beside an image, {name} is the image file name
+CHECKSUM_FILES = (
+    'SHA256SUMS', 'SHA256SUMS.txt', 'sha256sum.txt', 'SHA512SUMS', 'SHA1SUMS', 'MD5SUMS', 'md5sum.txt',
+    'CHECKSUM', '{name}.sha256', '{name}.sha256sum', '{name}.sha512', '{name}.sha1', '{name}.md5',
+)
+
+# Hex digest length -> algorithm for checksum files that do not name it
+DIGEST_LENGTHS = {32: 'md5', 40: 'sha1', 64: 'sha256', 128: 'sha512'}
+
+# BSD style lines: SHA256 (file.iso) = 0123...
+BSD_CHECKSUM_LINE = re.compile(r'^(\w+)\s*\((.+)\)\s*=\s*([0-9a-fA-F]+)$')
+# GNU style lines: 0123...  file.iso, '*' marks binary mode
+GNU_CHECKSUM_LINE = re.compile(r'^([0-9a-fA-F]{32,128})\s+\*?(.+)$')
+
+
+def parse_checksum_file(path):
+    """Read a SHA256SUMS/MD5SUMS style file, returns [(algorithm, file name, hex digest)]"""
+    entries = []
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+
+            match = BSD_CHECKSUM_LINE.match(line)
+            if match:
+                algorithm = match.group(1).lower().replace('-', '')
+                name, digest = match.group(2), match.group(3)
+            else:
+                match = GNU_CHECKSUM_LINE.match(line)
+                if not match:
+                    continue
+                digest, name = match.group(1), match.group(2)
+                algorithm = DIGEST_LENGTHS.get(len(digest))
+
+            if algorithm in HASH_ALGORITHMS:
+                entries.append((algorithm, os.path.basename(name.strip().replace('\\', '/')), digest.lower()))
+    return entries
+
+
+def find_expected_checksums(image_path):
+    """Collect the digests published for an image in checksum files beside it
+
+    Returns {algorithm: (hex digest, checksum file)}.
+    """
+    folder = os.path.dirname(os.path.abspath(image_path))
+    name = os.path.basename(image_path)
+    expected = {}
+
+    for pattern in CHECKSUM_FILES:
+        path = os.path.join(folder, pattern.format(name=name))
+        if not os.path.isfile(path):
+            continue
+        try:
+            entries = parse_checksum_file(path)
+        except OSError:
+            continue
+        for algorithm, entry_name, digest in entries:
+            # Single entry files next to the image may omit the name
+            if entry_name == name or (len(entries) == 1 and pattern.startswith('{name}')):
+                expected.setdefault(algorithm, (digest, path))
+
+    return expected
+
+
+def compute_checksums(path, algorithms=SOURCE_ALGORITHMS, progress_callback=None, chunk_size=CHECKSUM_CHUNK_SIZE):
+    """Compute several digests of a file in a single read, one hashing thread per algorithm"""
+    hashers = {name: get_hash(name)() for name in algorithms}
+    queues = {name: queue.Queue(maxsize=CHECKSUM_QUEUE_DEPTH) for name in hashers}
+    errors = []
+
+    def consume(name):
+        hasher = hashers[name]
+        chunks = queues[name]
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                return
+            try:
+                hasher.update(chunk)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=consume, args=(name,), name=f'checksum-{name}', daemon=True)
+               for name in hashers]
+    for thread in threads:
+        thread.start()
+
+    total_bytes = os.path.getsize(path)
+    done_bytes = 0
+    last_report = 0
+    try:
+        with open(path, 'rb', buffering=0) as f:
+            while not errors:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                # Chunks are immutable, every algorithm hashes the same object
+                for chunks in queues.values():
+                    chunks.put(chunk)
+
+                done_bytes += len(chunk)
+                now = time.monotonic()
+                if progress_callback and now - last_report >= PROGRESS_INTERVAL:
+                    last_report = now
+                    progress_callback(done_bytes, total_bytes)
+    finally:
+        for chunks in queues.values():
+            chunks.put(None)
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+    if progress_callback:
+        progress_callback(done_bytes, total_bytes)
+
+    return {name: hasher.hexdigest() for name, hasher in hashers.items()}
+
+
+_checksum_cache = MetadataCache('checksums.json')
+
+
+def get_checksums(path, algorithms=SOURCE_ALGORITHMS, progress_callback=None):
+    """Digests of a file, cached by path, size and modification time
+
+    Only the algorithms missing from the cache are computed, in a single read.
+    """
+    key = file_cache_key(path)
+    cached = dict(_checksum_cache.get(key) or {})
+    missing = [name for name in algorithms if name not in cached]
+
+    if missing:
+        cached.update(compute_checksums(path, missing, progress_callback))
+        _checksum_cache.put(key, cached)
+
+    return {name: cached[name] for name in algorithms}
+
+
+def check_source_checksums(path, progress_callback=None):
+    """Compare an image with the checksum files published beside it
+
+    Returns (verified, details): verified is None when no checksum file lists the image,
+    details maps each algorithm to (expected, actual, checksum file).
+    """
+    expected = find_expected_checksums(path)
+    if not expected:
+        return None, {}
+
+    actual = get_checksums(path, list(expected), progress_callback)
+    details = {name: (digest, actual[name], source) for name, (digest, source) in expected.items()}
+    verified = all(expected_digest == actual_digest for expected_digest, actual_digest, _ in details.values())
+    return verified, details
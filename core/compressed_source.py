@@ -0,0 +1,436 @@
+import io
+import os
+import bz2
+import lzma
+import gzip
+import zlib
+import time
+import queue
+import struct
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from core.scheduler import DEFAULT_WORKERS, PROGRESS_INTERVAL, StageStats
+
+# Magic bytes at the start of every supported container
+COMPRESSION_MAGIC = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'BZh', 'bz2'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+)
+
+COMPRESSION_SUFFIXES = {'.gz': 'gzip', '.xz': 'xz', '.bz2': 'bz2', '.zst': 'zstd'}
+
+# Decompressed bytes handed over per queue item by the streaming decoders
+CHUNK_SIZE = 1024 * 1024
+
+# Decoded chunks buffered between the decode stage and the consumer
+QUEUE_DEPTH = 8
+
+# xz stream header/footer and the seekable zstd seek table
+XZ_HEADER_SIZE = 12
+ZSTD_SKIPPABLE_MAGIC = 0x184D2A5E
+ZSTD_SEEKABLE_MAGIC = 0x8F92EAB1
+
+
+def detect_compression(path):
+    """Get the compression format of a file from its magic bytes, or None"""
+    try:
+        with open(path, 'rb') as f:
+            magic = f.read(6)
+    except OSError:
+        return None
+
+    for prefix, name in COMPRESSION_MAGIC:
+        if magic.startswith(prefix):
+            return name
+
+    return None
+
+
+def _read_varint(data, offset):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+        if shift > 63:
+            raise Exception("Invalid xz index")
+
+
+def _varint(value):
+    data = bytearray()
+    while value >= 0x80:
+        data.append((value & 0x7F) | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def read_xz_blocks(f, size):
+    """Read the indexes of every stream of an xz file
+
+    Returns (stream header, offset, padded size, unpadded size, uncompressed size)
+    per block in file order.
+    """
+    blocks = []
+    position = size
+    while position > 0:
+        # Streams may be followed by zero padding in multiples of four bytes
+        f.seek(position - 4)
+        while position > 0 and f.read(4) == b'\0\0\0\0':
+            position -= 4
+            f.seek(position - 4)
+        if position < 2 * XZ_HEADER_SIZE:
+            raise Exception("Truncated xz stream")
+
+        f.seek(position - XZ_HEADER_SIZE)
+        footer = f.read(XZ_HEADER_SIZE)
+        if footer[10:12] != b'YZ':
+            raise Exception("Invalid xz stream footer")
+        backward_size = (struct.unpack_from('<I', footer, 4)[0] + 1) * 4
+
+        index_start = position - XZ_HEADER_SIZE - backward_size
+        f.seek(index_start)
+        index = f.read(backward_size)
+        if index[:1] != b'\0':
+            raise Exception("Invalid xz index")
+
+        records = []
+        count, offset = _read_varint(index, 1)
+        for _ in range(count):
+            unpadded, offset = _read_varint(index, offset)
+            uncompressed, offset = _read_varint(index, offset)
+            records.append((unpadded, uncompressed))
+
+        stream_start = index_start - sum((unpadded + 3) & ~3 for unpadded, _ in records) - XZ_HEADER_SIZE
+        f.seek(stream_start)
+        header = f.read(XZ_HEADER_SIZE)
+        if not header.startswith(b'\xfd7zXZ\x00') or header[6:8] != footer[8:10]:
+            raise Exception("Invalid xz stream header")
+
+        stream_blocks = []
+        offset = stream_start + XZ_HEADER_SIZE
+        for unpadded, uncompressed in records:
+            padded = (unpadded + 3) & ~3
+            stream_blocks.append((header, offset, padded, unpadded, uncompressed))
+            offset += padded
+
+        blocks[:0] = stream_blocks
+        position = stream_start
+
+    return blocks
+
+
+def decode_xz_block(header, block, unpadded_size, uncompressed_size):
+    """Decode one xz block by wrapping it in a single block stream of its own"""
+    index = b'\0' + _varint(1) + _varint(unpadded_size) + _varint(uncompressed_size)
+    index += bytes(-len(index) % 4)
+    index += struct.pack('<I', zlib.crc32(index))
+
+    backward = struct.pack('<I', len(index) // 4 - 1) + header[6:8]
+    footer = struct.pack('<I', zlib.crc32(backward)) + backward + b'YZ'
+
+    return lzma.decompress(header + block + index + footer, format=lzma.FORMAT_XZ)
+
+
+def read_zstd_seek_table(f, size):
+    """Read the seek table of a seekable zstd file
+
+    Returns (offset, compressed size, decompressed size) per frame, or None when the
+    file has no seek table.
+    """
+    if size < 9:
+        return None
+    f.seek(size - 9)
+    count, descriptor, magic = struct.unpack('<IBI', f.read(9))
+    if magic != ZSTD_SEEKABLE_MAGIC:
+        return None
+
+    entry_size = 12 if descriptor & 0x80 else 8
+    table_size = count * entry_size
+    f.seek(size - 9 - table_size - 8)
+    skippable_magic, frame_size = struct.unpack('<II', f.read(8))
+    if skippable_magic != ZSTD_SKIPPABLE_MAGIC or frame_size != table_size + 9:
+        raise Exception("Invalid zstd seek table")
+
+    table = f.read(table_size)
+    frames = []
+    offset = 0
+    for index in range(count):
+        compressed, decompressed = struct.unpack_from('<II', table, index * entry_size)
+        frames.append((offset, compressed, decompressed))
+        offset += compressed
+
+    return frames
+
+
+def _zstd_module():
+    try:
+        import zstandard
+        return zstandard
+    except ImportError:
+        pass
+    try:
+        # Standard library from Python 3.14
+        from compression import zstd
+        return zstd
+    except ImportError:
+        raise Exception("Reading .zst images needs the zstandard package")
+
+
+def decode_zstd_frame(frame, decompressed_size):
+    zstd = _zstd_module()
+    if hasattr(zstd, 'ZstdFile'):
+        return zstd.decompress(frame)
+    return zstd.ZstdDecompressor().decompress(frame, max_output_size=decompressed_size)
+
+
+def open_zstd_stream(fileobj):
+    zstd = _zstd_module()
+    if hasattr(zstd, 'ZstdFile'):
+        return zstd.ZstdFile(fileobj)
+    return zstd.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True)
+
+
+class _CountingReader(io.RawIOBase):
+    """File wrapper that counts the compressed bytes pulled by a decoder"""
+
+    def __init__(self, raw, stats):
+        self.raw = raw
+        self.stats = stats
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = self.raw.readinto(buffer)
+        self.stats.bytes += count or 0
+        return count
+
+
+class CompressedSource:
+    """Readable, decompressed view of a compressed image fed by a background decode stage
+
+    Formats with independent blocks (multi-block xz, seekable zstd) are decoded on a
+    pool of worker threads and handed over in order, everything else is streamed by a
+    single decoder thread. Either way decoding overlaps with whatever consumes the data.
+    """
+
+    def __init__(self, path, workers=DEFAULT_WORKERS, queue_depth=QUEUE_DEPTH):
+        self.path = path
+        self.format = detect_compression(path)
+        if self.format is None:
+            raise Exception(f"Unsupported compression: {os.path.basename(path)}")
+
+        self.workers = workers
+        self.compressed_size = os.path.getsize(path)
+        # Uncompressed size when the container records it
+        self.size = None
+
+        self.compressed_stats = StageStats("Compressed")
+        self.uncompressed_stats = StageStats("Uncompressed")
+
+        self._file = open(path, 'rb', buffering=0)
+        self._frames = None
+        try:
+            self._index()
+        except Exception as e:
+            print(f"Could not index {os.path.basename(path)}, decoding as a stream: {e}")
+            self._frames = None
+
+        self._queue = queue.Queue(maxsize=queue_depth)
+        self._stop = threading.Event()
+        self._thread = None
+        self._current = memoryview(b'')
+        self._eof = False
+
+    def _index(self):
+        """Find independently decodable blocks and the uncompressed size"""
+        if self.format == 'xz':
+            blocks = read_xz_blocks(self._file, self.compressed_size)
+            self.size = sum(block[4] for block in blocks)
+            if len(blocks) > 1:
+                self._frames = blocks
+        elif self.format == 'zstd':
+            frames = read_zstd_seek_table(self._file, self.compressed_size)
+            if frames:
+                self.size = sum(frame[2] for frame in frames)
+                if len(frames) > 1:
+                    self._frames = frames
+        self._file.seek(0)
+
+    @property
+    def parallel(self):
+        """True when blocks are decoded on more than one thread"""
+        return self._frames is not None and self.workers > 1
+
+    @property
+    def progress(self):
+        """Fraction of the compressed file consumed so far"""
+        if self.compressed_size <= 0:
+            return 0.0
+        return min(self.compressed_stats.bytes / self.compressed_size, 1.0)
+
+    @property
+    def stats(self):
+        return [self.compressed_stats, self.uncompressed_stats]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            # Unblock a decode stage waiting for room in the queue
+            while self._thread.is_alive():
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    pass
+                self._thread.join(PROGRESS_INTERVAL)
+            self._thread = None
+        self._file.close()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        """Fill buffer with decompressed bytes, returns 0 at the end of the image"""
+        if self._thread is None and not self._eof:
+            self._thread = threading.Thread(target=self._decode, name='decompress', daemon=True)
+            self._thread.start()
+
+        view = memoryview(buffer).cast('B')
+        filled = 0
+        while filled < len(view):
+            if not self._current:
+                if self._eof:
+                    break
+                item = self._queue.get()
+                if item is None:
+                    self._eof = True
+                    break
+                if isinstance(item, Exception):
+                    self._eof = True
+                    raise item
+                self._current = memoryview(item)
+
+            count = min(len(self._current), len(view) - filled)
+            view[filled:filled + count] = self._current[:count]
+            self._current = self._current[count:]
+            filled += count
+
+        return filled
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = []
+            while True:
+                chunk = self.read(CHUNK_SIZE)
+                if not chunk:
+                    return b''.join(chunks)
+                chunks.append(chunk)
+
+        buffer = bytearray(size)
+        count = self.readinto(buffer)
+        del buffer[count:]
+        return bytes(buffer)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=PROGRESS_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _decode(self):
+        started = time.perf_counter()
+        try:
+            if self.parallel:
+                self._decode_frames()
+            else:
+                self._decode_stream()
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.compressed_stats.seconds = elapsed
+            self.uncompressed_stats.seconds = elapsed
+
+    def _decode_stream(self):
+        reader = _CountingReader(self._file, self.compressed_stats)
+        if self.format == 'gzip':
+            decoder = gzip.GzipFile(fileobj=reader)
+        elif self.format == 'xz':
+            decoder = lzma.LZMAFile(reader)
+        elif self.format == 'bz2':
+            decoder = bz2.BZ2File(reader)
+        else:
+            decoder = open_zstd_stream(reader)
+
+        with decoder:
+            while not self._stop.is_set():
+                chunk = decoder.read(CHUNK_SIZE)
+                if not chunk:
+                    return
+                self.uncompressed_stats.bytes += len(chunk)
+                if not self._put(chunk):
+                    return
+
+    def _decode_frames(self):
+        """Read blocks in file order, decode them on the pool and queue the results in order"""
+        if self.format == 'xz':
+            decode = decode_xz_block
+            jobs = ((offset, padded, (header, unpadded, uncompressed))
+                    for header, offset, padded, unpadded, uncompressed in self._frames)
+        else:
+            decode = decode_zstd_frame
+            jobs = ((offset, compressed, (decompressed,)) for offset, compressed, decompressed in self._frames)
+
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='decompress') as executor:
+            try:
+                for offset, length, extra in jobs:
+                    if self._stop.is_set():
+                        return
+                    self._file.seek(offset)
+                    data = self._file.read(length)
+                    if len(data) < length:
+                        raise Exception(f"Unexpected end of {os.path.basename(self.path)} at offset {offset + len(data)}")
+                    self.compressed_stats.bytes += length
+
+                    if self.format == 'xz':
+                        header, unpadded, uncompressed = extra
+                        pending.append(executor.submit(decode, header, data, unpadded, uncompressed))
+                    else:
+                        pending.append(executor.submit(decode, data, *extra))
+
+                    # Keep every worker busy without decoding far ahead of the consumer
+                    while len(pending) > self.workers:
+                        if not self._queue_result(pending.popleft()):
+                            return
+
+                while pending:
+                    if not self._queue_result(pending.popleft()):
+                        return
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def _queue_result(self, future):
+        data = future.result()
+        self.uncompressed_stats.bytes += len(data)
+        return self._put(data)
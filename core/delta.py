@@ -0,0 +1,145 @@
+import os
+
+from core.manifest import MANIFEST_NAME
+from core.verifier import VERIFY_FULL, Verifier
+
+# Timestamps closer than this are equal, FAT keeps modification times in 2 second steps
+MTIME_TOLERANCE = 2.0
+
+# Entries at the root of a target that belong to the file system or the flasher, not the image
+PRESERVED_NAMES = {'system volume information', MANIFEST_NAME.casefold()}
+
+
+def _key(path):
+    # FAT and exFAT compare names without regard to case
+    return path.casefold()
+
+
+class DeltaPlan:
+    """Differences between the file tree on a target and the entries of an image"""
+
+    def __init__(self):
+        self.directories = []
+        # Entries missing on the target
+        self.added = []
+        # Entries whose size or content differ from the target
+        self.changed = []
+        # Entries with the same content but another timestamp on the target
+        self.retimed = []
+        self.unchanged = 0
+        # Target paths that are not in the image, directories deepest first
+        self.removed_files = []
+        self.removed_dirs = []
+        # Bytes read from each side to compare files of equal size and differing timestamps
+        self.hashed_bytes = 0
+
+    @property
+    def write_entries(self):
+        return self.added + self.changed
+
+    @property
+    def write_bytes(self):
+        return sum(entry.size for entry in self.write_entries)
+
+    def __str__(self):
+        return (f"Delta: {len(self.added)} added, {len(self.changed)} changed, {self.unchanged} unchanged, "
+                f"{len(self.removed_files)} removed, {self.write_bytes / 1e6:.1f} MB to write, "
+                f"{self.hashed_bytes / 1e6:.1f} MB compared")
+
+
+def scan_target(target_root):
+    """Index the files and directories under target_root by case folded relative path
+
+    Returns ({key: (path, size, mtime)}, {key: path}) for files and directories.
+    """
+    files = {}
+    directories = {}
+    for current, subdirectories, names in os.walk(target_root):
+        relative = os.path.relpath(current, target_root)
+        prefix = '' if relative == '.' else relative.replace(os.sep, '/') + '/'
+        if not prefix:
+            subdirectories[:] = [name for name in subdirectories if _key(name) not in PRESERVED_NAMES]
+            names = [name for name in names if _key(name) not in PRESERVED_NAMES]
+
+        for name in subdirectories:
+            directories[_key(prefix + name)] = os.path.join(current, name)
+        for name in names:
+            path = os.path.join(current, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files[_key(prefix + name)] = (path, stat.st_size, stat.st_mtime)
+    return files, directories
+
+
+def plan_delta(iso_path, target_root, entries, verifier=None):
+    """Compare a target tree with the entries of an image: size first, then timestamp, then content
+
+    Only files of equal size whose timestamps differ (or are unknown) are read and
+    hashed, on both sides, through the verifier's pool.
+    """
+    plan = DeltaPlan()
+    target_files, target_directories = scan_target(target_root)
+    image_files = set()
+    image_directories = set()
+    candidates = []
+
+    for entry in entries:
+        key = _key(entry.path)
+        if entry.is_dir:
+            image_directories.add(key)
+            plan.directories.append(entry)
+            continue
+
+        image_files.add(key)
+        existing = target_files.get(key)
+        if existing is None:
+            plan.added.append(entry)
+            continue
+
+        _, size, mtime = existing
+        if size != entry.size:
+            plan.changed.append(entry)
+        elif entry.mtime is not None and abs(mtime - entry.mtime) <= MTIME_TOLERANCE:
+            plan.unchanged += 1
+        else:
+            candidates.append(entry)
+
+    if candidates:
+        verifier = verifier or Verifier(VERIFY_FULL)
+        result = verifier.verify_files(iso_path, target_root, candidates)
+        plan.hashed_bytes = result.checked_bytes
+        differing = {_key(mismatch.path) for mismatch in result.mismatches}
+        for entry in candidates:
+            if _key(entry.path) in differing:
+                plan.changed.append(entry)
+            elif entry.mtime is not None:
+                plan.retimed.append(entry)
+            else:
+                plan.unchanged += 1
+
+    # A file where the image has a directory goes too, and the other way round
+    plan.removed_files = sorted(path for key, (path, _, _) in target_files.items() if key not in image_files)
+    plan.removed_dirs = sorted((path for key, path in target_directories.items() if key not in image_directories),
+                               key=lambda path: path.count(os.sep), reverse=True)
+    return plan
+
+
+def remove_stale(plan):
+    """Delete the files and directories of a target that the image no longer has"""
+    for path in plan.removed_files:
+        os.remove(path)
+    for path in plan.removed_dirs:
+        # Children were removed above, deepest directories first
+        os.rmdir(path)
+
+
+def apply_timestamps(entries, target_root):
+    """Give unchanged files the image's timestamps so the next comparison skips them"""
+    for entry in entries:
+        target = os.path.join(target_root, *entry.path.split('/'))
+        try:
+            os.utime(target, (entry.mtime, entry.mtime))
+        except OSError:
+            pass
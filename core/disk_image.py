@@ -0,0 +1,429 @@
+import os
+import sys
+import zlib
+import struct
+import threading
+
+# Virtual disk sector size of VHD bitmaps and qcow2 compressed cluster descriptors
+DISK_SECTOR_SIZE = 512
+
+# VHD footer and dynamic disk header
+VHD_COOKIE = b'conectix'
+VHD_DYNAMIC_COOKIE = b'cxsparse'
+VHD_FOOTER_SIZE = 512
+VHD_TYPE_FIXED = 2
+VHD_TYPE_DYNAMIC = 3
+VHD_TYPE_DIFFERENCING = 4
+VHD_UNALLOCATED = 0xFFFFFFFF
+
+# qcow2 header and table entry bits
+QCOW2_MAGIC = b'QFI\xfb'
+QCOW2_OFFSET_MASK = 0x00FFFFFFFFFFFE00
+QCOW2_COMPRESSED = 1 << 62
+QCOW2_ZERO = 1
+QCOW2_INCOMPATIBLE_DIRTY = 1
+QCOW2_INCOMPATIBLE_CORRUPT = 2
+QCOW2_INCOMPATIBLE_COMPRESSION = 8
+
+# Windows sparse file range query
+FSCTL_QUERY_ALLOCATED_RANGES = 0x940CF
+ALLOCATED_RANGES_BUFFER = 64 * 1024
+
+
+def merge_ranges(ranges, alignment=1, limit=None):
+    """Sort, align outward and merge (offset, length) ranges"""
+    merged = []
+    for offset, length in sorted(ranges):
+        start = offset - offset % alignment
+        end = -(-(offset + length) // alignment) * alignment
+        if limit is not None:
+            end = min(end, limit)
+        if end <= start:
+            continue
+        if merged and start <= merged[-1][0] + merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end - merged[-1][0])
+        else:
+            merged.append([start, end - start])
+    return [(offset, length) for offset, length in merged]
+
+
+def hole_ranges(ranges, size):
+    """(offset, length) gaps between sorted, merged ranges up to size"""
+    holes = []
+    position = 0
+    for offset, length in ranges:
+        if offset > position:
+            holes.append((position, offset - position))
+        position = max(position, offset + length)
+    if size is not None and size > position:
+        holes.append((position, size - position))
+    return holes
+
+
+class DiskImage:
+    """Virtual disk read from an image file: random access reads plus the map of allocated data
+
+    Ranges outside extents() read back as zeros, so a writer only has to transfer the
+    extents to a target that already reads zeros.
+    """
+
+    format = None
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb', buffering=0)
+        self.file_size = os.fstat(self._file.fileno()).st_size
+        # Virtual disk size
+        self.size = self.file_size
+        self._lock = threading.Lock()
+        self._extents = None
+
+    @classmethod
+    def matches(cls, header, footer):
+        """Check the first and last sector of a file for this format"""
+        return False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def extents(self):
+        """Allocated (offset, length) ranges of the virtual disk, sorted and merged"""
+        if self._extents is None:
+            self._extents = merge_ranges(self._map_extents(), limit=self.size)
+        return self._extents
+
+    @property
+    def allocated_bytes(self):
+        return sum(length for _, length in self.extents())
+
+    def _map_extents(self):
+        return [(0, self.size)]
+
+    def _read_file(self, offset, view):
+        """Fill a view from the image file, zeros past its end"""
+        with self._lock:
+            self._file.seek(offset)
+            filled = 0
+            while filled < len(view):
+                count = self._file.readinto(view[filled:])
+                if not count:
+                    break
+                filled += count
+        view[filled:] = bytes(len(view) - filled)
+
+    def readinto_at(self, offset, buffer):
+        """Fill buffer with virtual disk data from offset, returns the bytes filled"""
+        view = memoryview(buffer).cast('B')
+        length = max(0, min(len(view), self.size - offset))
+        self._read(offset, view[:length])
+        return length
+
+    def _read(self, offset, view):
+        self._read_file(offset, view)
+
+    def read_at(self, offset, length):
+        buffer = bytearray(length)
+        count = self.readinto_at(offset, buffer)
+        return bytes(buffer[:count])
+
+
+class RawImage(DiskImage):
+    """Raw disk image, holes of sparse files are left out of the extents"""
+
+    format = 'raw'
+
+    def _map_extents(self):
+        return self._file_data_ranges(0, self.size)
+
+    def _file_data_ranges(self, start, end):
+        """Data ranges of the image file between start and end"""
+        try:
+            if sys.platform.startswith('win'):
+                return self._windows_allocated_ranges(start, end)
+            if hasattr(os, 'SEEK_DATA'):
+                return self._seek_data_ranges(start, end)
+        except Exception as e:
+            print(f"Could not map sparse image {os.path.basename(self.path)}: {e}")
+        return [(start, end - start)]
+
+    def _seek_data_ranges(self, start, end):
+        fd = self._file.fileno()
+        ranges = []
+        position = start
+        while position < end:
+            try:
+                data = os.lseek(fd, position, os.SEEK_DATA)
+            except OSError:
+                # ENXIO: no data past position
+                break
+            if data >= end:
+                break
+            hole = min(os.lseek(fd, data, os.SEEK_HOLE), end)
+            ranges.append((data, hole - data))
+            position = hole
+        return ranges
+
+    def _windows_allocated_ranges(self, start, end):
+        import msvcrt
+        import win32file
+
+        handle = msvcrt.get_osfhandle(self._file.fileno())
+        ranges = []
+        position = start
+        while position < end:
+            query = struct.pack('<qq', position, end - position)
+            result = win32file.DeviceIoControl(handle, FSCTL_QUERY_ALLOCATED_RANGES, query, ALLOCATED_RANGES_BUFFER)
+            if not result:
+                break
+            for index in range(0, len(result) - 15, 16):
+                offset, length = struct.unpack_from('<qq', result, index)
+                ranges.append((offset, min(length, end - offset)))
+            if len(result) < ALLOCATED_RANGES_BUFFER:
+                break
+            # A full buffer means there may be more ranges behind the last one
+            position = ranges[-1][0] + ranges[-1][1]
+        return ranges
+
+
+class FixedVHDImage(RawImage):
+    """Fixed size VHD: raw disk data followed by a 512 byte footer"""
+
+    format = 'vhd'
+
+    def __init__(self, path):
+        super().__init__(path)
+        self._file.seek(self.file_size - VHD_FOOTER_SIZE)
+        footer = self._file.read(VHD_FOOTER_SIZE)
+        self.size = min(struct.unpack_from('>Q', footer, 48)[0], self.file_size - VHD_FOOTER_SIZE)
+
+    @classmethod
+    def matches(cls, header, footer):
+        return footer.startswith(VHD_COOKIE) and struct.unpack_from('>I', footer, 60)[0] == VHD_TYPE_FIXED
+
+
+class DynamicVHDImage(DiskImage):
+    """Dynamic VHD: a block allocation table of blocks with per sector bitmaps"""
+
+    format = 'vhd'
+
+    def __init__(self, path):
+        super().__init__(path)
+        footer = self._file.read(VHD_FOOTER_SIZE)
+        if struct.unpack_from('>I', footer, 60)[0] == VHD_TYPE_DIFFERENCING:
+            raise Exception("Differencing VHDs need their parent image and are not supported")
+
+        self.size = struct.unpack_from('>Q', footer, 48)[0]
+        header_offset = struct.unpack_from('>Q', footer, 16)[0]
+        self._file.seek(header_offset)
+        header = self._file.read(1024)
+        if not header.startswith(VHD_DYNAMIC_COOKIE):
+            raise Exception("Invalid dynamic VHD header")
+
+        table_offset = struct.unpack_from('>Q', header, 16)[0]
+        entries, self.block_size = struct.unpack_from('>II', header, 28)
+        self.sectors_per_block = self.block_size // DISK_SECTOR_SIZE
+        # One bit per sector, padded to whole sectors
+        self.bitmap_size = -(-self.sectors_per_block // 8 // DISK_SECTOR_SIZE) * DISK_SECTOR_SIZE
+
+        self._file.seek(table_offset)
+        table = self._file.read(entries * 4)
+        self.block_table = struct.unpack(f'>{len(table) // 4}I', table)
+        self._bitmaps = {}
+
+    @classmethod
+    def matches(cls, header, footer):
+        return header.startswith(VHD_COOKIE) and struct.unpack_from('>I', header, 60)[0] in (
+            VHD_TYPE_DYNAMIC, VHD_TYPE_DIFFERENCING)
+
+    def _bitmap(self, block):
+        bitmap = self._bitmaps.get(block)
+        if bitmap is None:
+            bitmap = bytearray(self.bitmap_size)
+            self._read_file(self.block_table[block] * DISK_SECTOR_SIZE, memoryview(bitmap))
+            self._bitmaps[block] = bitmap
+        return bitmap
+
+    def _sector_runs(self, block, first, count):
+        """Split sectors of a block into (first sector, count, present) runs"""
+        bitmap = self._bitmap(block)
+        runs = []
+        for sector in range(first, first + count):
+            present = bool(bitmap[sector >> 3] & (0x80 >> (sector & 7)))
+            if runs and runs[-1][2] == present:
+                runs[-1][1] += 1
+            else:
+                runs.append([sector, 1, present])
+        return runs
+
+    def _map_extents(self):
+        ranges = []
+        for block, sector in enumerate(self.block_table):
+            if sector == VHD_UNALLOCATED:
+                continue
+            base = block * self.block_size
+            bitmap = self._bitmap(block)
+            if not any(bitmap):
+                continue
+            if all(byte == 0xFF for byte in bitmap[:self.sectors_per_block // 8]):
+                ranges.append((base, self.block_size))
+                continue
+            for first, count, present in self._sector_runs(block, 0, self.sectors_per_block):
+                if present:
+                    ranges.append((base + first * DISK_SECTOR_SIZE, count * DISK_SECTOR_SIZE))
+        return ranges
+
+    def _read(self, offset, view):
+        position = 0
+        while position < len(view):
+            block, within = divmod(offset + position, self.block_size)
+            length = min(self.block_size - within, len(view) - position)
+            chunk = view[position:position + length]
+            sector = self.block_table[block] if block < len(self.block_table) else VHD_UNALLOCATED
+
+            if sector == VHD_UNALLOCATED:
+                chunk[:] = bytes(length)
+            else:
+                data_offset = sector * DISK_SECTOR_SIZE + self.bitmap_size
+                self._read_file(data_offset + within, chunk)
+                # Sectors without their bitmap bit are not present and read as zeros
+                first = within // DISK_SECTOR_SIZE
+                last = (within + length - 1) // DISK_SECTOR_SIZE
+                for run_first, count, present in self._sector_runs(block, first, last - first + 1):
+                    if present:
+                        continue
+                    start = max(run_first * DISK_SECTOR_SIZE - within, 0)
+                    end = min((run_first + count) * DISK_SECTOR_SIZE - within, length)
+                    chunk[start:end] = bytes(end - start)
+
+            position += length
+
+
+class Qcow2Image(DiskImage):
+    """qcow2 image: two level cluster tables, zero clusters and deflate compressed clusters"""
+
+    format = 'qcow2'
+
+    def __init__(self, path):
+        super().__init__(path)
+        header = self._file.read(112)
+        (version, backing_offset, _, self.cluster_bits, self.size, crypt_method,
+         l1_size, l1_offset) = struct.unpack_from('>IQIIQIIQ', header, 4)
+
+        if backing_offset:
+            raise Exception("qcow2 images with a backing file are not supported")
+        if crypt_method:
+            raise Exception("Encrypted qcow2 images are not supported")
+        if version >= 3:
+            incompatible = struct.unpack_from('>Q', header, 72)[0]
+            if incompatible & QCOW2_INCOMPATIBLE_CORRUPT:
+                raise Exception("qcow2 image is marked corrupt")
+            if incompatible & ~(QCOW2_INCOMPATIBLE_DIRTY | QCOW2_INCOMPATIBLE_COMPRESSION):
+                raise Exception("qcow2 image uses unsupported features")
+            header_length = struct.unpack_from('>I', header, 100)[0]
+            if incompatible & QCOW2_INCOMPATIBLE_COMPRESSION and header_length > 104 and header[104] != 0:
+                raise Exception("Only deflate compressed qcow2 images are supported")
+
+        self.cluster_size = 1 << self.cluster_bits
+        self.l2_entries = self.cluster_size // 8
+        self._file.seek(l1_offset)
+        table = self._file.read(l1_size * 8)
+        self.l1_table = struct.unpack(f'>{len(table) // 8}Q', table)
+        self._l2_tables = {}
+        self._compressed_cluster = (None, None)
+
+    @classmethod
+    def matches(cls, header, footer):
+        return header.startswith(QCOW2_MAGIC)
+
+    def _l2_entry(self, cluster):
+        l1_index, l2_index = divmod(cluster, self.l2_entries)
+        if l1_index >= len(self.l1_table):
+            return 0
+        l2_offset = self.l1_table[l1_index] & QCOW2_OFFSET_MASK
+        if not l2_offset:
+            return 0
+
+        table = self._l2_tables.get(l2_offset)
+        if table is None:
+            data = bytearray(self.cluster_size)
+            self._read_file(l2_offset, memoryview(data))
+            table = struct.unpack(f'>{self.l2_entries}Q', data)
+            self._l2_tables[l2_offset] = table
+        return table[l2_index]
+
+    def _map_extents(self):
+        ranges = []
+        clusters = -(-self.size // self.cluster_size)
+        for cluster in range(clusters):
+            entry = self._l2_entry(cluster)
+            if entry & QCOW2_COMPRESSED or (entry & QCOW2_OFFSET_MASK and not entry & QCOW2_ZERO):
+                ranges.append((cluster * self.cluster_size, self.cluster_size))
+        return ranges
+
+    def _decompress_cluster(self, entry):
+        cached_entry, data = self._compressed_cluster
+        if cached_entry == entry:
+            return data
+
+        shift = 62 - (self.cluster_bits - 8)
+        host_offset = entry & ((1 << shift) - 1)
+        sectors = ((entry >> shift) & ((1 << (62 - shift)) - 1)) + 1
+        compressed = bytearray(sectors * DISK_SECTOR_SIZE - host_offset % DISK_SECTOR_SIZE)
+        self._read_file(host_offset, memoryview(compressed))
+
+        data = zlib.decompressobj(-12).decompress(compressed, self.cluster_size)
+        data += bytes(self.cluster_size - len(data))
+        self._compressed_cluster = (entry, data)
+        return data
+
+    def _read(self, offset, view):
+        position = 0
+        while position < len(view):
+            cluster, within = divmod(offset + position, self.cluster_size)
+            entry = self._l2_entry(cluster)
+            length = min(self.cluster_size - within, len(view) - position)
+
+            if entry & QCOW2_COMPRESSED:
+                view[position:position + length] = self._decompress_cluster(entry)[within:within + length]
+            elif entry & QCOW2_ZERO or not entry & QCOW2_OFFSET_MASK:
+                view[position:position + length] = bytes(length)
+            else:
+                host = (entry & QCOW2_OFFSET_MASK) + within
+                next_host = (entry & QCOW2_OFFSET_MASK) + self.cluster_size
+                # Clusters that follow each other on the host are read in one go
+                while position + length < len(view):
+                    following = self._l2_entry(cluster + 1)
+                    if following & (QCOW2_COMPRESSED | QCOW2_ZERO) or (following & QCOW2_OFFSET_MASK) != next_host:
+                        break
+                    cluster += 1
+                    next_host += self.cluster_size
+                    length += min(self.cluster_size, len(view) - position - length)
+                self._read_file(host, view[position:position + length])
+
+            position += length
+
+
+# Formats tried in order before falling back to a raw image
+DISK_IMAGE_FORMATS = [Qcow2Image, DynamicVHDImage, FixedVHDImage]
+
+
+def open_disk_image(path):
+    """Open an image file with the first format that recognizes it"""
+    with open(path, 'rb') as f:
+        header = f.read(VHD_FOOTER_SIZE)
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(size - VHD_FOOTER_SIZE, 0))
+        footer = f.read(VHD_FOOTER_SIZE)
+
+    for image_format in DISK_IMAGE_FORMATS:
+        if image_format.matches(header, footer):
+            return image_format(path)
+
+    return RawImage(path)
@@ -0,0 +1,546 @@
+import os
+import sys
+import time
+import struct
+from array import array
+from collections import deque
+
+from core.extent_reader import ExtentReader
+from core.fat32 import SequentialWriter, dos_datetime, source_position, stream_file, write_fat_region
+from core.partition import get_device_size, write_at
+from core.raw_writer import get_sector_sizes
+from core.scheduler import PROGRESS_INTERVAL
+
+# Boot sector, eight extended boot sectors, OEM parameters, a reserved sector and the checksum sector
+BOOT_REGION_SECTORS = 12
+BOOT_CHECKSUM_SECTOR = 11
+EXTENDED_BOOT_SIGNATURE = b'\x00\x00\x55\xAA'
+FILE_SYSTEM_REVISION = 0x0100
+
+# The FAT follows the main and backup boot regions
+EXFAT_FAT_OFFSET = 2 * BOOT_REGION_SECTORS
+
+EXFAT_MAX_CLUSTERS = 0xFFFFFFF5
+EXFAT_EOC = 0xFFFFFFFF
+EXFAT_MEDIA = 0xFFFFFFF8
+FIRST_CLUSTER = 2
+
+MAX_CLUSTER_SIZE = 32 * 1024 * 1024
+MIN_VOLUME_SIZE = 1024 * 1024
+
+# Default cluster sizes by volume size, as Windows formats them
+DEFAULT_CLUSTER_SIZES = (
+    (256 * 1024 * 1024, 4096),
+    (32 * 1024 * 1024 * 1024, 32 * 1024),
+    (None, 128 * 1024),
+)
+
+ENTRY_SIZE = 32
+ENTRY_ALLOCATION_BITMAP = 0x81
+ENTRY_UPCASE_TABLE = 0x82
+ENTRY_VOLUME_LABEL = 0x83
+ENTRY_FILE = 0x85
+ENTRY_STREAM_EXTENSION = 0xC0
+ENTRY_FILE_NAME = 0xC1
+
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+
+# GeneralSecondaryFlags of a stream extension: clusters allocated, and contiguous without a FAT chain
+ALLOCATION_POSSIBLE = 0x01
+NO_FAT_CHAIN = 0x02
+
+# UTF-16 units of a name held by one file name entry, the longest name and label
+NAME_CHARS = 15
+MAX_NAME_LENGTH = 255
+MAX_LABEL_LENGTH = 11
+
+# Characters exFAT does not allow in file names, besides control characters
+INVALID_NAME_CHARS = set('"*/:<>?\\|')
+
+# Directories may not grow beyond this
+MAX_DIRECTORY_SIZE = 256 * 1024 * 1024
+
+# Unit following this marker in the up-case table counts characters that map to themselves
+UPCASE_RUN_MARKER = 0xFFFF
+
+# Halt, for anyone booting the volume itself. Drives that boot from BIOS are formatted by diskpart instead
+BOOT_CODE = b'\xF4\xEB\xFD'
+
+
+class ExFATLayout:
+    """Geometry of an exFAT volume, offsets in bytes from the start of the volume"""
+
+    def __init__(self, sector_size, sectors_per_cluster, fat_offset, fat_length, cluster_heap_offset, cluster_count,
+                 volume_length, partition_offset=0):
+        self.sector_size = sector_size
+        self.sectors_per_cluster = sectors_per_cluster
+        # In sectors, like the boot sector stores them
+        self.fat_offset = fat_offset
+        self.fat_length = fat_length
+        self.cluster_heap_offset = cluster_heap_offset
+        self.cluster_count = cluster_count
+        self.volume_length = volume_length
+        # Sectors in front of the volume on the disk, the partition start
+        self.partition_offset = partition_offset
+
+    @property
+    def cluster_size(self):
+        return self.sector_size * self.sectors_per_cluster
+
+    @property
+    def bitmap_size(self):
+        return -(-self.cluster_count // 8)
+
+    def cluster_offset(self, cluster):
+        """Byte offset of a cluster of the heap, the first one is number 2"""
+        return (self.cluster_heap_offset + (cluster - FIRST_CLUSTER) * self.sectors_per_cluster) * self.sector_size
+
+    def __repr__(self):
+        return (f"ExFATLayout(cluster_size={self.cluster_size}, clusters={self.cluster_count}, "
+                f"fat_length={self.fat_length}, cluster_heap_offset={self.cluster_heap_offset})")
+
+
+def default_exfat_cluster_size(volume_size):
+    for limit, cluster_size in DEFAULT_CLUSTER_SIZES:
+        if limit is None or volume_size <= limit:
+            return cluster_size
+
+
+def plan_exfat(volume_size, cluster_size=None, sector_size=512, partition_offset=0):
+    """Lay out an exFAT volume with the cluster heap aligned to the cluster size"""
+    cluster_size = cluster_size or default_exfat_cluster_size(volume_size)
+    if sector_size not in (512, 1024, 2048, 4096):
+        raise Exception(f"exFAT does not support {sector_size} byte sectors")
+    if cluster_size % sector_size or cluster_size > MAX_CLUSTER_SIZE or cluster_size & (cluster_size - 1):
+        raise Exception(f"Cluster size {cluster_size} does not suit {sector_size} byte sectors")
+    if volume_size < MIN_VOLUME_SIZE:
+        raise Exception("Volume is too small for exFAT")
+
+    volume_length = volume_size // sector_size
+    sectors_per_cluster = cluster_size // sector_size
+    fat_length = 1
+
+    # A bigger FAT leaves fewer clusters to describe, stop once it holds all of them
+    while True:
+        heap_offset = EXFAT_FAT_OFFSET + fat_length
+        heap_offset += -heap_offset % sectors_per_cluster
+        clusters = min((volume_length - heap_offset) // sectors_per_cluster, EXFAT_MAX_CLUSTERS)
+        needed = -(-(clusters + 2) * 4 // sector_size)
+        if needed <= fat_length:
+            break
+        fat_length = needed
+
+    if clusters < 3:
+        raise Exception(f"Volume is too small for exFAT with {cluster_size} byte clusters")
+    return ExFATLayout(sector_size, sectors_per_cluster, EXFAT_FAT_OFFSET, fat_length, heap_offset, clusters,
+                       volume_length, partition_offset)
+
+
+def _rotate32(checksum, byte):
+    return ((checksum >> 1) | ((checksum & 1) << 31)) + byte & 0xFFFFFFFF
+
+
+def _rotate16(checksum, data):
+    for byte in data:
+        checksum = ((checksum >> 1) | ((checksum & 1) << 15)) + byte & 0xFFFF
+    return checksum
+
+
+def boot_checksum(sectors):
+    """Checksum of the first eleven boot region sectors, VolumeFlags and PercentInUse excluded"""
+    checksum = 0
+    for index, byte in enumerate(sectors):
+        if index not in (106, 107, 112):
+            checksum = _rotate32(checksum, byte)
+    return checksum
+
+
+def table_checksum(data):
+    checksum = 0
+    for byte in data:
+        checksum = _rotate32(checksum, byte)
+    return checksum
+
+
+_upcase_mapping = None
+
+
+def upcase_mapping():
+    """Upper case of every UTF-16 unit, surrogates and characters without a single unit upper case map to themselves"""
+    global _upcase_mapping
+    if _upcase_mapping is None:
+        mapping = array('H', range(0x10000))
+        for unit in range(0x10000):
+            if 0xD800 <= unit < 0xE000:
+                continue
+            upper = chr(unit).upper()
+            if len(upper) == 1 and ord(upper) < 0x10000:
+                mapping[unit] = ord(upper)
+        _upcase_mapping = mapping
+    return _upcase_mapping
+
+
+def build_upcase_table():
+    """Up-case table with runs of characters that map to themselves compressed, and its checksum"""
+    mapping = upcase_mapping()
+    table = array('H')
+    unit = 0
+    while unit < 0x10000:
+        end = unit
+        while end < 0x10000 and mapping[end] == end:
+            end += 1
+        # A run is cheaper from three characters on, and the last character may not be mistaken for a marker
+        if end - unit >= 3 or end == 0x10000 and end > unit:
+            table.extend((UPCASE_RUN_MARKER, end - unit))
+            unit = end
+        else:
+            table.append(mapping[unit])
+            unit += 1
+    if sys.byteorder != 'little':
+        table.byteswap()
+    data = table.tobytes()
+    return data, table_checksum(data)
+
+
+def name_units(name):
+    units = array('H', name.encode('utf-16-le'))
+    if sys.byteorder != 'little':
+        units.byteswap()
+    return units
+
+
+def upcase_name(name):
+    """Up-cased UTF-16 units of a name, the form exFAT compares and hashes names in"""
+    mapping = upcase_mapping()
+    return array('H', (mapping[unit] for unit in name_units(name)))
+
+
+def name_hash(name):
+    checksum = 0
+    for unit in upcase_name(name):
+        checksum = _rotate16(checksum, (unit & 0xFF, unit >> 8))
+    return checksum
+
+
+def exfat_name(name):
+    """Name with the characters exFAT rejects replaced"""
+    return ''.join('_' if char in INVALID_NAME_CHARS or ord(char) < 0x20 else char for char in name)
+
+
+def exfat_timestamp(timestamp):
+    """(timestamp, 10 ms increment, UTC offset) fields of a POSIX timestamp in local time"""
+    date, clock = dos_datetime(timestamp)
+    moment = time.localtime(timestamp)
+    increment = (moment.tm_sec % 2) * 100 + int(timestamp * 100) % 100 if moment.tm_year >= 1980 else 0
+    # Offset in 15 minute steps with the valid bit set
+    utc_offset = 0x80 | (round((moment.tm_gmtoff or 0) / 900) & 0x7F)
+    return (date << 16) | clock, increment, utc_offset
+
+
+def build_boot_region(layout, root_cluster, volume_id, percent_in_use=0xFF):
+    """Boot sector, extended boot sectors, OEM parameters and the checksum sector"""
+    size = layout.sector_size
+    region = bytearray(BOOT_REGION_SECTORS * size)
+    struct.pack_into(
+        '<3s8s53xQQIIIIIIHHBBBBB', region, 0,
+        b'\xEB\x76\x90', b'EXFAT   ',
+        layout.partition_offset, layout.volume_length,
+        layout.fat_offset, layout.fat_length, layout.cluster_heap_offset, layout.cluster_count, root_cluster, volume_id,
+        FILE_SYSTEM_REVISION, 0,
+        size.bit_length() - 1, layout.sectors_per_cluster.bit_length() - 1,
+        1, 0x80, percent_in_use
+    )
+    # The boot code of the main boot sector is where the jump lands
+    region[120:120 + len(BOOT_CODE)] = BOOT_CODE
+    region[510:512] = b'\x55\xAA'
+    for sector in range(1, 9):
+        region[(sector + 1) * size - 4:(sector + 1) * size] = EXTENDED_BOOT_SIGNATURE
+
+    checksum = boot_checksum(region[:BOOT_CHECKSUM_SECTOR * size])
+    region[BOOT_CHECKSUM_SECTOR * size:] = struct.pack('<I', checksum) * (size // 4)
+    return bytes(region)
+
+
+def volume_label_entry(label):
+    units = label.encode('utf-16-le')
+    return struct.pack('<BB22s8x', ENTRY_VOLUME_LABEL, len(units) // 2, units)
+
+
+def bitmap_entry(cluster, length):
+    return struct.pack('<BB18xIQ', ENTRY_ALLOCATION_BITMAP, 0, cluster, length)
+
+
+def upcase_entry(checksum, cluster, length):
+    return struct.pack('<B3xI12xIQ', ENTRY_UPCASE_TABLE, checksum, cluster, length)
+
+
+def file_entry_set(name, attributes, cluster, size, timestamp, contiguous=True):
+    """File, stream extension and file name entries of one file or directory, with their set checksum"""
+    units = name.encode('utf-16-le')
+    name_entries = -(-len(units) // (NAME_CHARS * 2))
+    stamp, increment, utc_offset = exfat_timestamp(timestamp)
+
+    flags = ALLOCATION_POSSIBLE | (NO_FAT_CHAIN if contiguous and cluster else 0)
+    entries = bytearray(struct.pack('<BBHHHIIIBBBBB7x', ENTRY_FILE, 1 + name_entries, 0, attributes, 0,
+                                    stamp, stamp, stamp, increment, increment, utc_offset, utc_offset, utc_offset))
+    entries += struct.pack('<BBBBHHQIIQ', ENTRY_STREAM_EXTENSION, flags, 0, len(units) // 2, name_hash(name), 0,
+                           size, 0, cluster, size)
+    for index in range(name_entries):
+        part = units[index * NAME_CHARS * 2:(index + 1) * NAME_CHARS * 2]
+        entries += struct.pack('<BB30s', ENTRY_FILE_NAME, 0, part)
+
+    # The checksum covers the whole set except its own field
+    checksum = _rotate16(0, entries[:2])
+    checksum = _rotate16(checksum, entries[4:])
+    struct.pack_into('<H', entries, 2, checksum)
+    return bytes(entries)
+
+
+def entry_set_slots(name):
+    return 2 + -(-len(name.encode('utf-16-le')) // (NAME_CHARS * 2))
+
+
+class _Directory:
+    __slots__ = ('path', 'mtime', 'children', 'records', 'cluster', 'clusters')
+
+    def __init__(self, path, mtime=None):
+        self.path = path
+        self.mtime = mtime
+        # Child directories and file entries, in catalog order
+        self.children = []
+        # (name, child) of every entry, filled in by the planner
+        self.records = []
+        self.cluster = 0
+        self.clusters = 0
+
+
+class ExFATBuilder:
+    """Lay out an exFAT volume straight from an image catalog and write it in one sequential sweep
+
+    The allocation bitmap, the up-case table and the root directory come first, then
+    the other directories and the files in the order their data lies in the image.
+    Every directory and file is a contiguous run marked NoFatChain, so the FAT only
+    chains the three system structures and a file of any size is one sequential write.
+    """
+
+    def __init__(self, entries, layout, label='', progress_callback=None):
+        self.layout = layout
+        self.label = exfat_name(label or '')[:MAX_LABEL_LENGTH]
+        # Called with (written_bytes, total_bytes)
+        self.progress_callback = progress_callback
+        self.timestamp = time.time()
+
+        self.upcase_table, self.upcase_checksum = build_upcase_table()
+        self.root = _Directory('')
+        self.directories = []
+        # (entry, first cluster, cluster count) in cluster order
+        self.files = []
+        self.total_bytes = 0
+        self.used_clusters = 0
+        self.skipped = []
+        self._last_report = 0
+
+        self._plan(entries)
+
+    def _clusters(self, size):
+        return -(-size // self.layout.cluster_size)
+
+    def _plan(self, entries):
+        directories = {'': self.root}
+
+        def directory(path, mtime=None):
+            node = directories.get(path)
+            if node is None:
+                node = _Directory(path, mtime)
+                directories[path] = node
+                directory(path.rpartition('/')[0]).children.append(node)
+            elif mtime is not None:
+                node.mtime = mtime
+            return node
+
+        files = []
+        for entry in entries:
+            if entry.is_dir:
+                directory(entry.path, entry.mtime)
+                continue
+            directory(entry.path.rpartition('/')[0]).children.append(entry)
+            files.append(entry)
+
+        # Breadth first, parents ahead of their children
+        pending = deque([self.root])
+        while pending:
+            node = pending.popleft()
+            self.directories.append(node)
+            self._name_children(node)
+            pending.extend(child for _, child in node.records if isinstance(child, _Directory))
+
+        self.bitmap_cluster = FIRST_CLUSTER
+        self.upcase_cluster = self.bitmap_cluster + self._clusters(self.layout.bitmap_size)
+        cluster = self.upcase_cluster + self._clusters(len(self.upcase_table))
+        for node in self.directories:
+            # The root also holds the label, bitmap and up-case table entries
+            slots = (3 if node is self.root else 0) + sum(entry_set_slots(name) for name, _ in node.records)
+            size = slots * ENTRY_SIZE
+            if size > MAX_DIRECTORY_SIZE:
+                raise Exception(f"Directory {node.path or '/'} has more entries than exFAT allows")
+            node.clusters = max(1, self._clusters(size))
+            node.cluster = cluster
+            cluster += node.clusters
+
+        # Image order keeps the source reads sequential too
+        named = {id(child) for node in self.directories for _, child in node.records}
+        files = [entry for entry in files if id(entry) in named]
+        files.sort(key=source_position)
+        for entry in files:
+            clusters = self._clusters(entry.size)
+            self.files.append((entry, cluster if clusters else 0, clusters))
+            cluster += clusters
+            self.total_bytes += entry.size
+
+        self.used_clusters = cluster - FIRST_CLUSTER
+        if self.used_clusters > self.layout.cluster_count:
+            raise Exception("ISO contents do not fit on the exFAT volume")
+
+    def _name_children(self, node):
+        seen = set()
+        for child in node.children:
+            name = exfat_name(child.path.rpartition('/')[2])
+            if len(name.encode('utf-16-le')) // 2 > MAX_NAME_LENGTH:
+                raise Exception(f"{child.path} has a name longer than exFAT allows")
+            # Names are compared through the volume's up-case table
+            key = upcase_name(name).tobytes()
+            if key in seen:
+                self.skipped.append(child.path)
+                continue
+            seen.add(key)
+            node.records.append((name, child))
+
+    def _fat(self):
+        """Bytes of the used part of the FAT, only the system structures are chained"""
+        last = self.root.cluster + self.root.clusters
+        fat = array('I', bytes(4 * last))
+        fat[0] = EXFAT_MEDIA
+        fat[1] = EXFAT_EOC
+        for first, end in ((self.bitmap_cluster, self.upcase_cluster),
+                           (self.upcase_cluster, self.root.cluster), (self.root.cluster, last)):
+            fat[first:end - 1] = array('I', range(first + 1, end))
+            fat[end - 1] = EXFAT_EOC
+        if sys.byteorder != 'little':
+            fat.byteswap()
+        return fat.tobytes()
+
+    def _bitmap(self):
+        """Allocation bitmap with the contiguous used clusters from the start of the heap set"""
+        bitmap = bytearray(self.layout.bitmap_size)
+        full, rest = divmod(self.used_clusters, 8)
+        bitmap[:full] = b'\xFF' * full
+        if rest:
+            bitmap[full] = (1 << rest) - 1
+        return bitmap
+
+    def _directory_bytes(self, node):
+        data = bytearray(node.clusters * self.layout.cluster_size)
+        entries = []
+        if node is self.root:
+            entries.append(volume_label_entry(self.label))
+            entries.append(bitmap_entry(self.bitmap_cluster, self.layout.bitmap_size))
+            entries.append(upcase_entry(self.upcase_checksum, self.upcase_cluster, len(self.upcase_table)))
+
+        clusters = {id(entry): first for entry, first, _ in self.files}
+        cluster_size = self.layout.cluster_size
+        for name, child in node.records:
+            mtime = child.mtime if child.mtime is not None else self.timestamp
+            if isinstance(child, _Directory):
+                entries.append(file_entry_set(name, ATTR_DIRECTORY, child.cluster, child.clusters * cluster_size,
+                                              mtime))
+            else:
+                entries.append(file_entry_set(name, ATTR_ARCHIVE, clusters[id(child)], child.size, mtime))
+
+        packed = b''.join(entries)
+        data[:len(packed)] = packed
+        return data
+
+    def write(self, iso_path, target_path, offset=0, volume_id=None, leaves=None):
+        """Write the volume to a device or image file, offset being the partition start
+
+        leaves, a LeafHasher, gets the files hashed as they are written.
+        """
+        layout = self.layout
+        if volume_id is None:
+            volume_id = struct.unpack('<I', os.urandom(4))[0]
+        percent_in_use = self.used_clusters * 100 // layout.cluster_count
+
+        fd = os.open(target_path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+        try:
+            # Main and backup boot regions are identical
+            write_at(fd, build_boot_region(layout, self.root.cluster, volume_id, percent_in_use) * 2, offset)
+            write_fat_region(fd, offset + layout.fat_offset * layout.sector_size,
+                             layout.fat_length * layout.sector_size, self._fat())
+
+            stream = SequentialWriter(fd, offset + layout.cluster_offset(FIRST_CLUSTER), self._report)
+            for data in (self._bitmap(), self.upcase_table):
+                stream.write(data)
+                stream.pad(self._clusters(len(data)) * layout.cluster_size - len(data))
+            for node in self.directories:
+                stream.write(self._directory_bytes(node))
+
+            if self.files:
+                with open(iso_path, 'rb') as iso_file, ExtentReader(iso_file) as reader:
+                    for entry, _, clusters in self.files:
+                        if not clusters:
+                            continue
+                        stream_file(stream, reader, entry, leaves)
+                        # Files start on their own cluster
+                        stream.pad(clusters * layout.cluster_size - entry.size)
+            stream.close()
+
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self._report(self.total_bytes, force=True)
+
+    def _report(self, written_bytes, force=False):
+        if not self.progress_callback:
+            return
+        now = time.monotonic()
+        if force or now - self._last_report >= PROGRESS_INTERVAL:
+            self._last_report = now
+            self.progress_callback(written_bytes, self.total_bytes)
+
+
+def _volume_geometry(target_path, offset, size, sector_size):
+    fd = os.open(target_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        if size is None:
+            size = get_device_size(fd) - offset
+        if sector_size is None:
+            sector_size = get_sector_sizes(fd)[0]
+    finally:
+        os.close(fd)
+    return size, sector_size
+
+
+def format_exfat(target_path, offset=0, size=None, cluster_size=None, label='', sector_size=None, volume_id=None):
+    """Write an empty exFAT file system to a partition or image file
+
+    offset and size select the volume on the device, by default the whole device or
+    file. The cluster size defaults by volume size. Returns the ExFATLayout.
+    """
+    size, sector_size = _volume_geometry(target_path, offset, size, sector_size)
+    layout = plan_exfat(size, cluster_size, sector_size, offset // sector_size)
+    ExFATBuilder([], layout, label).write(None, target_path, offset, volume_id)
+    return layout
+
+
+def build_exfat(iso_path, entries, target_path, offset=0, size=None, cluster_size=None, label='', sector_size=None,
+                progress_callback=None, leaves=None):
+    """Format a partition or image file as exFAT and fill it with the files of an image in one pass
+
+    Returns the ExFATBuilder, its skipped list names entries dropped for clashing names.
+    """
+    size, sector_size = _volume_geometry(target_path, offset, size, sector_size)
+    layout = plan_exfat(size, cluster_size, sector_size, offset // sector_size)
+    builder = ExFATBuilder(entries, layout, label, progress_callback)
+    builder.write(iso_path, target_path, offset, leaves=leaves)
+    return builder
@@ -0,0 +1,870 @@
+import os
+import sys
+import time
+import uuid
+import struct
+import threading
+from array import array
+from collections import deque
+
+from core.extent_reader import ExtentReader
+from core.fat32 import SequentialWriter, source_position, stream_file
+from core.manifest import check_files
+from core.partition import get_device_size, read_at
+from core.raw_writer import get_sector_sizes
+from core.scheduler import DEFAULT_WORKERS, PROGRESS_INTERVAL
+from core.verifier import VERIFY_CHUNK_SIZE, VERIFY_FULL, Mismatch
+
+EXT_FILE_SYSTEMS = ("ext2", "ext3", "ext4")
+
+EXT_MAGIC = 0xEF53
+SUPERBLOCK_OFFSET = 1024
+SUPERBLOCK_SIZE = 1024
+DESCRIPTOR_SIZE = 32
+
+EXT_BLOCK_SIZES = (1024, 2048, 4096)
+EXT_DEFAULT_BLOCK_SIZE = 4096
+INODE_SIZE = 256
+# Bytes of volume per inode, as mke2fs sizes inode tables
+INODE_RATIO = 16384
+EXTRA_ISIZE = 32
+
+# Share of the blocks kept back for root, as mke2fs does
+RESERVED_PERCENT = 5
+
+# Groups whose bitmaps and inode tables are packed together into the first group of the set
+FLEX_BG_SIZE = 16
+
+# A last group smaller than its metadata and this many data blocks is dropped
+MIN_LAST_GROUP_BLOCKS = 50
+
+# Inodes 1 to 10 are reserved, lost+found takes the first ordinary one
+ROOT_INODE = 2
+JOURNAL_INODE = 8
+FIRST_INODE = 11
+LOST_AND_FOUND_SIZE = 16 * 1024
+
+COMPAT_HAS_JOURNAL = 0x0004
+COMPAT_DIR_INDEX = 0x0020
+INCOMPAT_FILETYPE = 0x0002
+INCOMPAT_EXTENTS = 0x0040
+INCOMPAT_FLEX_BG = 0x0200
+RO_COMPAT_SPARSE_SUPER = 0x0001
+RO_COMPAT_LARGE_FILE = 0x0002
+RO_COMPAT_HUGE_FILE = 0x0008
+RO_COMPAT_GDT_CSUM = 0x0010
+RO_COMPAT_DIR_NLINK = 0x0020
+RO_COMPAT_EXTRA_ISIZE = 0x0040
+
+# (compat, incompat, ro_compat) of each variant. uninit_bg (GDT_CSUM) lets ext4 inode tables stay
+# unwritten, ext2 and ext3 drivers do not know it so their inode tables are zeroed
+FEATURES = {
+    'ext2': (COMPAT_DIR_INDEX, INCOMPAT_FILETYPE, RO_COMPAT_SPARSE_SUPER | RO_COMPAT_LARGE_FILE),
+    'ext3': (COMPAT_DIR_INDEX | COMPAT_HAS_JOURNAL, INCOMPAT_FILETYPE, RO_COMPAT_SPARSE_SUPER | RO_COMPAT_LARGE_FILE),
+    'ext4': (COMPAT_DIR_INDEX | COMPAT_HAS_JOURNAL, INCOMPAT_FILETYPE | INCOMPAT_EXTENTS | INCOMPAT_FLEX_BG,
+             RO_COMPAT_SPARSE_SUPER | RO_COMPAT_LARGE_FILE | RO_COMPAT_HUGE_FILE | RO_COMPAT_GDT_CSUM
+             | RO_COMPAT_DIR_NLINK | RO_COMPAT_EXTRA_ISIZE),
+}
+
+# Group descriptor flags: inode table and bitmap not initialized yet
+BG_INODE_UNINIT = 0x0001
+
+MODE_DIRECTORY = 0o040000
+MODE_FILE = 0o100000
+FILE_TYPE_REGULAR = 1
+FILE_TYPE_DIRECTORY = 2
+EXTENTS_FLAG = 0x80000
+
+# Directories with more links than this count as one with dir_nlink
+LINK_MAX = 65000
+MAX_NAME_LENGTH = 255
+
+EXTENT_MAGIC = 0xF30A
+EXTENT_MAX_LENGTH = 32768
+EXTENTS_IN_INODE = 4
+DIRECT_BLOCKS = 12
+
+# jbd2 superblock of an empty journal
+JOURNAL_MAGIC = 0xC03B3998
+JOURNAL_SUPERBLOCK_V2 = 4
+# Journal blocks by volume blocks, the sizes mke2fs picks
+JOURNAL_SIZES = (
+    (2048, 0),
+    (32768, 1024),
+    (256 * 1024, 4096),
+    (512 * 1024, 8192),
+    (4096 * 1024, 16384),
+    (8192 * 1024, 32768),
+    (16384 * 1024, 65536),
+    (32768 * 1024, 131072),
+    (None, 262144),
+)
+
+
+def _crc16_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+CRC16_TABLE = _crc16_table()
+
+
+def crc16(crc, data):
+    for byte in data:
+        crc = (crc >> 8) ^ CRC16_TABLE[(crc ^ byte) & 0xFF]
+    return crc
+
+
+def has_superblock(group):
+    """sparse_super keeps superblock copies in groups 0, 1 and the powers of 3, 5 and 7"""
+    if group <= 1:
+        return True
+    for base in (3, 5, 7):
+        power = base
+        while power < group:
+            power *= base
+        if power == group:
+            return True
+    return False
+
+
+def journal_blocks(blocks_count):
+    for limit, size in JOURNAL_SIZES:
+        if limit is None or blocks_count < limit:
+            return size
+
+
+class Ext4Layout:
+    """Geometry of an ext2/3/4 volume, block numbers counted from the start of the volume"""
+
+    def __init__(self, file_system, block_size, blocks_count, inodes_per_group):
+        self.file_system = file_system
+        self.block_size = block_size
+        self.blocks_count = blocks_count
+        self.inodes_per_group = inodes_per_group
+        self.first_data_block = 1 if block_size == 1024 else 0
+        self.blocks_per_group = 8 * block_size
+        self.group_count = -(-(blocks_count - self.first_data_block) // self.blocks_per_group)
+        self.flex_size = FLEX_BG_SIZE if file_system == 'ext4' else 1
+        self.gdt_blocks = -(-self.group_count * DESCRIPTOR_SIZE // block_size)
+        self.inode_table_blocks = inodes_per_group * INODE_SIZE // block_size
+
+    @property
+    def inodes_count(self):
+        return self.group_count * self.inodes_per_group
+
+    @property
+    def features(self):
+        return FEATURES[self.file_system]
+
+    def group_start(self, group):
+        return self.first_data_block + group * self.blocks_per_group
+
+    def group_blocks(self, group):
+        return min(self.blocks_per_group, self.blocks_count - self.group_start(group))
+
+    def _flex(self, group):
+        leader = group - group % self.flex_size
+        members = min(self.flex_size, self.group_count - leader)
+        first = self.group_start(leader) + (1 + self.gdt_blocks if has_superblock(leader) else 0)
+        return leader, members, first
+
+    def block_bitmap(self, group):
+        leader, _, first = self._flex(group)
+        return first + group - leader
+
+    def inode_bitmap(self, group):
+        leader, members, first = self._flex(group)
+        return first + members + group - leader
+
+    def inode_table(self, group):
+        leader, members, first = self._flex(group)
+        return first + 2 * members + (group - leader) * self.inode_table_blocks
+
+    def metadata_blocks(self, group):
+        """Blocks at the start of a group taken by superblock, descriptors, bitmaps and inode tables
+
+        Bitmaps and inode tables sit right behind the superblock copy of the group
+        that holds them, so the metadata of every group is one run at its start.
+        """
+        leader, members, _ = self._flex(group)
+        count = 1 + self.gdt_blocks if has_superblock(group) else 0
+        if group == leader:
+            count += members * (2 + self.inode_table_blocks)
+        return count
+
+    def free_runs(self):
+        """(first block, count) of the space between the group metadata, merged where groups adjoin"""
+        runs = []
+        for group in range(self.group_count):
+            start = self.group_start(group) + self.metadata_blocks(group)
+            end = self.group_start(group) + self.group_blocks(group)
+            if start >= end:
+                continue
+            if runs and runs[-1][0] + runs[-1][1] == start:
+                runs[-1] = (runs[-1][0], end - runs[-1][0])
+            else:
+                runs.append((start, end - start))
+        return runs
+
+    def __repr__(self):
+        return (f"Ext4Layout({self.file_system}, block_size={self.block_size}, blocks={self.blocks_count}, "
+                f"groups={self.group_count}, inodes_per_group={self.inodes_per_group})")
+
+
+def plan_ext4(volume_size, file_system='ext4', block_size=EXT_DEFAULT_BLOCK_SIZE):
+    """Lay out an ext2, ext3 or ext4 volume the way mke2fs sizes its groups and inode tables"""
+    if file_system not in FEATURES:
+        raise Exception(f"Unsupported file system: {file_system}")
+    if block_size not in EXT_BLOCK_SIZES:
+        raise Exception(f"Block size {block_size} is not supported for {file_system}")
+
+    blocks_count = volume_size // block_size
+    if blocks_count > 0xFFFFFFFF:
+        raise Exception(f"Volume is too large for {file_system} with {block_size} byte blocks")
+
+    per_block = block_size // INODE_SIZE
+    inodes_per_group = 8 * block_size * block_size // INODE_RATIO
+    inodes_per_group = min(-(-inodes_per_group // per_block) * per_block, 8 * block_size)
+    layout = Ext4Layout(file_system, block_size, blocks_count, inodes_per_group)
+
+    # A last group too small to hold its own metadata and some data is left unused
+    last = layout.group_count - 1
+    overhead = 1 + layout.gdt_blocks + 2 + layout.inode_table_blocks
+    if last > 0 and layout.group_blocks(last) < overhead + MIN_LAST_GROUP_BLOCKS:
+        layout = Ext4Layout(file_system, block_size, layout.group_start(last), inodes_per_group)
+
+    if layout.group_count < 1 or layout.group_blocks(0) < overhead + MIN_LAST_GROUP_BLOCKS:
+        raise Exception(f"Volume is too small for {file_system}")
+    for group in range(0, layout.group_count, layout.flex_size):
+        if layout.metadata_blocks(group) > layout.group_blocks(group):
+            raise Exception(f"Volume is too small for {file_system} with {block_size} byte blocks")
+    return layout
+
+
+def _set_bits(bitmap, start, count):
+    """Set count bits from bit start"""
+    end = start + count
+    while start < end and start % 8:
+        bitmap[start // 8] |= 1 << (start % 8)
+        start += 1
+    full = (end - start) // 8
+    bitmap[start // 8:start // 8 + full] = b'\xFF' * full
+    start += full * 8
+    while start < end:
+        bitmap[start // 8] |= 1 << (start % 8)
+        start += 1
+
+
+def _timestamp(value):
+    return max(0, min(int(value), 0x7FFFFFFF))
+
+
+def pack_inode(mode, size, links, sectors, flags, block_map, timestamp):
+    """Inode of INODE_SIZE bytes, sectors counting the 512 byte units of its data and mapping blocks"""
+    inode = bytearray(INODE_SIZE)
+    stamp = _timestamp(timestamp)
+    struct.pack_into('<HHIIIIIHHII', inode, 0, mode, 0, size & 0xFFFFFFFF, stamp, stamp, stamp, 0, 0, links,
+                     sectors & 0xFFFFFFFF, flags)
+    inode[40:40 + len(block_map)] = block_map
+    struct.pack_into('<I', inode, 108, size >> 32)
+    struct.pack_into('<H', inode, 116, sectors >> 32)
+    struct.pack_into('<H', inode, 128, EXTRA_ISIZE)
+    return bytes(inode)
+
+
+def pack_directory(records, block_size):
+    """Linear directory blocks of (inode, name bytes, file type) records, no record crosses a block"""
+    data = bytearray()
+    last = None
+    for inode, name, file_type in records:
+        length = 8 + len(name) + -(8 + len(name)) % 4
+        used = len(data) % block_size
+        if used and used + length > block_size:
+            # The previous record takes the rest of its block
+            struct.pack_into('<H', data, last + 4, block_size - (last % block_size))
+            data += bytes(block_size - used)
+        last = len(data)
+        data += struct.pack('<IHBB', inode, length, len(name), file_type) + name + bytes(length - 8 - len(name))
+    struct.pack_into('<H', data, last + 4, block_size - (last % block_size))
+    data += bytes(-len(data) % block_size)
+    return bytes(data)
+
+
+def empty_directory_block(block_size):
+    return struct.pack('<IHBB', 0, block_size, 0, 0) + bytes(block_size - 8)
+
+
+class _Allocator:
+    """Hands out blocks front to back from the free runs, skipping the group metadata"""
+
+    def __init__(self, layout):
+        self._runs = deque(layout.free_runs())
+        # First block not handed out yet
+        self.next_block = self._runs[0][0] if self._runs else layout.blocks_count
+
+    def allocate(self, count):
+        """(first block, count) runs of count blocks"""
+        runs = []
+        while count:
+            if not self._runs:
+                raise Exception("Contents do not fit on the volume")
+            start, length = self._runs[0]
+            size = min(count, length)
+            runs.append((start, size))
+            count -= size
+            if size == length:
+                self._runs.popleft()
+            else:
+                self._runs[0] = (start + size, length - size)
+            self.next_block = start + size
+        return runs
+
+
+class _Node:
+    __slots__ = ('path', 'mtime', 'children', 'inode', 'data', 'runs', 'links', 'parent')
+
+    def __init__(self, path, mtime=None, parent=None):
+        self.path = path
+        self.mtime = mtime
+        self.parent = parent
+        # Child directories and file entries, in catalog order
+        self.children = []
+        self.inode = 0
+        self.data = b''
+        self.runs = []
+        self.links = 2
+
+
+class Ext4Builder:
+    """Lay out an ext2/3/4 volume, optionally filled from an image catalog, and write only what it needs
+
+    Inodes and blocks are handed out front to back: directories, the journal, then the
+    files in the order their data lies in the image, each as few contiguous runs as
+    the group metadata allows. Only the superblock copies, descriptors, bitmaps, the
+    inode table blocks in use and the used data are written. On ext4 unused inode
+    tables stay as they are behind uninit_bg and the kernel zeroes them lazily after
+    mounting, ext2 and ext3 get them zeroed like mke2fs does.
+    """
+
+    def __init__(self, entries, layout, label='', progress_callback=None):
+        self.layout = layout
+        self.label = (label or '').encode('utf-8')[:16]
+        # Called with (written_bytes, total_bytes)
+        self.progress_callback = progress_callback
+        self.timestamp = time.time()
+        self.uuid = uuid.uuid4().bytes
+        self.hash_seed = uuid.uuid4().bytes
+
+        self.root = _Node('', self.timestamp)
+        self.directories = []
+        # (entry, inode number, data runs) in block order
+        self.files = []
+        # Packed inodes by number
+        self.inodes = {}
+        # (block, data) of everything besides file contents
+        self.blocks = []
+        self.total_bytes = 0
+        self.used_inodes = FIRST_INODE - 1
+        self.used_directories = {}
+        self.skipped = []
+        self.journal_blocks = 0
+        # Block map of the journal inode, backed up in the superblock
+        self.journal_map = None
+        self._allocator = _Allocator(layout)
+        self._last_report = 0
+
+        self._plan(entries)
+
+    @property
+    def lazy_inode_tables(self):
+        return bool(self.layout.features[2] & RO_COMPAT_GDT_CSUM)
+
+    @property
+    def extents(self):
+        return bool(self.layout.features[1] & INCOMPAT_EXTENTS)
+
+    def _new_inode(self, is_directory=False):
+        self.used_inodes += 1
+        if self.used_inodes > self.layout.inodes_count:
+            raise Exception("Contents need more inodes than the volume has")
+        if is_directory:
+            group = (self.used_inodes - 1) // self.layout.inodes_per_group
+            self.used_directories[group] = self.used_directories.get(group, 0) + 1
+        return self.used_inodes
+
+    def _plan(self, entries):
+        block_size = self.layout.block_size
+        directories = {'': self.root}
+
+        def directory(path, mtime=None):
+            node = directories.get(path)
+            if node is None:
+                parent = directory(path.rpartition('/')[0])
+                node = _Node(path, mtime, parent)
+                directories[path] = node
+                parent.children.append(node)
+            elif mtime is not None:
+                node.mtime = mtime
+            return node
+
+        for entry in entries:
+            if entry.path.partition('/')[0] == 'lost+found':
+                # The volume brings its own
+                self.skipped.append(entry.path)
+            elif entry.is_dir:
+                directory(entry.path, entry.mtime)
+            else:
+                directory(entry.path.rpartition('/')[0]).children.append(entry)
+
+        # Inode numbers breadth first, lost+found ahead of the image's files
+        self.root.inode = ROOT_INODE
+        self.used_directories[0] = 1
+        lost_found = _Node('lost+found', self.timestamp, self.root)
+        lost_found.inode = self._new_inode(True)
+        self.root.children.insert(0, lost_found)
+
+        files = []
+        inodes = {}
+        pending = deque([self.root])
+        while pending:
+            node = pending.popleft()
+            self.directories.append(node)
+            for child in node.children:
+                if child is lost_found:
+                    pending.append(child)
+                    continue
+                if len(child.path.rpartition('/')[2].encode('utf-8')) > MAX_NAME_LENGTH:
+                    raise Exception(f"{child.path} has a name longer than {self.layout.file_system} allows")
+                if isinstance(child, _Node):
+                    child.inode = self._new_inode(True)
+                    pending.append(child)
+                else:
+                    inodes[id(child)] = self._new_inode()
+                    files.append(child)
+
+        for node in self.directories:
+            records = [(node.inode, b'.', FILE_TYPE_DIRECTORY),
+                       (node.parent.inode if node.parent else node.inode, b'..', FILE_TYPE_DIRECTORY)]
+            for child in node.children:
+                name = child.path.rpartition('/')[2].encode('utf-8')
+                if isinstance(child, _Node):
+                    records.append((child.inode, name, FILE_TYPE_DIRECTORY))
+                    node.links += 1
+                else:
+                    records.append((inodes[id(child)], name, FILE_TYPE_REGULAR))
+            node.data = pack_directory(records, block_size)
+            if node is lost_found:
+                # Room for e2fsck to reconnect files without growing the directory
+                extra = max(0, LOST_AND_FOUND_SIZE - len(node.data)) // block_size
+                node.data += empty_directory_block(block_size) * extra
+            if node.links > LINK_MAX:
+                if not self.layout.features[2] & RO_COMPAT_DIR_NLINK:
+                    raise Exception(f"{node.path} has more subdirectories than {self.layout.file_system} allows")
+                node.links = 1
+
+        for node in self.directories:
+            node.runs = self._allocator.allocate(len(node.data) // block_size)
+            self._add_runs(node.runs, node.data)
+            self._add_inode(node.inode, MODE_DIRECTORY | (0o700 if node is lost_found else 0o755), len(node.data),
+                            node.links, node.runs, node.mtime)
+
+        if self.layout.features[0] & COMPAT_HAS_JOURNAL:
+            self.journal_blocks = journal_blocks(self.layout.blocks_count)
+            if not self.journal_blocks:
+                raise Exception(f"Volume is too small for a {self.layout.file_system} journal")
+            runs = self._allocator.allocate(self.journal_blocks)
+            self.blocks.append((runs[0][0], self._journal_superblock()))
+            self._add_inode(JOURNAL_INODE, MODE_FILE | 0o600, self.journal_blocks * block_size, 1, runs,
+                            self.timestamp)
+            self.journal_map = self.inodes[JOURNAL_INODE][40:100]
+
+        # Image order keeps the source reads sequential too
+        files.sort(key=source_position)
+        for entry in files:
+            count = -(-entry.size // block_size)
+            runs = self._allocator.allocate(count) if count else []
+            self.files.append((entry, inodes[id(entry)], runs))
+            self._add_inode(inodes[id(entry)], MODE_FILE | 0o644, entry.size, 1, runs, entry.mtime)
+            self.total_bytes += entry.size
+
+    def _add_runs(self, runs, data):
+        position = 0
+        for start, count in runs:
+            size = count * self.layout.block_size
+            self.blocks.append((start, data[position:position + size]))
+            position += size
+
+    def _add_inode(self, number, mode, size, links, runs, mtime):
+        """Map the runs of an inode through extents or block pointers and record the inode"""
+        if self.extents:
+            block_map, mapping = self._extent_map(runs)
+            flags = EXTENTS_FLAG
+        else:
+            block_map, mapping = self._indirect_map(runs)
+            flags = 0
+        blocks = sum(count for _, count in runs) + mapping
+        mtime = mtime if mtime is not None else self.timestamp
+        self.inodes[number] = pack_inode(mode, size, links, blocks * (self.layout.block_size // 512), flags,
+                                         block_map, mtime)
+
+    def _extent_map(self, runs):
+        """(i_block, mapping blocks) of runs as extents, in the inode or behind one level of leaves"""
+        extents = []
+        logical = 0
+        for start, count in runs:
+            while count:
+                length = min(count, EXTENT_MAX_LENGTH)
+                extents.append(struct.pack('<IHHI', logical, length, 0, start))
+                logical += length
+                start += length
+                count -= length
+
+        if len(extents) <= EXTENTS_IN_INODE:
+            header = struct.pack('<HHHHI', EXTENT_MAGIC, len(extents), EXTENTS_IN_INODE, 0, 0)
+            return header + b''.join(extents), 0
+
+        per_leaf = (self.layout.block_size - 12) // 12
+        leaves = [extents[index:index + per_leaf] for index in range(0, len(extents), per_leaf)]
+        if len(leaves) > EXTENTS_IN_INODE:
+            raise Exception("File is too large or fragmented for a two level extent tree")
+        indexes = []
+        for leaf in leaves:
+            block = self._allocator.allocate(1)[0][0]
+            data = struct.pack('<HHHHI', EXTENT_MAGIC, len(leaf), per_leaf, 0, 0) + b''.join(leaf)
+            self.blocks.append((block, data + bytes(self.layout.block_size - len(data))))
+            indexes.append(struct.pack('<IIHH', struct.unpack_from('<I', leaf[0])[0], block, 0, 0))
+        header = struct.pack('<HHHHI', EXTENT_MAGIC, len(indexes), EXTENTS_IN_INODE, 1, 0)
+        return header + b''.join(indexes), len(leaves)
+
+    def _indirect_map(self, runs):
+        """(i_block, mapping blocks) of runs as direct, indirect, double and triple indirect pointers"""
+        pointers = self.layout.block_size // 4
+        blocks = array('I')
+        for start, count in runs:
+            blocks.extend(range(start, start + count))
+        mapping = 0
+
+        def indirect(level, items):
+            nonlocal mapping
+            block = self._allocator.allocate(1)[0][0]
+            mapping += 1
+            if level > 1:
+                span = pointers ** (level - 1)
+                items = array('I', (indirect(level - 1, items[index:index + span])
+                                    for index in range(0, len(items), span)))
+            if sys.byteorder != 'little':
+                items.byteswap()
+            data = items.tobytes()
+            self.blocks.append((block, data + bytes(self.layout.block_size - len(data))))
+            return block
+
+        block_map = array('I', blocks[:DIRECT_BLOCKS])
+        block_map.extend([0] * (DIRECT_BLOCKS - len(block_map)))
+        position = DIRECT_BLOCKS
+        for level in (1, 2, 3):
+            span = pointers ** level
+            if position < len(blocks):
+                block_map.append(indirect(level, blocks[position:position + span]))
+                position += span
+            else:
+                block_map.append(0)
+        if position < len(blocks):
+            raise Exception("File is too large for block pointers")
+        if sys.byteorder != 'little':
+            block_map.byteswap()
+        return block_map.tobytes(), mapping
+
+    def _journal_superblock(self):
+        block = bytearray(self.layout.block_size)
+        # An empty journal (start 0) is never replayed, a random sequence keeps old journal blocks
+        # on the disk from ever matching, so the journal needs no zeroing
+        sequence = struct.unpack('<I', os.urandom(4))[0] | 1
+        struct.pack_into('>IIIIIIII', block, 0, JOURNAL_MAGIC, JOURNAL_SUPERBLOCK_V2, 0,
+                         self.layout.block_size, self.journal_blocks, 1, sequence, 0)
+        block[0x30:0x40] = self.uuid
+        struct.pack_into('>I', block, 0x40, 1)
+        return bytes(block)
+
+    def _group_usage(self, group):
+        """(used blocks from the group start, used inodes) of a group"""
+        layout = self.layout
+        start = layout.group_start(group)
+        metadata = layout.metadata_blocks(group)
+        data = min(max(self._allocator.next_block - start - metadata, 0), layout.group_blocks(group) - metadata)
+        inodes = min(max(self.used_inodes - group * layout.inodes_per_group, 0), layout.inodes_per_group)
+        return metadata + data, inodes
+
+    def _descriptors(self):
+        layout = self.layout
+        table = bytearray(layout.gdt_blocks * layout.block_size)
+        free_blocks = free_inodes = 0
+        for group in range(layout.group_count):
+            used_blocks, used_inodes = self._group_usage(group)
+            group_free_blocks = layout.group_blocks(group) - used_blocks
+            group_free_inodes = layout.inodes_per_group - used_inodes
+            free_blocks += group_free_blocks
+            free_inodes += group_free_inodes
+            offset = group * DESCRIPTOR_SIZE
+            struct.pack_into('<IIIHHH', table, offset, layout.block_bitmap(group), layout.inode_bitmap(group),
+                             layout.inode_table(group), group_free_blocks, group_free_inodes,
+                             self.used_directories.get(group, 0))
+            if self.lazy_inode_tables:
+                # Flags, the inodes past the last one in use and the descriptor checksum
+                struct.pack_into('<H', table, offset + 18, BG_INODE_UNINIT if not used_inodes else 0)
+                struct.pack_into('<H', table, offset + 28, group_free_inodes)
+                checksum = crc16(crc16(crc16(0xFFFF, self.uuid), struct.pack('<I', group)),
+                                 table[offset:offset + DESCRIPTOR_SIZE - 2])
+                struct.pack_into('<H', table, offset + DESCRIPTOR_SIZE - 2, checksum)
+        return bytes(table), free_blocks, free_inodes
+
+    def _superblock(self, group, free_blocks, free_inodes):
+        layout = self.layout
+        compat, incompat, ro_compat = layout.features
+        now = int(self.timestamp)
+        block = bytearray(SUPERBLOCK_SIZE)
+        struct.pack_into(
+            '<IIIIIIIIIIIIIHhHHHHIIIIHHIHHIII16s16s', block, 0,
+            layout.inodes_count, layout.blocks_count, layout.blocks_count * RESERVED_PERCENT // 100,
+            free_blocks, free_inodes, layout.first_data_block,
+            layout.block_size.bit_length() - 11, layout.block_size.bit_length() - 11,
+            layout.blocks_per_group, layout.blocks_per_group, layout.inodes_per_group,
+            0, now, 0, -1, EXT_MAGIC, 1, 1, 0,
+            now, 0, 0, 1, 0, 0,
+            FIRST_INODE, INODE_SIZE, group, compat, incompat, ro_compat,
+            self.uuid, self.label
+        )
+        if self.journal_blocks:
+            struct.pack_into('<I', block, 224, JOURNAL_INODE)
+            # Backup of the journal inode's block map and size
+            block[268:328] = self.journal_map
+            struct.pack_into('<II', block, 328, 0, self.journal_blocks * layout.block_size)
+            block[253] = 1
+        block[236:252] = self.hash_seed
+        # Half MD4 directory hashes, signed as on x86
+        block[252] = 1
+        struct.pack_into('<I', block, 256, 0x000C)
+        struct.pack_into('<I', block, 264, now)
+        struct.pack_into('<HH', block, 348, EXTRA_ISIZE, EXTRA_ISIZE)
+        struct.pack_into('<I', block, 352, 0x0001)
+        if layout.flex_size > 1:
+            block[372] = layout.flex_size.bit_length() - 1
+        return bytes(block)
+
+    def _bitmaps(self, group):
+        layout = self.layout
+        used_blocks, used_inodes = self._group_usage(group)
+        block_bitmap = bytearray(layout.block_size)
+        _set_bits(block_bitmap, 0, used_blocks)
+        # Bits past the end of a short last group are set
+        _set_bits(block_bitmap, layout.group_blocks(group), layout.blocks_per_group - layout.group_blocks(group))
+        inode_bitmap = bytearray(layout.block_size)
+        _set_bits(inode_bitmap, 0, used_inodes)
+        _set_bits(inode_bitmap, layout.inodes_per_group, 8 * layout.block_size - layout.inodes_per_group)
+        return bytes(block_bitmap), bytes(inode_bitmap)
+
+    def _metadata(self):
+        """(block, data) of superblocks, descriptors, bitmaps and the inode table blocks in use
+
+        data is a length instead for runs of zeros.
+        """
+        layout = self.layout
+        block_size = layout.block_size
+        descriptors, free_blocks, free_inodes = self._descriptors()
+        metadata = list(self.blocks)
+
+        for group in range(layout.group_count):
+            if has_superblock(group):
+                superblock = self._superblock(group, free_blocks, free_inodes)
+                start = layout.group_start(group)
+                if group == 0:
+                    # The primary copy sits 1024 bytes in, the boot area in front of it is cleared
+                    head = bytes(SUPERBLOCK_OFFSET) + superblock
+                    start = 0
+                else:
+                    head = superblock
+                metadata.append((start, head + bytes(-len(head) % block_size) + descriptors))
+
+            block_bitmap, inode_bitmap = self._bitmaps(group)
+            metadata.append((layout.block_bitmap(group), block_bitmap))
+            metadata.append((layout.inode_bitmap(group), inode_bitmap))
+
+            _, used_inodes = self._group_usage(group)
+            table = bytearray(-(-used_inodes * INODE_SIZE // block_size) * block_size)
+            if used_inodes:
+                first = group * layout.inodes_per_group + 1
+                for index in range(used_inodes):
+                    inode = self.inodes.get(first + index)
+                    if inode is not None:
+                        table[index * INODE_SIZE:(index + 1) * INODE_SIZE] = inode
+                metadata.append((layout.inode_table(group), bytes(table)))
+            if not self.lazy_inode_tables:
+                rest = layout.inode_table_blocks * block_size - len(table)
+                metadata.append((layout.inode_table(group) + len(table) // block_size, rest))
+
+        metadata.sort(key=lambda item: item[0])
+        return metadata
+
+    def write(self, iso_path, target_path, offset=0, leaves=None):
+        """Write the volume to a device or image file, offset being the partition start
+
+        leaves, a LeafHasher, gets the files hashed as they are written.
+        """
+        block_size = self.layout.block_size
+        fd = os.open(target_path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+        try:
+            stream = SequentialWriter(fd, offset, self._report)
+            for block, data in self._metadata():
+                stream.seek(offset + block * block_size)
+                if isinstance(data, int):
+                    stream.pad(data)
+                else:
+                    stream.write(data)
+
+            if self.files:
+                with open(iso_path, 'rb') as iso_file, ExtentReader(iso_file) as reader:
+                    for entry, _, runs in self.files:
+                        if not runs:
+                            continue
+                        target = _RunStream(stream, runs, block_size, offset)
+                        stream_file(target, reader, entry, leaves)
+                        # Files end on a block boundary
+                        target.pad(-entry.size % block_size)
+            stream.close()
+
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self._report(self.total_bytes, force=True)
+
+    def check(self, target_path, manifest, offset=0, mode=VERIFY_FULL, coverage=1.0, workers=DEFAULT_WORKERS,
+              progress_callback=None):
+        """Read the written volume back, returns a VerifyResult
+
+        Metadata is compared with what was laid out (zeroed inode tables in full mode
+        only), file data with the leaves of manifest, hashed while it was written.
+        """
+        block_size = self.layout.block_size
+        fd = os.open(target_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            sector_size = get_sector_sizes(fd)[0]
+            lock = threading.Lock()
+
+            def read(position, length):
+                # Raw disks only take whole sector reads
+                start = position - position % sector_size
+                end = -(-(position + length) // sector_size) * sector_size
+                with lock:
+                    data = read_at(fd, end - start, start)
+                return data[position - start:position - start + length]
+
+            metadata = []
+            for block, data in self._metadata():
+                if isinstance(data, int):
+                    if mode != VERIFY_FULL:
+                        continue
+                    for position in range(0, data, VERIFY_CHUNK_SIZE):
+                        length = min(VERIFY_CHUNK_SIZE, data - position)
+                        if read(offset + block * block_size + position, length) != bytes(length):
+                            metadata.append(Mismatch(None, block * block_size + position, length))
+                elif read(offset + block * block_size, len(data)) != data:
+                    metadata.append(Mismatch(None, block * block_size, len(data)))
+
+            runs = {entry.path: runs for entry, _, runs in self.files}
+
+            def read_file(path, position, length):
+                data = bytearray()
+                for start, count in runs[path]:
+                    size = count * block_size
+                    if position >= size:
+                        position -= size
+                        continue
+                    take = min(size - position, length - len(data))
+                    data += read(offset + start * block_size + position, take)
+                    position = 0
+                    if len(data) == length:
+                        break
+                return bytes(data)
+
+            result = check_files(manifest, read_file, mode, coverage, workers, progress_callback)
+        finally:
+            os.close(fd)
+        result.mismatches[:0] = metadata
+        return result
+
+    def _report(self, written_bytes, force=False):
+        if not self.progress_callback:
+            return
+        now = time.monotonic()
+        if force or now - self._last_report >= PROGRESS_INTERVAL:
+            self._last_report = now
+            self.progress_callback(written_bytes, self.total_bytes)
+
+
+class _RunStream:
+    """File data written through a SequentialWriter, moving to the next run of blocks where one ends"""
+
+    def __init__(self, stream, runs, block_size, offset):
+        self.stream = stream
+        self._runs = deque((offset + start * block_size, count * block_size) for start, count in runs)
+        self._left = 0
+
+    def _advance(self):
+        while not self._left:
+            position, self._left = self._runs.popleft()
+            self.stream.seek(position)
+
+    def write(self, data, counted=0):
+        view = memoryview(data)
+        try:
+            position = 0
+            while position < len(view):
+                self._advance()
+                size = min(self._left, len(view) - position)
+                self.stream.write(view[position:position + size], size if counted else 0)
+                self._left -= size
+                position += size
+        finally:
+            view.release()
+
+    def pad(self, length, counted=False):
+        while length > 0:
+            self._advance()
+            size = min(self._left, length)
+            self.stream.pad(size, counted)
+            self._left -= size
+            length -= size
+
+
+def format_ext4(target_path, offset=0, size=None, file_system='ext4', block_size=EXT_DEFAULT_BLOCK_SIZE, label=''):
+    """Write an empty ext2, ext3 or ext4 file system to a partition or image file
+
+    offset and size select the volume on the device, by default the whole device or
+    file. Only metadata in use is written, so even large volumes format in seconds.
+    Returns the Ext4Layout.
+    """
+    return build_ext4(None, [], target_path, offset, size, file_system, block_size, label).layout
+
+
+def build_ext4(iso_path, entries, target_path, offset=0, size=None, file_system='ext4',
+               block_size=EXT_DEFAULT_BLOCK_SIZE, label='', progress_callback=None, leaves=None):
+    """Format a partition or image file as ext2/3/4 and fill it with the files of an image in one pass
+
+    Returns the Ext4Builder, its skipped list names image entries under lost+found.
+    """
+    if size is None:
+        fd = os.open(target_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            size = get_device_size(fd) - offset
+        finally:
+            os.close(fd)
+
+    layout = plan_ext4(size, file_system, block_size)
+    builder = Ext4Builder(entries, layout, label, progress_callback)
+    builder.write(iso_path, target_path, offset, leaves)
+    return builder
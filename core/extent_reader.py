@@ -0,0 +1,150 @@
+import os
+import sys
+import mmap
+import threading
+
+# Largest single request handed to the kernel or written from the mapping
+COPY_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Reusable buffer of the readinto fallback
+BUFFER_SIZE = 4 * 1024 * 1024
+
+
+class ExtentReader:
+    """Memory mapped view of an image that copies extents with as few user space copies as possible"""
+
+    def __init__(self, source_file):
+        self.source_file = source_file
+        self.fd = source_file.fileno()
+        self.size = os.fstat(self.fd).st_size
+
+        self._mapping = None
+        self._view = None
+        self._buffer = None
+        # Seek + read on the shared file object must not interleave between threads
+        self._lock = threading.Lock()
+
+        # In-kernel copies, dropped for the rest of the run on the first refusal
+        self._use_copy_file_range = hasattr(os, 'copy_file_range')
+        # sendfile() only accepts regular file targets on Linux
+        self._use_sendfile = hasattr(os, 'sendfile') and sys.platform.startswith('linux')
+
+        try:
+            if self.size > 0:
+                self._mapping = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+                self._view = memoryview(self._mapping)
+        except (OSError, ValueError, OverflowError):
+            # 32-bit processes cannot map multi-GB images
+            self._mapping = None
+            self._view = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._view is not None:
+            try:
+                self._view.release()
+                self._mapping.close()
+            except BufferError:
+                # A caller still holds a slice, the mapping goes away with it
+                pass
+            self._view = None
+            self._mapping = None
+
+    def _check_range(self, offset, length):
+        if offset < 0 or offset + length > self.size:
+            raise Exception(f"Extent {offset}+{length} is beyond the end of the image ({self.size} bytes)")
+
+    def extent(self, offset, length):
+        """Get a memoryview of an extent, backed by the mapping when possible"""
+        self._check_range(offset, length)
+        if self._view is not None:
+            return self._view[offset:offset + length]
+
+        with self._lock:
+            self.source_file.seek(offset)
+            data = self.source_file.read(length)
+        if len(data) < length:
+            raise Exception(f"Unexpected end of image at offset {offset + len(data)}")
+        return memoryview(data)
+
+    def copy_extent(self, offset, length, output_file, on_progress=None):
+        """Copy an extent to the current position of an open output file"""
+        self._check_range(offset, length)
+
+        # Everything below works on the raw descriptor
+        output_file.flush()
+        out_fd = output_file.fileno()
+
+        copied = 0
+        while copied < length and self._use_copy_file_range:
+            try:
+                count = os.copy_file_range(self.fd, out_fd, min(COPY_CHUNK_SIZE, length - copied), offset + copied)
+            except OSError:
+                # Cross file system copies on older kernels, FAT targets, ...
+                self._use_copy_file_range = False
+                break
+            if count == 0:
+                break
+            copied += count
+            if on_progress:
+                on_progress(count)
+
+        while copied < length and self._use_sendfile:
+            try:
+                count = os.sendfile(out_fd, self.fd, offset + copied, min(COPY_CHUNK_SIZE, length - copied))
+            except OSError:
+                self._use_sendfile = False
+                break
+            if count == 0:
+                break
+            copied += count
+            if on_progress:
+                on_progress(count)
+
+        while copied < length:
+            chunk_size = min(COPY_CHUNK_SIZE, length - copied)
+            if self._view is not None:
+                chunk = self._view[offset + copied:offset + copied + chunk_size]
+                try:
+                    written = self._write_all(out_fd, chunk)
+                finally:
+                    chunk.release()
+            else:
+                with self._lock:
+                    chunk = self._read_into_buffer(offset + copied, chunk_size)
+                    written = self._write_all(out_fd, chunk)
+
+            copied += written
+            if on_progress:
+                on_progress(written)
+
+        # Bring the file object back in line with the descriptor position
+        output_file.seek(0, os.SEEK_CUR)
+        return copied
+
+    def _write_all(self, fd, data):
+        written = 0
+        while written < len(data):
+            written += os.write(fd, data[written:])
+        return written
+
+    def _read_into_buffer(self, offset, length):
+        """Read into the reusable buffer, returns a view of the bytes read"""
+        if self._buffer is None:
+            self._buffer = bytearray(BUFFER_SIZE)
+
+        length = min(length, len(self._buffer))
+        view = memoryview(self._buffer)[:length]
+        self.source_file.seek(offset)
+        filled = 0
+        while filled < length:
+            count = self.source_file.readinto(view[filled:])
+            if not count:
+                raise Exception(f"Unexpected end of image at offset {offset + filled}")
+            filled += count
+        return view
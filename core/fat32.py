@@ -0,0 +1,685 @@
+import os
+import sys
+import time
+import struct
+from array import array
+from collections import deque
+from itertools import count
+
+from core.extent_reader import ExtentReader
+from core.partition import get_device_size, read_at, write_at
+from core.raw_writer import get_sector_sizes
+from core.scheduler import PROGRESS_INTERVAL
+from core.verifier import file_pieces
+
+FAT32_RESERVED_SECTORS = 32
+FAT_COUNT = 2
+MEDIA_FIXED_DISK = 0xF8
+
+# A volume with fewer clusters is FAT16 by definition, more do not fit 28 bit entries
+FAT32_MIN_CLUSTERS = 65525
+FAT32_MAX_CLUSTERS = 0x0FFFFFF5
+
+FAT32_EOC = 0x0FFFFFFF
+FAT32_ENTRY_MASK = 0x0FFFFFFF
+ROOT_CLUSTER = 2
+
+DEFAULT_CLUSTER_SIZE = 4096
+MAX_CLUSTER_SIZE = 64 * 1024
+
+# Zeroed FAT sectors are written in pieces of this size
+FORMAT_WRITE_SIZE = 16 * 1024 * 1024
+
+# Sectors of the boot record and their backup copy
+FSINFO_SECTOR = 1
+BACKUP_BOOT_SECTOR = 6
+
+FSINFO_LEAD_SIGNATURE = 0x41615252
+FSINFO_STRUCT_SIGNATURE = 0x61417272
+FSINFO_TRAIL_SIGNATURE = 0xAA550000
+FSINFO_UNKNOWN = 0xFFFFFFFF
+
+ATTR_VOLUME_ID = 0x08
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+ATTR_LONG_NAME = 0x0F
+DIR_ENTRY_SIZE = 32
+
+# Characters of a long name held by one LFN entry, and the longest name
+LFN_CHARS = 13
+LFN_MAX_LENGTH = 255
+LFN_LAST = 0x40
+
+# Reserved byte flags of a short entry whose base or extension is shown in lower case
+CASE_LOWER_BASE = 0x08
+CASE_LOWER_EXTENSION = 0x10
+
+# Largest file FAT32 can hold
+FAT32_MAX_FILE_SIZE = 0xFFFFFFFF
+
+# Characters FAT does not allow in short names and labels
+INVALID_SHORT_CHARS = set('"*+,./:;<=>?[\\]|')
+# Punctuation allowed in short names besides letters and digits
+SHORT_NAME_PUNCTUATION = set("!#$%&'()-@^_`{}~")
+
+# int 18h (try the next boot device), then halt, for anyone booting the volume itself. Drives that
+# boot from BIOS are formatted by diskpart instead, its boot sector loads BOOTMGR
+BOOT_CODE = b'\xCD\x18\xF4\xEB\xFD'
+
+
+class FAT32Layout:
+    """Geometry of a FAT32 volume, offsets in bytes from the start of the volume"""
+
+    def __init__(self, sector_size, sectors_per_cluster, reserved_sectors, fat_sectors, total_sectors,
+                 hidden_sectors=0):
+        self.sector_size = sector_size
+        self.sectors_per_cluster = sectors_per_cluster
+        self.reserved_sectors = reserved_sectors
+        self.fat_sectors = fat_sectors
+        self.total_sectors = total_sectors
+        # Sectors in front of the volume on the disk, the partition start
+        self.hidden_sectors = hidden_sectors
+
+    @property
+    def cluster_size(self):
+        return self.sector_size * self.sectors_per_cluster
+
+    @property
+    def data_sector(self):
+        return self.reserved_sectors + FAT_COUNT * self.fat_sectors
+
+    @property
+    def cluster_count(self):
+        return (self.total_sectors - self.data_sector) // self.sectors_per_cluster
+
+    def fat_offset(self, index=0):
+        return (self.reserved_sectors + index * self.fat_sectors) * self.sector_size
+
+    def cluster_offset(self, cluster):
+        """Byte offset of a data cluster, the first one is number 2"""
+        return (self.data_sector + (cluster - 2) * self.sectors_per_cluster) * self.sector_size
+
+    def __repr__(self):
+        return (f"FAT32Layout(cluster_size={self.cluster_size}, clusters={self.cluster_count}, "
+                f"fat_sectors={self.fat_sectors}, reserved_sectors={self.reserved_sectors})")
+
+
+def plan_fat32(volume_size, cluster_size=DEFAULT_CLUSTER_SIZE, sector_size=512, hidden_sectors=0):
+    """Lay out a FAT32 volume with clusters aligned to their own size"""
+    if cluster_size % sector_size or cluster_size > MAX_CLUSTER_SIZE or cluster_size & (cluster_size - 1):
+        raise Exception(f"Cluster size {cluster_size} does not suit {sector_size} byte sectors")
+
+    total_sectors = min(volume_size // sector_size, 0xFFFFFFFF)
+    sectors_per_cluster = cluster_size // sector_size
+    reserved_sectors = FAT32_RESERVED_SECTORS
+    fat_sectors = 1
+
+    # A bigger FAT leaves fewer clusters to describe, stop once it holds all of them
+    while True:
+        data_sector = reserved_sectors + FAT_COUNT * fat_sectors
+        clusters = (total_sectors - data_sector) // sectors_per_cluster
+        needed = -(-(clusters + 2) * 4 // sector_size)
+        if needed <= fat_sectors:
+            break
+        fat_sectors = needed
+
+    # Pad the reserved area so the data region starts on a cluster boundary
+    reserved_sectors += -(reserved_sectors + FAT_COUNT * fat_sectors) % sectors_per_cluster
+    layout = FAT32Layout(sector_size, sectors_per_cluster, reserved_sectors, fat_sectors, total_sectors,
+                         hidden_sectors)
+
+    if layout.cluster_count < FAT32_MIN_CLUSTERS:
+        raise Exception(f"Volume is too small for FAT32 with {cluster_size} byte clusters")
+    if layout.cluster_count > FAT32_MAX_CLUSTERS:
+        raise Exception(f"Volume is too large for FAT32 with {cluster_size} byte clusters")
+    return layout
+
+
+def fat_label(name):
+    """Volume label as the 11 upper case bytes FAT stores"""
+    label = ''.join('_' if char in INVALID_SHORT_CHARS else char for char in (name or '').upper())
+    label = label.encode('ascii', 'replace').replace(b'?', b'_')[:11]
+    return label.ljust(11, b' ') if label.strip() else b'NO NAME    '
+
+
+def dos_datetime(timestamp):
+    """(date, time) words of a POSIX timestamp in local time, FAT cannot express years before 1980"""
+    moment = time.localtime(timestamp)
+    if moment.tm_year < 1980:
+        return (1 << 5) | 1, 0
+    date = ((min(moment.tm_year, 2107) - 1980) << 9) | (moment.tm_mon << 5) | moment.tm_mday
+    clock = (moment.tm_hour << 11) | (moment.tm_min << 5) | (moment.tm_sec // 2)
+    return date, clock
+
+
+def build_boot_sector(layout, label=b'NO NAME    ', volume_id=0):
+    sector = bytearray(layout.sector_size)
+    struct.pack_into(
+        '<3s8sHBHBHHBHHHII', sector, 0,
+        b'\xEB\x58\x90', b'MSWIN4.1',
+        layout.sector_size, layout.sectors_per_cluster, layout.reserved_sectors, FAT_COUNT,
+        # No fixed root directory and no 16 bit sector counts on FAT32
+        0, 0, MEDIA_FIXED_DISK, 0,
+        63, 255, layout.hidden_sectors, layout.total_sectors
+    )
+    struct.pack_into(
+        '<IHHIHH12xBxBI11s8s', sector, 36,
+        layout.fat_sectors, 0, 0, ROOT_CLUSTER, FSINFO_SECTOR, BACKUP_BOOT_SECTOR,
+        0x80, 0x29, volume_id, label, b'FAT32   '
+    )
+    sector[90:90 + len(BOOT_CODE)] = BOOT_CODE
+    sector[510:512] = b'\x55\xAA'
+    return bytes(sector)
+
+
+def build_fsinfo(layout, free_clusters, next_free):
+    sector = bytearray(layout.sector_size)
+    struct.pack_into('<I', sector, 0, FSINFO_LEAD_SIGNATURE)
+    struct.pack_into('<IIII', sector, 484, FSINFO_STRUCT_SIGNATURE, free_clusters, next_free, 0)
+    struct.pack_into('<I', sector, 508, FSINFO_TRAIL_SIGNATURE)
+    return bytes(sector)
+
+
+def build_reserved_area(layout, label, volume_id, free_clusters, next_free):
+    """Boot sector, FSInfo and the third boot sector, and their backups"""
+    reserved = bytearray(layout.reserved_sectors * layout.sector_size)
+    boot = build_boot_sector(layout, label, volume_id)
+    fsinfo = build_fsinfo(layout, free_clusters, next_free)
+    # The boot record spans three sectors, the last one only carries a signature
+    third = bytearray(layout.sector_size)
+    third[510:512] = b'\x55\xAA'
+    for first in (0, BACKUP_BOOT_SECTOR):
+        for index, sector in enumerate((boot, fsinfo, third)):
+            offset = (first + index) * layout.sector_size
+            reserved[offset:offset + layout.sector_size] = sector
+    return bytes(reserved)
+
+
+def volume_label_entry(label, timestamp):
+    """Root directory entry carrying the volume label"""
+    date, clock = dos_datetime(timestamp)
+    return struct.pack('<11sBBBHHHHHHHI', label, ATTR_VOLUME_ID, 0, 0, clock, date, date, 0, clock, date, 0, 0)
+
+
+def write_fat_region(fd, offset, length, head=b''):
+    """Write one FAT: its used entries, then zeros, in a few large writes"""
+    head = memoryview(head)
+    zeros = bytes(min(FORMAT_WRITE_SIZE, length))
+    position = 0
+    while position < length:
+        size = min(len(zeros), length - position)
+        piece = head[position:position + size]
+        if len(piece) == size:
+            write_at(fd, piece, offset + position)
+        else:
+            write_at(fd, bytes(piece) + zeros[:size - len(piece)], offset + position)
+        position += size
+
+
+def format_fat32(target_path, offset=0, size=None, cluster_size=DEFAULT_CLUSTER_SIZE, label='',
+                 sector_size=None, hidden_sectors=None, volume_id=None):
+    """Write an empty FAT32 file system to a partition or image file
+
+    offset and size select the volume on the device, by default the whole device or
+    file. The reserved area, both FATs and the root directory are built in memory and
+    written with a handful of large writes. Returns the FAT32Layout.
+    """
+    fd = os.open(target_path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+    try:
+        if size is None:
+            size = get_device_size(fd) - offset
+        if sector_size is None:
+            sector_size = get_sector_sizes(fd)[0]
+        if hidden_sectors is None:
+            hidden_sectors = offset // sector_size
+
+        layout = plan_fat32(size, cluster_size, sector_size, hidden_sectors)
+        label = fat_label(label)
+        if volume_id is None:
+            volume_id = struct.unpack('<I', os.urandom(4))[0]
+
+        # The root directory takes the first cluster
+        write_at(fd, build_reserved_area(layout, label, volume_id, layout.cluster_count - 1, ROOT_CLUSTER + 1),
+                 offset)
+
+        head = struct.pack('<III', FAT32_ENTRY_MASK & (0x0FFFFF00 | MEDIA_FIXED_DISK), FAT32_EOC, FAT32_EOC)
+        for index in range(FAT_COUNT):
+            write_fat_region(fd, offset + layout.fat_offset(index), layout.fat_sectors * sector_size, head)
+
+        root = bytearray(layout.cluster_size)
+        if label != b'NO NAME    ':
+            root[:DIR_ENTRY_SIZE] = volume_label_entry(label, time.time())
+        write_at(fd, bytes(root), offset + layout.cluster_offset(ROOT_CLUSTER))
+
+        os.fsync(fd)
+        return layout
+    finally:
+        os.close(fd)
+
+
+def read_fat32_layout(target_path, offset=0):
+    """Read the geometry of an existing FAT32 volume from its boot sector"""
+    fd = os.open(target_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        sector = read_at(fd, 512, offset)
+    finally:
+        os.close(fd)
+
+    if len(sector) < 512 or sector[510:512] != b'\x55\xAA' or sector[82:87] != b'FAT32':
+        raise Exception("Volume is not FAT32")
+    (sector_size, sectors_per_cluster, reserved_sectors, fat_count, _, _, _, _, _, _,
+     hidden_sectors, total_sectors) = struct.unpack_from('<HBHBHHBHHHII', sector, 11)
+    fat_sectors = struct.unpack_from('<I', sector, 36)[0]
+    if fat_count != FAT_COUNT:
+        raise Exception(f"FAT32 volume with {fat_count} FATs is not supported")
+    return FAT32Layout(sector_size, sectors_per_cluster, reserved_sectors, fat_sectors, total_sectors,
+                       hidden_sectors)
+
+
+def _short_char(char):
+    return char if char.isascii() and (char.isalnum() or char in SHORT_NAME_PUNCTUATION) else '_'
+
+
+def exact_short_name(name):
+    """(11 byte short name, case flags) of a name that is a valid 8.3 name apart from case, else None
+
+    The case flags are set when the base or extension is all lower case, Windows shows
+    such names in lower case without a long name. Mixed case names return flags None.
+    """
+    base, _, extension = name.partition('.')
+    if not base or len(base) > 8 or len(extension) > 3 or '.' in extension:
+        return None
+    upper = name.upper()
+    if len(upper) != len(name) or any(_short_char(char) != char for char in upper.replace('.', '')):
+        return None
+
+    flags = 0
+    for part, flag in ((base, CASE_LOWER_BASE), (extension, CASE_LOWER_EXTENSION)):
+        if part != part.upper():
+            if part != part.lower():
+                flags = None
+                break
+            flags |= flag
+    short = upper.partition('.')
+    return (short[0].ljust(8) + short[2].ljust(3)).encode('ascii'), flags
+
+
+def generate_short_name(name, taken):
+    """Numbered short name (NAME~1.EXT) for a long name, unique among the taken 11 byte names"""
+    stripped = name.lstrip('.').replace(' ', '')
+    base, _, extension = stripped.rpartition('.') if '.' in stripped else (stripped, '', '')
+    base = ''.join(_short_char(char) for char in base.replace('.', '').upper()) or '_'
+    extension = ''.join(_short_char(char) for char in extension.upper())[:3]
+
+    for number in count(1):
+        tail = f"~{number}"
+        candidate = ((base[:8 - len(tail)] + tail).ljust(8) + extension.ljust(3)).encode('ascii')
+        if candidate not in taken:
+            return candidate
+
+
+def short_name_checksum(short_name):
+    checksum = 0
+    for byte in short_name:
+        checksum = ((((checksum & 1) << 7) | (checksum >> 1)) + byte) & 0xFF
+    return checksum
+
+
+def lfn_entries(name, short_name):
+    """Long file name entries of a name, in the order they precede the short entry"""
+    units = name.encode('utf-16-le')
+    units += b'\0\0' if len(units) % (LFN_CHARS * 2) else b''
+    units += b'\xFF' * (-len(units) % (LFN_CHARS * 2))
+    checksum = short_name_checksum(short_name)
+    total = len(units) // (LFN_CHARS * 2)
+
+    entries = []
+    for index in range(total):
+        part = units[index * LFN_CHARS * 2:(index + 1) * LFN_CHARS * 2]
+        sequence = (index + 1) | (LFN_LAST if index == total - 1 else 0)
+        entries.append(struct.pack('<B10sBBB12sH4s', sequence, part[:10], ATTR_LONG_NAME, 0, checksum,
+                                   part[10:22], 0, part[22:26]))
+    entries.reverse()
+    return entries
+
+
+def dir_entry(short_name, attributes, cluster, size, timestamp, case_flags=0):
+    date, clock = dos_datetime(timestamp)
+    return struct.pack('<11sBBBHHHHHHHI', short_name, attributes, case_flags, 0, clock, date, date,
+                       cluster >> 16, clock, date, cluster & 0xFFFF, size)
+
+
+class _Directory:
+    __slots__ = ('path', 'name', 'mtime', 'children', 'records', 'cluster', 'clusters', 'parent')
+
+    def __init__(self, path, name, mtime=None, parent=None):
+        self.path = path
+        self.name = name
+        self.mtime = mtime
+        self.parent = parent
+        # Child directories and file entries, in catalog order
+        self.children = []
+        # (long name or None, short name, case flags, child) of every entry, filled in by the planner
+        self.records = []
+        self.cluster = 0
+        self.clusters = 0
+
+
+class FAT32Builder:
+    """Lay out a FAT32 volume straight from an image catalog and write it in one sequential sweep
+
+    Every directory and file gets a contiguous run of clusters: directories first, then
+    the files in the order their data lies in the image. Directory entries with long
+    names and the FAT chains are built in memory, so the device is written from the
+    reserved area to the last used cluster in order, with large writes and no file
+    system driver in between.
+    """
+
+    def __init__(self, entries, layout, label='', progress_callback=None):
+        self.layout = layout
+        self.label = fat_label(label)
+        # Called with (written_bytes, total_bytes)
+        self.progress_callback = progress_callback
+        self.timestamp = time.time()
+
+        self.root = _Directory('', '')
+        self.directories = []
+        # (entry, first cluster, cluster count) in cluster order
+        self.files = []
+        self.total_bytes = 0
+        self.used_clusters = 0
+        self.skipped = []
+        self._last_report = 0
+
+        self._plan(entries)
+
+    def _plan(self, entries):
+        directories = {'': self.root}
+
+        def directory(path, mtime=None):
+            node = directories.get(path)
+            if node is None:
+                parent_path, _, name = path.rpartition('/')
+                parent = directory(parent_path)
+                node = _Directory(path, name, mtime, parent)
+                directories[path] = node
+                parent.children.append(node)
+            elif mtime is not None:
+                node.mtime = mtime
+            return node
+
+        files = []
+        for entry in entries:
+            if entry.is_dir:
+                directory(entry.path, entry.mtime)
+                continue
+            if entry.size > FAT32_MAX_FILE_SIZE:
+                raise Exception(f"{entry.path} is larger than the 4 GiB FAT32 can hold")
+            directory(entry.path.rpartition('/')[0]).children.append(entry)
+            files.append(entry)
+
+        # Breadth first, parents ahead of their children
+        pending = deque([self.root])
+        while pending:
+            node = pending.popleft()
+            self.directories.append(node)
+            self._name_children(node)
+            pending.extend(child for _, _, _, child in node.records if isinstance(child, _Directory))
+
+        cluster = ROOT_CLUSTER
+        for node in self.directories:
+            # Dot entries or the volume label, the records and their long names
+            slots = (1 if node is self.root else 2) + sum(
+                1 + (len(lfn_entries(name, short)) if name is not None else 0) for name, short, _, _ in node.records)
+            node.clusters = max(1, -(-slots * DIR_ENTRY_SIZE // self.layout.cluster_size))
+            node.cluster = cluster
+            cluster += node.clusters
+
+        # Image order keeps the source reads sequential too
+        named = {id(child) for node in self.directories for _, _, _, child in node.records}
+        files = [entry for entry in files if id(entry) in named]
+        files.sort(key=source_position)
+        for entry in files:
+            clusters = -(-entry.size // self.layout.cluster_size)
+            self.files.append((entry, cluster if clusters else 0, clusters))
+            cluster += clusters
+            self.total_bytes += entry.size
+
+        self.used_clusters = cluster - ROOT_CLUSTER
+        if self.used_clusters > self.layout.cluster_count:
+            raise Exception("ISO contents do not fit on the FAT32 volume")
+
+    def _name_children(self, node):
+        taken = set()
+        seen = set()
+        for child in node.children:
+            name = child.path.rpartition('/')[2]
+            key = name.casefold()
+            if key in seen:
+                # Names differing only in case cannot share a FAT directory
+                self.skipped.append(child.path)
+                continue
+            seen.add(key)
+            if len(name) > LFN_MAX_LENGTH:
+                raise Exception(f"{child.path} has a name longer than FAT allows")
+
+            exact = exact_short_name(name)
+            if exact is not None and exact[0] not in taken:
+                short, flags = exact
+                # Mixed case needs a long name to keep its case
+                long_name = None if flags is not None else name
+            else:
+                short, flags = generate_short_name(name, taken), None
+                long_name = name
+            taken.add(short)
+            node.records.append((long_name, short, flags or 0, child))
+
+    def _fat(self):
+        """Bytes of the used part of the FAT, every run chained to its end"""
+        last = ROOT_CLUSTER + self.used_clusters
+        fat = array('I', bytes(4 * last))
+        fat[0] = FAT32_ENTRY_MASK & (0x0FFFFF00 | MEDIA_FIXED_DISK)
+        fat[1] = FAT32_EOC
+        runs = [(node.cluster, node.clusters) for node in self.directories]
+        runs += [(first, clusters) for _, first, clusters in self.files if clusters]
+        for first, clusters in runs:
+            fat[first:first + clusters - 1] = array('I', range(first + 1, first + clusters))
+            fat[first + clusters - 1] = FAT32_EOC
+        if sys.byteorder != 'little':
+            fat.byteswap()
+        return fat.tobytes()
+
+    def _directory_bytes(self, node):
+        data = bytearray(node.clusters * self.layout.cluster_size)
+        timestamp = node.mtime if node.mtime is not None else self.timestamp
+        if node is self.root:
+            entries = [volume_label_entry(self.label, self.timestamp)] if self.label != b'NO NAME    ' else []
+        else:
+            parent = node.parent.cluster if node.parent is not self.root else 0
+            entries = [dir_entry(b'.          ', ATTR_DIRECTORY, node.cluster, 0, timestamp),
+                       dir_entry(b'..         ', ATTR_DIRECTORY, parent, 0, timestamp)]
+
+        clusters = {id(entry): first for entry, first, _ in self.files}
+        for long_name, short, flags, child in node.records:
+            if long_name is not None:
+                entries.extend(lfn_entries(long_name, short))
+            mtime = child.mtime if child.mtime is not None else self.timestamp
+            if isinstance(child, _Directory):
+                entries.append(dir_entry(short, ATTR_DIRECTORY, child.cluster, 0, mtime, flags))
+            else:
+                entries.append(dir_entry(short, ATTR_ARCHIVE, clusters[id(child)], child.size, mtime, flags))
+
+        packed = b''.join(entries)
+        data[:len(packed)] = packed
+        return data
+
+    def write(self, iso_path, target_path, offset=0, volume_id=None, leaves=None):
+        """Write the volume to a device or image file, offset being the partition start
+
+        leaves, a LeafHasher, gets the files hashed as they are written.
+        """
+        layout = self.layout
+        if volume_id is None:
+            volume_id = struct.unpack('<I', os.urandom(4))[0]
+        next_free = ROOT_CLUSTER + self.used_clusters
+
+        fd = os.open(target_path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+        try:
+            write_at(fd, build_reserved_area(layout, self.label, volume_id,
+                                             layout.cluster_count - self.used_clusters, next_free), offset)
+            fat = self._fat()
+            for index in range(FAT_COUNT):
+                write_fat_region(fd, offset + layout.fat_offset(index), layout.fat_sectors * layout.sector_size, fat)
+
+            stream = SequentialWriter(fd, offset + layout.cluster_offset(ROOT_CLUSTER), self._report)
+            for node in self.directories:
+                stream.write(self._directory_bytes(node))
+
+            with open(iso_path, 'rb') as iso_file, ExtentReader(iso_file) as reader:
+                for entry, _, clusters in self.files:
+                    if not clusters:
+                        continue
+                    stream_file(stream, reader, entry, leaves)
+                    # Files start on their own cluster
+                    stream.pad(clusters * layout.cluster_size - entry.size)
+            stream.close()
+
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self._report(self.total_bytes, force=True)
+
+    def _report(self, written_bytes, force=False):
+        if not self.progress_callback:
+            return
+        now = time.monotonic()
+        if force or now - self._last_report >= PROGRESS_INTERVAL:
+            self._last_report = now
+            self.progress_callback(written_bytes, self.total_bytes)
+
+
+def stream_file(stream, reader, entry, leaves=None):
+    """Append the data of an ISOEntry/UDFEntry to a SequentialWriter, counted for progress
+
+    With a LeafHasher (core.manifest) the data is hashed on its way to the target.
+    """
+    hashed = leaves.file(entry.path) if leaves is not None else None
+    position = 0
+    for file_offset, source, length in file_pieces(entry):
+        if file_offset > position:
+            stream.pad(file_offset - position)
+            if hashed is not None:
+                hashed.zeros(file_offset - position)
+        if isinstance(source, bytes):
+            stream.write(source[:length], length)
+            if hashed is not None:
+                hashed.update(source[:length])
+        elif source is None:
+            stream.pad(length, counted=True)
+            if hashed is not None:
+                hashed.zeros(length)
+        else:
+            for start in range(0, length, FORMAT_WRITE_SIZE):
+                view = reader.extent(source + start, min(FORMAT_WRITE_SIZE, length - start))
+                try:
+                    stream.write(view, len(view))
+                    if hashed is not None:
+                        hashed.update(view)
+                finally:
+                    view.release()
+        position = file_offset + length
+    if entry.size > position:
+        stream.pad(entry.size - position, counted=True)
+        if hashed is not None:
+            hashed.zeros(entry.size - position)
+    if hashed is not None:
+        hashed.close()
+
+
+def source_position(entry):
+    """Offset of a file's first data in the image, files sorted by it are read sequentially"""
+    pieces = file_pieces(entry)
+    for _, source, _ in pieces:
+        if isinstance(source, int):
+            return source
+    return 0
+
+
+class SequentialWriter:
+    """Gather consecutive data into large writes at an advancing offset"""
+
+    def __init__(self, fd, offset, report=None):
+        self.fd = fd
+        self.offset = offset
+        self.report = report
+        self.counted = 0
+        self._buffer = bytearray(FORMAT_WRITE_SIZE)
+        self._filled = 0
+
+    def write(self, data, counted=0):
+        view = memoryview(data)
+        try:
+            position = 0
+            while position < len(view):
+                size = min(len(view) - position, len(self._buffer) - self._filled)
+                self._buffer[self._filled:self._filled + size] = view[position:position + size]
+                self._filled += size
+                position += size
+                if self._filled == len(self._buffer):
+                    self.flush()
+        finally:
+            view.release()
+        self._count(counted)
+
+    def pad(self, length, counted=False):
+        """Zeros, counted as file data for progress or as padding"""
+        while length > 0:
+            size = min(length, len(self._buffer) - self._filled)
+            self._buffer[self._filled:self._filled + size] = bytes(size)
+            self._filled += size
+            length -= size
+            if counted:
+                self._count(size)
+            if self._filled == len(self._buffer):
+                self.flush()
+
+    def _count(self, length):
+        if length and self.report:
+            self.counted += length
+            self.report(self.counted)
+
+    def seek(self, offset):
+        """Continue at another offset, data adjoining the buffered data still goes into the same write"""
+        if offset != self.offset + self._filled:
+            self.flush()
+            self.offset = offset
+
+    def flush(self):
+        if self._filled:
+            write_at(self.fd, memoryview(self._buffer)[:self._filled], self.offset)
+            self.offset += self._filled
+            self._filled = 0
+
+    def close(self):
+        self.flush()
+
+
+def build_fat32(iso_path, entries, target_path, offset=0, size=None, cluster_size=DEFAULT_CLUSTER_SIZE, label='',
+                sector_size=None, progress_callback=None, leaves=None):
+    """Format a partition or image file as FAT32 and fill it with the files of an image in one pass
+
+    Returns the FAT32Builder, its skipped list names entries dropped for clashing names.
+    """
+    fd = os.open(target_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        if size is None:
+            size = get_device_size(fd) - offset
+        if sector_size is None:
+            sector_size = get_sector_sizes(fd)[0]
+    finally:
+        os.close(fd)
+
+    layout = plan_fat32(size, cluster_size, sector_size, offset // sector_size)
+    builder = FAT32Builder(entries, layout, label, progress_callback)
+    builder.write(iso_path, target_path, offset, leaves=leaves)
+    return builder
@@ -3,17 +3,123 @@ import subprocess
 import shutil
 import tempfile
 import time
-import struct
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from core.checksum import check_source_checksums, default_hash, get_hash
+from core.delta import apply_timestamps, plan_delta, remove_stale
+from core.exfat import build_exfat, format_exfat
+from core.ext4 import EXT_BLOCK_SIZES, EXT_DEFAULT_BLOCK_SIZE, EXT_FILE_SYSTEMS, build_ext4, format_ext4
+from core.fat32 import DEFAULT_CLUSTER_SIZE, build_fat32, format_fat32
+from core.compressed_source import CompressedSource, detect_compression
+from core.disk_image import open_disk_image
+from core.iso_handler import ISOHandler, detect_partition_table, iter_iso_entries
+from core.journal import FlashJournal
+from core.manifest import (
+    LeafHasher, cache_image_manifest, cached_image_manifest, check_target, get_image_manifest,
+    read_manifest, remove_manifest, write_manifest
+)
+from core.multi_writer import DEFAULT_MAX_LAG, MultiTargetWriter
+from core.partition import reload_partition_table, set_active_partition, write_partition_table
+from core.raw_writer import DEFAULT_BLOCK_SIZE, RawBlockWriter, open_readback
+from core.scheduler import (
+    DEFAULT_WORKERS, SMALL_FILE_THRESHOLD, ExtractionScheduler, SmallFilePool, StageStats
+)
+from core.udf_reader import UDFReader, has_udf
+from core.verifier import DEFAULT_COVERAGE, VERIFY_FULL, VERIFY_OFF, VERIFY_QUICK, Verifier
+
+# Extract the ISO file system onto a freshly formatted drive
+WRITE_MODE_FILES = "files"
+# Write an isohybrid image block for block onto the device
+WRITE_MODE_RAW = "raw"
+# Update a drive flashed before: write changed files, delete removed ones, no format
+WRITE_MODE_DELTA = "delta"
+
+# diskpart clean zeroes the first megabyte of the disk
+CLEAN_WIPE_SIZE = 1024 * 1024
+
+# Seconds to wait for the drive letter to come back after partitioning
+DRIVE_READY_TIMEOUT = 15
+
+# Windows volume ioctls releasing a volume before its disk is repartitioned
+FSCTL_LOCK_VOLUME = 0x90018
+FSCTL_DISMOUNT_VOLUME = 0x90020
+
+# File systems written in process straight from the ISO catalog
+DIRECT_FILE_SYSTEMS = ("FAT32", "exFAT")
+
+# Target systems booting the volume's own boot sector from BIOS
+BIOS_TARGET_SYSTEMS = ("BIOS (Legacy)", "BIOS or UEFI")
+
+
+def parse_cluster_size(text):
+    """Bytes of a cluster size as offered in the UI ("4096 bytes (Default)", "16 kilobytes"), None if unknown"""
+    parts = (text or '').split()
+    if len(parts) < 2 or not parts[0].isdigit():
+        return None
+    unit = parts[1].lower()
+    if unit.startswith('kilobyte'):
+        return int(parts[0]) * 1024
+    if unit.startswith('byte'):
+        return int(parts[0])
+    return None
+
+
 class ISOFlasher:
     def __init__(self):
         self.progress_callback = None
         self.temp_dir = None
+        self.iso_handler = ISOHandler()
+        # Files up to this size are written in parallel by a bounded pool
+        self.small_file_threshold = SMALL_FILE_THRESHOLD
+        self.extract_workers = DEFAULT_WORKERS
+        # Raw image writes bypass the page cache with blocks of this size
+        self.raw_block_size = DEFAULT_BLOCK_SIZE
+        self.raw_direct_io = True
+        # Seek over all-zero runs of the image once the target has been discarded
+        self.raw_skip_zeros = False
+        # Threads decoding independent blocks of compressed images
+        self.decode_workers = DEFAULT_WORKERS
+        # Read back after writing, quick mode compares a sampled fraction of the data
+        self.verify_mode = VERIFY_QUICK
+        self.verify_coverage = DEFAULT_COVERAGE
+        # None picks the fastest available hash (xxh3, BLAKE3, BLAKE2b)
+        self.verify_algorithm = None
+        # Compare the image with a SHA256SUMS/MD5SUMS file beside it before writing
+        self.check_source_checksum = True
+        # Drives writing the same image may fall this far behind the fastest one
+        self.multi_max_lag = DEFAULT_MAX_LAG
+        # Journal finished ranges/files on the host so an interrupted flash continues where it stopped,
+        # FAT32/exFAT drives are then formatted and copied instead of built directly
+        self.resume_journal = True
+        # Leave a Merkle manifest of the copied files on the drive, a drive already holding the image is not flashed again
+        self.write_manifest = True
+        # Write MBR/GPT partition tables in process, diskpart only formats the partition
+        self.direct_partitioning = True
+        # Write FAT32 and exFAT drives in one sweep from the ISO catalog instead of formatting and copying file by
+        # file, only with resume_journal off
+        self.direct_build = True
         
-    def flash_iso(self, iso_path, drive_letter, volume_name, partition_scheme, target_system, file_system, progress_callback=None):
-        """Flash ISO to USB drive using temporary folder extraction method or format only for non-bootable"""
+    def flash_iso(self, iso_path, drive_letter, volume_name, partition_scheme, target_system, file_system, progress_callback=None,
+                  write_mode=WRITE_MODE_FILES, target_path=None, verify_mode=None, cluster_size=None):
+        """Flash ISO to USB drive using temporary folder extraction method or format only for non-bootable
+
+        In raw write mode an isohybrid image is streamed as is onto target_path (a block
+        device or an image file) or the physical disk behind drive_letter. Delta mode
+        updates the files of a drive flashed before without formatting it.
+
+        verify_mode ("off", "quick" or "full", defaults to self.verify_mode) reads the
+        written data back and fails the flash on any mismatch. cluster_size in bytes
+        applies to the new file system, None keeps the file system's default.
+
+        FAT32 and exFAT drives are built in one sweep (direct_build) only with
+        resume_journal off: the build is faster than formatting and copying, but it is
+        not journaled and an interrupted build starts over from the partition table.
+        Drives booting from BIOS are formatted by diskpart, whose boot sector loads BOOTMGR.
+        """
         self.progress_callback = progress_callback
+        if verify_mode is None:
+            verify_mode = self.verify_mode
 
         try:
             # Update progress
@@ -22,7 +128,26 @@ class ISOFlasher:
             # Check if this is a non-bootable format-only operation
             if iso_path is None:
                 # Non-bootable mode - just format the drive
-                return self._format_only_mode(drive_letter, volume_name, partition_scheme, file_system)
+                return self._format_only_mode(drive_letter, volume_name, partition_scheme, file_system, cluster_size)
+
+            if not os.path.exists(iso_path):
+                raise Exception("ISO file not found")
+
+            if self.check_source_checksum:
+                self._check_source_checksum(iso_path)
+
+            # Hybrid images bring their own partition table, no format or file copy
+            if write_mode == WRITE_MODE_RAW:
+                return self._raw_write_mode(iso_path, drive_letter, target_path, verify_mode)
+
+            # Extracting files needs random access to the image
+            if detect_compression(iso_path):
+                raise Exception("Compressed images can only be written in raw mode")
+
+            # Classify the boot method from the ISO itself before anything is written
+            boot_profile = self.iso_handler.get_boot_profile(iso_path)
+            if target_system is None:
+                target_system = boot_profile.target_system
 
             # To prevent unwanted configuration
             if partition_scheme == "MBR":
@@ -45,9 +170,6 @@ class ISOFlasher:
                     raise Exception("Selected unwanted configuration")
 
             # Validate inputs
-            if not os.path.exists(iso_path):
-                raise Exception("ISO file not found")
-
             if not os.path.exists(f"{drive_letter}:\\"):
                 raise Exception("USB drive not found")
 
@@ -56,29 +178,70 @@ class ISOFlasher:
             if not drive_info:
                 raise Exception("Could not get drive information")
 
-            # Update progress
-            self._update_progress(10, "Preparing USB drive...")
+            # Make sure the ISO contents fit on the drive before erasing it
+            plan = self.iso_handler.plan_extraction(iso_path)
+            if plan['total_bytes'] > drive_info['total_bytes']:
+                raise Exception("ISO contents do not fit on the USB drive")
 
-            # Format the drive first
-            if not self._format_drive_standalone(drive_letter, volume_name, partition_scheme, file_system):
-                raise Exception("Failed to format USB drive")
+            if file_system in EXT_FILE_SYSTEMS:
+                return self._ext_mode(iso_path, drive_letter, volume_name, partition_scheme, file_system,
+                                      cluster_size, verify_mode)
 
-            # Update progress
-            self._update_progress(25, "Mounting ISO and copying files...")
+            options = {'volume_name': volume_name, 'partition_scheme': partition_scheme,
+                       'target_system': target_system, 'file_system': file_system, 'cluster_size': cluster_size}
+            if write_mode == WRITE_MODE_DELTA:
+                return self._delta_mode(iso_path, drive_letter, target_system, boot_profile, verify_mode, options)
 
-            # Copy all files directly from mounted ISO to USB drive using xcopy
-            if not self._copy_iso_to_usb_direct(iso_path, drive_letter):
-                raise Exception("Failed to copy files to USB drive")
+            if self.write_manifest and self._drive_is_current(iso_path, f"{drive_letter}:\\", options, verify_mode):
+                self._update_progress(100, "Drive already holds this image")
+                return True
+
+            # Files are hashed as they are written, verification and manifest then only read the drive
+            leaves = self._leaf_hasher(iso_path, verify_mode)
+            journal = None
+            builder = None
+            # FAT32 and exFAT volumes are laid out from the ISO catalog and written in one sweep,
+            # the build is not journaled so it only runs when an interruption may start over. Its
+            # boot sector loads nothing, BIOS drives get the one diskpart's format writes instead
+            if (self.direct_build and not self.resume_journal and file_system in DIRECT_FILE_SYSTEMS
+                    and target_system not in BIOS_TARGET_SYSTEMS):
+                # A journal left by an earlier interrupted copy no longer describes the volume it rewrites
+                FlashJournal.open(iso_path, f"{drive_letter}:", WRITE_MODE_FILES, options).remove()
+                builder = self._build_volume_drive(iso_path, drive_letter, volume_name, partition_scheme,
+                                                   file_system, cluster_size, leaves)
+            if builder is None:
+                journal = self._format_and_copy(iso_path, drive_letter, volume_name, partition_scheme, file_system,
+                                                cluster_size, options, leaves)
 
             # Update progress
             self._update_progress(90, "Making drive bootable...")
 
             # Make the drive bootable
-            if not self._make_bootable_standalone(drive_letter, target_system):
+            if not self._make_bootable_standalone(drive_letter, target_system, boot_profile):
                 raise Exception("Failed to make drive bootable")
 
+            manifest = None
+            if leaves is not None:
+                manifest = self._streamed_manifest(iso_path, leaves, builder.skipped if builder is not None else [])
+
+            # Read the files back before reporting success
+            if verify_mode != VERIFY_OFF:
+                try:
+                    self._verify_target(manifest, f"{drive_letter}:\\", verify_mode, 92, 99)
+                except Exception:
+                    # A drive that fails verification is formatted again next time
+                    if journal is not None:
+                        journal.remove()
+                    raise
+
+            if journal is not None:
+                journal.remove()
+
             # Update progress
-            self._update_progress(95, "Finalizing...")
+            self._update_progress(99, "Finalizing...")
+
+            if self.write_manifest:
+                self._store_manifest(iso_path, f"{drive_letter}:\\", options, manifest)
 
             # Update progress
             self._update_progress(100, "Flash completed successfully!")
@@ -89,7 +252,211 @@ class ISOFlasher:
             self._update_progress(0, f"Error: {str(e)}")
             raise e
             
-    def _format_only_mode(self, drive_letter, volume_name, partition_scheme, file_system):
+    def _format_and_copy(self, iso_path, drive_letter, volume_name, partition_scheme, file_system, cluster_size,
+                         options, leaves=None):
+        """Format the drive and copy the ISO's files onto it, continuing an interrupted copy
+
+        Returns the journal of the copy, None when journaling is off.
+        """
+        journal = None
+        if self.resume_journal:
+            journal = self._open_files_journal(iso_path, drive_letter, options)
+
+        if journal is not None and journal.formatted:
+            # An interrupted copy continues on the volume it formatted
+            self._update_progress(25, f"Resuming copy ({len(journal.files)} files already on the drive)...")
+        else:
+            # Update progress
+            self._update_progress(10, "Preparing USB drive...")
+
+            # Format the drive first
+            if not self._format_drive_standalone(drive_letter, volume_name, partition_scheme, file_system,
+                                                 cluster_size, options.get('target_system') in BIOS_TARGET_SYSTEMS):
+                raise Exception("Failed to format USB drive")
+
+            if journal is not None:
+                journal.formatted = True
+                journal.volume_id = self._get_volume_id(drive_letter)
+                journal.save(force=True)
+
+            # Update progress
+            self._update_progress(25, "Mounting ISO and copying files...")
+
+        # Copy all files directly from mounted ISO to USB drive using xcopy
+        if not self._copy_iso_to_usb_direct(iso_path, drive_letter, journal, leaves):
+            raise Exception("Failed to copy files to USB drive")
+        return journal
+
+    def _build_volume_drive(self, iso_path, drive_letter, volume_name, partition_scheme, file_system,
+                            cluster_size=None, leaves=None):
+        """Partition the disk and write a populated FAT32 or exFAT volume straight from the ISO catalog
+
+        Returns the builder, or None when the volume could not be built and the caller formats and copies instead.
+        """
+        disk_number = self._get_disk_number(drive_letter)
+        target_path = f"\\\\.\\PhysicalDrive{disk_number}"
+
+        def report(written_bytes, total_bytes):
+            fraction = written_bytes / total_bytes if total_bytes > 0 else 1.0
+            self._update_progress(10 + fraction * 78, f"Writing {file_system} volume... ({written_bytes // (1024 * 1024)} MB)")
+
+        self._update_progress(10, "Writing partition table...")
+        try:
+            entries = list(self.iso_handler.iter_entries(iso_path))
+            volume = self._dismount_volume(drive_letter)
+            try:
+                partition = write_partition_table(target_path, partition_scheme, file_system,
+                                                  bootable=partition_scheme == "MBR", reload=False)
+                if file_system == "exFAT":
+                    # Files are contiguous runs without FAT chains, large ones go out as one sequential write
+                    builder = build_exfat(iso_path, entries, target_path, partition.offset, partition.size,
+                                          cluster_size, volume_name, partition.sector_size, report, leaves)
+                else:
+                    builder = build_fat32(iso_path, entries, target_path, partition.offset, partition.size,
+                                          cluster_size or DEFAULT_CLUSTER_SIZE, volume_name, partition.sector_size,
+                                          report, leaves)
+            finally:
+                if volume is not None:
+                    volume.Close()
+            reload_partition_table(target_path)
+        except Exception as e:
+            print(f"Building the {file_system} volume directly failed, formatting and copying instead: {e}")
+            return None
+
+        print(f"{file_system} volume written: {builder.layout}, {builder.used_clusters} clusters used")
+        for path in builder.skipped:
+            print(f"Skipped {path}: another name differs only in case")
+        return builder if self._remount_drive(disk_number, drive_letter) else None
+
+    def _ext_mode(self, iso_path, drive_letter, volume_name, partition_scheme, file_system, cluster_size=None,
+                  verify_mode=VERIFY_OFF):
+        """Partition the disk and write a populated ext2/3/4 volume straight from the ISO catalog
+
+        Windows does not mount ext volumes, so the drive letter goes away and the files
+        get no manifest. Verification reads the raw partition back instead: the metadata
+        against the builder's layout, the files against the leaves hashed while writing.
+        """
+        disk_number = self._get_disk_number(drive_letter)
+        target_path = f"\\\\.\\PhysicalDrive{disk_number}"
+
+        def report(written_bytes, total_bytes):
+            fraction = written_bytes / total_bytes if total_bytes > 0 else 1.0
+            self._update_progress(10 + fraction * 78, f"Writing {file_system} volume... ({written_bytes // (1024 * 1024)} MB)")
+
+        leaves = LeafHasher(self.verify_algorithm) if verify_mode != VERIFY_OFF else None
+        self._update_progress(10, "Writing partition table...")
+        try:
+            entries = list(self.iso_handler.iter_entries(iso_path))
+            volume = self._dismount_volume(drive_letter)
+            try:
+                partition = write_partition_table(target_path, partition_scheme, file_system,
+                                                  bootable=partition_scheme == "MBR", reload=False)
+                builder = build_ext4(iso_path, entries, target_path, partition.offset, partition.size, file_system,
+                                     self._ext_block_size(cluster_size), volume_name, report, leaves)
+            finally:
+                if volume is not None:
+                    volume.Close()
+                # Whatever was written, Windows has to drop its view of the old volume
+                reload_partition_table(target_path)
+        except Exception as e:
+            raise Exception(f"Writing the {file_system} volume failed: {e}")
+
+        print(f"{file_system} volume written: {builder.layout}, {builder.used_inodes} inodes used")
+        for path in builder.skipped:
+            print(f"Skipped {path}: lost+found belongs to the file system")
+
+        # Read the volume back before reporting success
+        if leaves is not None:
+            manifest = self._streamed_manifest(iso_path, leaves, builder.skipped)
+            self._update_progress(92, "Verifying written volume...")
+
+            def check_report(checked_bytes, total_bytes):
+                if total_bytes > 0:
+                    progress = 92 + min(checked_bytes / total_bytes, 1.0) * 7
+                    self._update_progress(progress, f"Verifying... ({checked_bytes // (1024 * 1024)} MB)")
+
+            self._check_verification(builder.check(target_path, manifest, partition.offset, verify_mode,
+                                                   self.verify_coverage, self.extract_workers, check_report))
+
+        self._update_progress(100, "Flash completed successfully!")
+        return True
+
+    def _ext_block_size(self, cluster_size):
+        """Block size of an ext volume, cluster sizes ext cannot use fall back to the default"""
+        if cluster_size in EXT_BLOCK_SIZES:
+            return cluster_size
+        if cluster_size:
+            print(f"ext volumes use 1, 2 or 4 KB blocks, using {EXT_DEFAULT_BLOCK_SIZE} bytes")
+        return EXT_DEFAULT_BLOCK_SIZE
+
+    def _remount_drive(self, disk_number, drive_letter):
+        """Wait for the drive letter of a rewritten volume, assigning it with diskpart if Windows did not"""
+        if self._wait_for_drive(drive_letter):
+            return True
+
+        diskpart_script = f"""
+select disk {disk_number}
+select partition 1
+assign letter={drive_letter}
+exit
+"""
+        self._run_diskpart(diskpart_script, 60)
+        return self._wait_for_drive(drive_letter)
+
+    def _delta_mode(self, iso_path, drive_letter, target_system, boot_profile, verify_mode=VERIFY_OFF, options=None):
+        """Bring the files of a drive in line with the ISO, writing only what changed
+
+        The drive is not formatted, so its manifest keeps the volume options it was
+        flashed with, only the target system changes. options is used for a drive
+        without a manifest.
+        """
+        target_root = f"{drive_letter}:\\"
+        if self.write_manifest and self._drive_is_current(iso_path, target_root, verify_mode=verify_mode):
+            self._update_progress(100, "Drive is already up to date")
+            return True
+
+        stored = read_manifest(target_root)
+        if stored is not None and stored.options:
+            options = dict(stored.options, target_system=target_system)
+
+        entries = list(self.iso_handler.iter_entries(iso_path))
+
+        self._update_progress(10, "Comparing drive with the ISO...")
+        plan = plan_delta(iso_path, target_root, entries, self._create_verifier(VERIFY_FULL, 10, 25))
+        print(plan)
+
+        # An interrupted update must not leave a manifest claiming the old content
+        remove_manifest(target_root)
+
+        self._update_progress(25, f"Removing {len(plan.removed_files)} deleted files...")
+        remove_stale(plan)
+
+        self._update_progress(30, f"Writing {len(plan.write_entries)} changed files...")
+        with open(iso_path, 'rb') as iso_file:
+            scheduler = self._create_scheduler(iso_file, target_root, 30, 88, "Updating files...")
+            for entry in plan.directories + plan.write_entries:
+                scheduler.add_entry(entry)
+            if not self._run_scheduler(scheduler):
+                raise Exception("Failed to copy files to USB drive")
+        apply_timestamps(plan.retimed, target_root)
+
+        self._update_progress(90, "Making drive bootable...")
+        if not self._make_bootable_standalone(drive_letter, target_system, boot_profile):
+            raise Exception("Failed to make drive bootable")
+
+        # Unchanged files were compared already, only what was written is read back
+        if verify_mode != VERIFY_OFF and plan.write_entries:
+            self._update_progress(92, "Verifying updated files...")
+            verifier = self._create_verifier(verify_mode, 92, 99)
+            self._check_verification(verifier.verify_files(iso_path, target_root, plan.write_entries))
+
+        if self.write_manifest:
+            self._store_manifest(iso_path, target_root, options)
+
+        self._update_progress(100, "Update completed successfully!")
+        return True
+
+    def _format_only_mode(self, drive_letter, volume_name, partition_scheme, file_system, cluster_size=None):
         """Format-only mode for non-bootable USB drives"""
         try:
             # Update progress
@@ -102,7 +469,8 @@ class ISOFlasher:
             self._update_progress(20, "Formatting USB drive...")
 
             # Format the drive using diskpart
-            if not self._format_drive_standalone(drive_letter, volume_name, partition_scheme, file_system):
+            if not self._format_drive_standalone(drive_letter, volume_name, partition_scheme, file_system,
+                                                 cluster_size):
                 raise Exception("Failed to format USB drive")
 
             # Update progress
@@ -114,6 +482,443 @@ class ISOFlasher:
             self._update_progress(0, f"Error: {str(e)}")
             raise e
 
+    def _raw_write_mode(self, iso_path, drive_letter, target_path=None, verify_mode=VERIFY_OFF):
+        """Write an isohybrid image block for block to the device or image file"""
+        if not self.is_raw_image(iso_path):
+            raise Exception("Image has no partition table and cannot be written in raw mode")
+
+        with self._open_raw_source(iso_path, workers=1) as source:
+            image_size = source.size or 0
+
+        wiped = target_path is None
+        if target_path is None:
+            self._update_progress(10, "Removing volumes from USB drive...")
+            target_path = self._prepare_raw_drive(drive_letter, image_size)
+
+        journal = self._open_raw_journal(iso_path, target_path, wiped) if self.resume_journal else None
+
+        self._update_progress(15, "Writing image to USB drive...")
+        if verify_mode != VERIFY_OFF:
+            # Blocks are hashed while writing, verification then only reads the target
+            writer = self._write_raw_image(iso_path, target_path, 15, 85,
+                                           hash_algorithm=self.verify_algorithm or default_hash(), journal=journal)
+            # Resumed blocks were not hashed, those runs compare against the source
+            digests = writer.block_digests if not writer.resumed_bytes else None
+            try:
+                self._verify_image(iso_path, target_path, verify_mode, 85, 99, digests=digests,
+                                   holes=writer.hole_ranges)
+            except Exception:
+                # A target that fails verification is not worth resuming
+                if journal is not None:
+                    journal.remove()
+                raise
+        else:
+            self._write_raw_image(iso_path, target_path, 15, 99, journal=journal)
+
+        if journal is not None:
+            journal.remove()
+        self._update_progress(100, "Flash completed successfully!")
+        return True
+
+    def _open_raw_journal(self, iso_path, target_path, wiped=False):
+        """Load the journal of an interrupted raw write to this target, checked against the target"""
+        journal = FlashJournal.open(iso_path, target_path, WRITE_MODE_RAW)
+        if not journal.resumable:
+            return journal
+
+        if wiped:
+            journal.discard(0, CLEAN_WIPE_SIZE)
+        if not self._check_raw_journal(journal, target_path):
+            print("Journal does not match the target, writing the whole image")
+            journal.reset()
+        else:
+            print(f"Resuming raw write: {journal.completed_bytes / 1e6:.1f} MB already on the target, "
+                  f"first missing byte at {journal.first_gap()}")
+        return journal
+
+    def _open_files_journal(self, iso_path, drive_letter, options):
+        """Load the journal of an interrupted file copy to this drive"""
+        journal = FlashJournal.open(iso_path, f"{drive_letter}:", WRITE_MODE_FILES, options)
+        if journal.formatted and journal.volume_id != self._get_volume_id(drive_letter):
+            print("Journal belongs to another volume, formatting the drive")
+            journal.reset()
+        return journal
+
+    def _get_volume_id(self, drive_letter):
+        """Serial number of the volume behind a drive letter, None if it cannot be read"""
+        try:
+            import win32api
+            return win32api.GetVolumeInformation(f"{drive_letter}:\\")[1]
+        except Exception:
+            return None
+
+    def _check_raw_journal(self, journal, target_path):
+        """Check that the last journaled block is still on the target"""
+        if not os.path.exists(target_path) and not target_path.startswith('\\\\.\\'):
+            return False
+        if journal.tail is None:
+            return True
+
+        offset, length, algorithm, digest = journal.tail
+        try:
+            target, _ = open_readback(target_path, direct=False)
+            with target:
+                target.seek(offset)
+                data = target.read(length)
+            return get_hash(algorithm)(data).hexdigest() == digest
+        except Exception as e:
+            print(f"Error checking journal against the target: {e}")
+            return False
+
+    def _prepare_raw_drive(self, drive_letter, image_size):
+        """Check and clean the disk behind a drive letter, returns its physical drive path"""
+        if not os.path.exists(f"{drive_letter}:\\"):
+            raise Exception("USB drive not found")
+
+        drive_info = self._get_drive_info(drive_letter)
+        if drive_info and image_size > drive_info['total_bytes']:
+            raise Exception("ISO image does not fit on the USB drive")
+
+        # Write to the whole disk, not the volume behind the drive letter
+        target_path = f"\\\\.\\PhysicalDrive{self._get_disk_number(drive_letter)}"
+
+        if not self._clean_disk(drive_letter):
+            raise Exception("Failed to release the USB drive")
+        return target_path
+
+    def flash_raw_multi(self, iso_path, targets, progress_callback=None, verify_mode=None):
+        """Write one raw image to many drives at once, reading the source a single time
+
+        targets are drive letters or device/image file paths. progress_callback is called
+        as (target, progress, status) for every target, a failing or slow target does not
+        stop the others. Returns {target: None on success or the exception}.
+        """
+        if verify_mode is None:
+            verify_mode = self.verify_mode
+
+        def update(target, progress, status):
+            if progress_callback:
+                progress_callback(target, progress, status)
+
+        if not os.path.exists(iso_path):
+            raise Exception("ISO file not found")
+        if not self.is_raw_image(iso_path):
+            raise Exception("Image has no partition table and cannot be written in raw mode")
+        if self.check_source_checksum:
+            self._check_source_checksum(iso_path)
+
+        with self._open_raw_source(iso_path, workers=1) as source:
+            image_size = source.size or 0
+
+        results = {}
+        paths = {}
+        for target in targets:
+            try:
+                if len(target.rstrip(':')) == 1:
+                    update(target, 10, "Removing volumes from USB drive...")
+                    paths[self._prepare_raw_drive(target.rstrip(':'), image_size)] = target
+                else:
+                    paths[target] = target
+            except Exception as e:
+                results[target] = e
+                update(target, 0, f"Error: {str(e)}")
+
+        if not paths:
+            raise Exception("No usable target drives")
+
+        verify_end = 85 if verify_mode != VERIFY_OFF else 99
+
+        def report(states):
+            for state in states:
+                if state.error is not None or state.finished:
+                    continue
+                status = "Writing image..." if not state.detached else "Writing image (detached)..."
+                update(paths[state.path], 15 + state.progress * (verify_end - 15),
+                       f"{status} ({state.written_bytes // (1024 * 1024)} MB)")
+
+        algorithm = (self.verify_algorithm or default_hash()) if verify_mode != VERIFY_OFF else None
+        writer = MultiTargetWriter(list(paths), lambda: self._open_raw_source(iso_path),
+                                   block_size=self.raw_block_size, max_lag=self.multi_max_lag,
+                                   direct=self.raw_direct_io, progress_callback=report, hash_algorithm=algorithm)
+        states = writer.write()
+
+        print(f"Read {writer.read_bytes / 1e6:.1f} MB once for {len(states)} targets in {writer.elapsed:.2f} s")
+        for state in states:
+            print(state)
+            target = paths[state.path]
+            results[target] = state.error
+            if state.error is not None:
+                update(target, 0, f"Error: {str(state.error)}")
+
+        written = [state for state in states if state.ok]
+        if verify_mode != VERIFY_OFF and written:
+            # Targets are read back in parallel, against the digests taken by the single reader
+            digests = writer.block_digests if writer.digests_complete else None
+
+            def verify(state):
+                target = paths[state.path]
+                update(target, verify_end, "Verifying written image...")
+                verifier = Verifier(mode=verify_mode, coverage=self.verify_coverage, algorithm=algorithm,
+                                    workers=1, direct=self.raw_direct_io)
+                return self._check_verification(verifier.verify_image(iso_path, state.path, digests,
+                                                                      writer.hole_ranges))
+
+            with ThreadPoolExecutor(max_workers=len(written), thread_name_prefix='multi-verify') as executor:
+                futures = [(state, executor.submit(verify, state)) for state in written]
+                for state, future in futures:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        results[paths[state.path]] = e
+                        update(paths[state.path], 0, f"Error: {str(e)}")
+
+        for target, error in results.items():
+            if error is None:
+                update(target, 100, "Flash completed successfully!")
+        return results
+
+    def is_raw_image(self, image_path):
+        """Check if an image, compressed or not, starts with a partition table and can be written block for block"""
+        try:
+            if not detect_compression(image_path) and self.iso_handler.is_hybrid(image_path):
+                return True
+
+            # Only the first chunk gets decompressed or mapped
+            with self._open_raw_source(image_path, workers=1) as source:
+                if isinstance(source, CompressedSource):
+                    header = source.read(ISOHandler.SYSTEM_AREA_SIZE)
+                else:
+                    header = source.read_at(0, ISOHandler.SYSTEM_AREA_SIZE)
+                return detect_partition_table(header) is not None
+
+        except Exception as e:
+            print(f"Error reading image header: {e}")
+            return False
+
+    def _open_raw_source(self, image_path, workers=None):
+        """Open an image for raw writing: a decompressing stream or a (sparse) disk image"""
+        if detect_compression(image_path):
+            return CompressedSource(image_path, workers=workers or self.decode_workers)
+        # Raw, VHD and qcow2 images expose only their allocated ranges
+        return open_disk_image(image_path)
+
+    def _clean_disk(self, drive_letter):
+        """Remove every partition so Windows lets go of the volumes before raw writes"""
+        try:
+            diskpart_script = f"""
+select disk {self._get_disk_number(drive_letter)}
+clean
+exit
+"""
+
+            with tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False) as f:
+                f.write(diskpart_script)
+                script_path = f.name
+
+            try:
+                result = subprocess.run(
+                    ['diskpart', '/s', script_path],
+                    capture_output=True,
+                    text=True,
+                    timeout=120,
+                    creationflags=subprocess.CREATE_NO_WINDOW
+                )
+                return result.returncode == 0
+            finally:
+                try:
+                    os.unlink(script_path)
+                except:
+                    pass
+
+        except Exception as e:
+            print(f"Error cleaning disk: {e}")
+            return False
+
+    def _write_raw_image(self, iso_path, target_path, start=0, end=100, hash_algorithm=None, journal=None):
+        """Copy the image onto the target from its first byte through the double buffered writer
+
+        Compressed images are decompressed by a pipelined stage in front of the writer,
+        sparse disk images only transfer their allocated ranges. With hash_algorithm every
+        block is hashed on the way through. Returns the finished RawBlockWriter.
+        """
+        source = self._open_raw_source(iso_path)
+
+        def report(written_bytes, total_bytes):
+            if total_bytes > 0:
+                fraction = written_bytes / total_bytes
+            elif isinstance(source, CompressedSource):
+                # Unknown uncompressed size (gzip, bz2), follow the compressed file
+                fraction = source.progress
+            else:
+                return
+            self._update_progress(start + fraction * (end - start),
+                                  f"Writing image... ({written_bytes // (1024 * 1024)} MB)")
+
+        writer = RawBlockWriter(target_path, block_size=self.raw_block_size, direct=self.raw_direct_io,
+                                progress_callback=report, skip_zeros=self.raw_skip_zeros,
+                                hash_algorithm=hash_algorithm, chunk_digests=hash_algorithm is not None)
+        with source:
+            written = writer.write(source, source.size, journal)
+
+        if isinstance(source, CompressedSource):
+            for stats in source.stats:
+                print(f"Decompress ({source.format}{', parallel' if source.parallel else ''}) {stats}")
+        elif writer.hole_bytes:
+            print(f"Sparse {source.format} image: {written / 1e6:.1f} MB allocated of {writer.image_size / 1e6:.1f} MB, "
+                  f"holes {'discarded' if writer.discarded else 'zeroed'}")
+
+        for stats in writer.stats:
+            print(stats)
+        print(f"Target busy {writer.utilization:.0%} of {writer.elapsed:.2f} s, "
+              f"sectors {writer.logical_sector_size}/{writer.physical_sector_size} bytes, "
+              f"direct I/O {'on' if writer.direct_active else 'off'}")
+        if self.raw_skip_zeros:
+            if writer.discarded:
+                print(f"Skipped {writer.skipped_bytes / 1e6:.1f} MB of zeros in {len(writer.skipped_ranges)} ranges, "
+                      f"{writer.repaired_bytes / 1e6:.1f} MB rewritten after verification")
+            else:
+                print("Target could not be discarded, zero blocks were written")
+        if writer.resumed_bytes:
+            print(f"Resumed: {writer.resumed_bytes / 1e6:.1f} MB were already on the target")
+        if writer.digest:
+            print(f"Written data {writer.hash_algorithm}: {writer.digest}")
+        return writer
+
+    def _create_verifier(self, verify_mode, start, end):
+        def report(checked_bytes, total_bytes):
+            if total_bytes > 0:
+                progress = start + min(checked_bytes / total_bytes, 1.0) * (end - start)
+                self._update_progress(progress, f"Verifying... ({checked_bytes // (1024 * 1024)} MB)")
+
+        return Verifier(mode=verify_mode, coverage=self.verify_coverage, algorithm=self.verify_algorithm,
+                        workers=self.extract_workers, progress_callback=report)
+
+    def _check_verification(self, result):
+        print(result)
+        if result.ok:
+            return True
+
+        for mismatch in result.mismatches[:20]:
+            print(f"Mismatch: {mismatch}")
+        shown = ", ".join(str(mismatch) for mismatch in result.mismatches[:3])
+        more = f" and {len(result.mismatches) - 3} more" if len(result.mismatches) > 3 else ""
+        raise Exception(f"Verification failed: {shown}{more}")
+
+    def _verify_image(self, iso_path, target_path, verify_mode, start=0, end=100, digests=None, holes=None):
+        """Read a raw written image back and compare it with the source or the digests taken while writing"""
+        self._update_progress(start, "Verifying written image...")
+        verifier = self._create_verifier(verify_mode, start, end)
+        return self._check_verification(verifier.verify_image(iso_path, target_path, digests, holes))
+
+    def _verify_target(self, manifest, target_root, verify_mode, start=0, end=100):
+        """Read the copied files back and compare them with the leaves hashed while they were written"""
+        self._update_progress(start, "Verifying copied files...")
+
+        def report(checked_bytes, total_bytes):
+            if total_bytes > 0:
+                progress = start + min(checked_bytes / total_bytes, 1.0) * (end - start)
+                self._update_progress(progress, f"Verifying... ({checked_bytes // (1024 * 1024)} MB)")
+
+        return self._check_verification(check_target(manifest, target_root, verify_mode, self.verify_coverage,
+                                                     self.extract_workers, report))
+
+    def _check_source_checksum(self, iso_path):
+        """Refuse to write an image that does not match its published checksums"""
+        def report(done_bytes, total_bytes):
+            fraction = done_bytes / total_bytes if total_bytes > 0 else 1.0
+            self._update_progress(5 + fraction * 4, f"Checking image checksum... ({done_bytes // (1024 * 1024)} MB)")
+
+        verified, details = check_source_checksums(iso_path, report)
+        if verified is None:
+            return
+
+        for algorithm, (expected, actual, source) in details.items():
+            if expected != actual:
+                raise Exception(f"Image {algorithm.upper()} does not match {os.path.basename(source)}")
+            print(f"{algorithm.upper()} matches {os.path.basename(source)}: {actual}")
+
+    def _image_manifest(self, iso_path, start, end):
+        """Merkle manifest of the ISO's files, hashed once per image and cached"""
+        def report(done_bytes, total_bytes):
+            fraction = done_bytes / total_bytes if total_bytes > 0 else 1.0
+            self._update_progress(start + fraction * (end - start),
+                                  f"Hashing image manifest... ({done_bytes // (1024 * 1024)} MB)")
+
+        return get_image_manifest(iso_path, lambda: self.iso_handler.iter_entries(iso_path),
+                                  self.verify_algorithm, workers=self.extract_workers, progress_callback=report)
+
+    def _drive_is_current(self, iso_path, target_root, options=None, verify_mode=VERIFY_QUICK):
+        """Check the manifest on a drive against the ISO, then the drive against its manifest
+
+        options, when given, must match the ones the drive was flashed with. A matching
+        root only says what the drive was flashed with, so its files are hashed against
+        the stored leaves as well, a sample of them unless verify_mode is full.
+        """
+        stored = read_manifest(target_root)
+        if stored is None or (options is not None and stored.options != options):
+            return False
+        try:
+            manifest = self._image_manifest(iso_path, 5, 10)
+        except Exception as e:
+            print(f"Error hashing image manifest: {e}")
+            return False
+        if manifest.algorithm != stored.algorithm or manifest.root != stored.root:
+            return False
+
+        def report(checked_bytes, total_bytes):
+            if total_bytes > 0:
+                progress = 10 + min(checked_bytes / total_bytes, 1.0) * 10
+                self._update_progress(progress, f"Checking drive... ({checked_bytes // (1024 * 1024)} MB)")
+
+        mode = VERIFY_FULL if verify_mode == VERIFY_FULL else VERIFY_QUICK
+        result = check_target(stored, target_root, mode, self.verify_coverage, self.extract_workers, report)
+        print(result)
+        if not result.ok:
+            # Damaged or missing files, the drive is flashed again
+            for mismatch in result.mismatches[:20]:
+                print(f"Drive differs from its manifest: {mismatch}")
+            return False
+        print(f"Drive manifest matches the image: {stored.root}")
+        return True
+
+    def _leaf_hasher(self, iso_path, verify_mode):
+        """LeafHasher for a flash that verifies or needs a manifest not cached yet, else None"""
+        if verify_mode == VERIFY_OFF:
+            algorithm = self.verify_algorithm or default_hash()
+            if not self.write_manifest or cached_image_manifest(iso_path, algorithm) is not None:
+                return None
+        return LeafHasher(self.verify_algorithm)
+
+    def _streamed_manifest(self, iso_path, leaves, skipped=()):
+        """Manifest of the flashed files from the leaves hashed while writing
+
+        Only files that were not streamed are read from the image. Entries left out of
+        the volume (skipped) are left out of the manifest as well.
+        """
+        def report(done_bytes, total_bytes):
+            fraction = done_bytes / total_bytes if total_bytes > 0 else 1.0
+            self._update_progress(90 + fraction * 2, f"Hashing remaining files... ({done_bytes // (1024 * 1024)} MB)")
+
+        skipped = tuple(skipped)
+        entries = [entry for entry in self.iso_handler.iter_entries(iso_path)
+                   if not any(entry.path == path or entry.path.startswith(path + '/') for path in skipped)]
+        manifest = leaves.manifest(iso_path, entries, self.extract_workers, report)
+        if not skipped:
+            # Describes the whole image, a later flash of it hashes nothing
+            cache_image_manifest(iso_path, manifest)
+        return manifest
+
+    def _store_manifest(self, iso_path, target_root, options=None, manifest=None):
+        """Write the manifest of the flashed files to the drive, a failure does not fail the flash"""
+        try:
+            if manifest is None:
+                manifest = self._image_manifest(iso_path, 99, 99)
+            manifest.options = options or {}
+            write_manifest(manifest, target_root)
+            print(f"Manifest root: {manifest.root} ({len(manifest.leaves)} chunks)")
+        except Exception as e:
+            print(f"Error writing manifest: {e}")
+
     def _update_progress(self, progress, status):
         """Update progress callback"""
         if self.progress_callback:
@@ -132,8 +937,19 @@ class ISOFlasher:
         except Exception:
             return None
             
-    def _format_drive_standalone(self, drive_letter, volume_name, partition_scheme, file_system):
-        """Format the USB drive using only Windows built-in tools"""
+    def _format_drive_standalone(self, drive_letter, volume_name, partition_scheme, file_system, cluster_size=None,
+                                 bios_boot=False):
+        """Format the USB drive using only Windows built-in tools
+
+        With bios_boot the volume gets the boot sector of diskpart's format, which loads BOOTMGR.
+        """
+        if self.direct_partitioning:
+            try:
+                return self._partition_and_format(drive_letter, volume_name, partition_scheme, file_system,
+                                                  cluster_size, bios_boot)
+            except Exception as e:
+                print(f"Writing the partition table failed, falling back to diskpart: {e}")
+
         try:
             # Create diskpart script for comprehensive formatting
             diskpart_script = f"""
@@ -142,44 +958,143 @@ clean
 convert {partition_scheme}
 create partition primary
 active
-format fs={file_system} label="{volume_name}" quick
+format fs={file_system} label="{volume_name}" quick{self._diskpart_unit(cluster_size)}
 assign letter={drive_letter}
 exit
 """
-            
-            # Write diskpart script to temp file
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False) as f:
-                f.write(diskpart_script)
-                script_path = f.name
-                
-            try:
-                # Run diskpart with elevated privileges
-                result = subprocess.run(
-                    ['diskpart', '/s', script_path],
-                    capture_output=True,
-                    text=True,
-                    timeout=180,
-                    creationflags=subprocess.CREATE_NO_WINDOW
-                )
-                
-                if result.returncode == 0:
-                    # Wait for drive to be ready
-                    time.sleep(3)
-                    return os.path.exists(f"{drive_letter}:\\")
-                else:
-                    return False
-                    
-            finally:
-                # Clean up temp file
-                try:
-                    os.unlink(script_path)
-                except:
-                    pass
-                    
+
+            result = self._run_diskpart(diskpart_script, 180)
+            if result.returncode == 0:
+                # Wait for drive to be ready
+                return self._wait_for_drive(drive_letter)
+            else:
+                return False
+
         except Exception as e:
             print(f"Error formatting drive: {e}")
             return False
-            
+
+    def _partition_and_format(self, drive_letter, volume_name, partition_scheme, file_system, cluster_size=None,
+                              bios_boot=False):
+        """Write a single partition table directly to the disk, then format the partition
+
+        FAT32, exFAT and ext2/3/4 are formatted in process while the old volume is still
+        locked, other file systems are formatted by diskpart once Windows sees the new
+        partition. So are FAT32 and exFAT with bios_boot: the boot sectors written in
+        process load nothing, diskpart's load BOOTMGR.
+        """
+        disk_number = self._get_disk_number(drive_letter)
+        target_path = f"\\\\.\\PhysicalDrive{disk_number}"
+
+        formatted = False
+        volume = self._dismount_volume(drive_letter)
+        try:
+            partition = write_partition_table(target_path, partition_scheme, file_system,
+                                              bootable=partition_scheme == "MBR", reload=False)
+            print(f"Partition table written: {partition}")
+            if file_system == "FAT32" and not bios_boot:
+                layout = format_fat32(target_path, partition.offset, partition.size,
+                                      cluster_size or DEFAULT_CLUSTER_SIZE, volume_name, partition.sector_size)
+                print(f"Formatted FAT32: {layout}")
+                formatted = True
+            elif file_system == "exFAT" and not bios_boot:
+                layout = format_exfat(target_path, partition.offset, partition.size, cluster_size, volume_name,
+                                      partition.sector_size)
+                print(f"Formatted exFAT: {layout}")
+                formatted = True
+            elif file_system in EXT_FILE_SYSTEMS:
+                layout = format_ext4(target_path, partition.offset, partition.size, file_system,
+                                     self._ext_block_size(cluster_size), volume_name)
+                print(f"Formatted {file_system}: {layout}")
+                formatted = True
+        finally:
+            if volume is not None:
+                volume.Close()
+        reload_partition_table(target_path)
+
+        if file_system in EXT_FILE_SYSTEMS:
+            # Windows does not mount ext volumes, no drive letter comes back
+            return True
+        if formatted:
+            return self._remount_drive(disk_number, drive_letter)
+
+        # The table is in place, diskpart only formats the new partition
+        diskpart_script = f"""
+select disk {disk_number}
+select partition 1
+format fs={file_system} label="{volume_name}" quick{self._diskpart_unit(cluster_size)}
+assign letter={drive_letter}
+exit
+"""
+        result = self._run_diskpart(diskpart_script, 180)
+        if result.returncode != 0:
+            raise Exception(f"diskpart could not format the partition: {result.stdout.strip()}")
+        return self._wait_for_drive(drive_letter)
+
+    def _diskpart_unit(self, cluster_size):
+        """Allocation unit option of diskpart's format command"""
+        return f" unit={cluster_size}" if cluster_size else ""
+
+    def _dismount_volume(self, drive_letter):
+        """Lock and dismount the volume of a drive letter, returns the handle keeping it locked or None"""
+        try:
+            import win32con
+            import win32file
+            handle = win32file.CreateFile(
+                f"\\\\.\\{drive_letter}:",
+                win32con.GENERIC_READ | win32con.GENERIC_WRITE,
+                win32con.FILE_SHARE_READ | win32con.FILE_SHARE_WRITE,
+                None,
+                win32con.OPEN_EXISTING,
+                0,
+                None
+            )
+        except Exception:
+            return None
+
+        try:
+            win32file.DeviceIoControl(handle, FSCTL_LOCK_VOLUME, None, 0)
+        except Exception as e:
+            # Dismounting without the lock still forces open handles to let go
+            print(f"Could not lock volume {drive_letter}: {e}")
+        try:
+            win32file.DeviceIoControl(handle, FSCTL_DISMOUNT_VOLUME, None, 0)
+        except Exception as e:
+            print(f"Could not dismount volume {drive_letter}: {e}")
+        return handle
+
+    def _run_diskpart(self, diskpart_script, timeout):
+        """Run a diskpart script from a temporary file"""
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False) as f:
+            f.write(diskpart_script)
+            script_path = f.name
+
+        try:
+            # Run diskpart with elevated privileges
+            return subprocess.run(
+                ['diskpart', '/s', script_path],
+                capture_output=True,
+                text=True,
+                timeout=timeout,
+                creationflags=subprocess.CREATE_NO_WINDOW
+            )
+        finally:
+            # Clean up temp file
+            try:
+                os.unlink(script_path)
+            except:
+                pass
+
+    def _wait_for_drive(self, drive_letter, timeout=DRIVE_READY_TIMEOUT):
+        """Poll until the drive letter is mounted again instead of sleeping a fixed time"""
+        deadline = time.monotonic() + timeout
+        while True:
+            if os.path.exists(f"{drive_letter}:\\"):
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.1)
+
     def _get_disk_number(self, drive_letter):
         """Get disk number for the drive letter"""
         try:
@@ -251,126 +1166,84 @@ exit
             print(f"Error with PowerShell extraction: {e}")
             return False
             
-    def _extract_iso_manual(self, iso_path):
+    def _extract_iso_manual(self, iso_path, output_path=None):
         """Manual ISO extraction using Python"""
+        if output_path is None:
+            output_path = self.temp_dir
+
         try:
+            # UDF-only Windows media and files > 4 GiB need the UDF file system
+            if has_udf(iso_path):
+                return self._extract_udf(iso_path, output_path)
+
             with open(iso_path, 'rb') as iso_file:
-                # Read ISO 9660 structure
-                iso_file.seek(16 * 2048)  # Primary Volume Descriptor
-                pvd = iso_file.read(2048)
-                
-                if pvd[1:6] != b'CD001':
-                    raise Exception("Invalid ISO format")
-                
-                # Get root directory location
-                root_dir_lba = struct.unpack('<L', pvd[158:162])[0]
-                root_dir_size = struct.unpack('<L', pvd[166:170])[0]
-                
-                # Extract files from ISO
-                self._extract_iso_files(iso_file, root_dir_lba, root_dir_size, self.temp_dir, "")
+                # Extract files while walking the ISO 9660 directory tree
+                self._extract_iso_files(iso_file, output_path)
                 
                 return True
                 
         except Exception as e:
             print(f"Error with manual ISO extraction: {e}")
             return False
+
+    def _extract_udf(self, iso_path, output_path, journal=None, leaves=None):
+        """Stream every file out of the UDF file system of an image, no mounting needed"""
+        with UDFReader(iso_path) as reader, open(iso_path, 'rb') as iso_file:
+            scheduler = self._create_scheduler(iso_file, output_path, 30, 70, "Copying files...", journal, leaves)
+            for entry in reader.walk():
+                scheduler.add_udf_entry(entry)
+
+            return self._run_scheduler(scheduler)
+
+    def _create_scheduler(self, iso_file, output_path, start, end, label, journal=None, leaves=None):
+        """Create an extraction scheduler with the configured small file pool"""
+        return ExtractionScheduler(
+            iso_file,
+            output_path,
+            self._extraction_progress(start, end, label),
+            small_file_threshold=self.small_file_threshold,
+            workers=self.extract_workers,
+            journal=journal,
+            leaves=leaves
+        )
+
+    def _run_scheduler(self, scheduler):
+        """Run a scheduler and report the throughput of each stage"""
+        result = scheduler.run()
+        if scheduler.resumed_files:
+            print(f"Resumed: {scheduler.resumed_files} files were already on the target")
+        for stats in scheduler.stats:
+            if stats.files:
+                print(stats)
+        return result
+
+    def _extraction_progress(self, start, end, label):
+        """Map scheduler byte counts onto a range of the overall progress"""
+        def report(copied_bytes, total_bytes, copied_files, total_files):
+            if total_bytes > 0:
+                progress = start + (copied_bytes / total_bytes) * (end - start)
+            else:
+                progress = end
+            self._update_progress(progress, f"{label} ({copied_files}/{total_files})")
+        return report
             
-    def _extract_iso_files(self, iso_file, dir_lba, dir_size, output_path, current_path):
-        """Recursively extract files from ISO directory"""
-        try:
-            iso_file.seek(dir_lba * 2048)
-            dir_data = iso_file.read(dir_size)
-            
-            offset = 0
-            file_count = 0
-            
-            while offset < len(dir_data):
-                if offset + 33 > len(dir_data):
-                    break
-                    
-                record_length = dir_data[offset]
-                if record_length == 0:
-                    # Skip to next sector
-                    sector_offset = offset % 2048
-                    if sector_offset != 0:
-                        offset += 2048 - sector_offset
-                        continue
-                    else:
-                        break
-                
-                if offset + record_length > len(dir_data):
-                    break
-                
-                # Parse directory record
-                record = dir_data[offset:offset + record_length]
-                
-                # Get file location and size
-                file_lba = struct.unpack('<L', record[2:6])[0]
-                file_size = struct.unpack('<L', record[10:14])[0]
-                
-                # Get filename
-                filename_len = record[32]
-                if filename_len > 0 and offset + 33 + filename_len <= len(dir_data):
-                    filename = record[33:33 + filename_len].decode('ascii', errors='ignore')
-                    
-                    # Skip . and .. entries
-                    if filename not in ['.', '..', '\x00']:
-                        file_flags = record[25]
-                        is_directory = (file_flags & 2) != 0
-                        
-                        # Clean filename
-                        if ';' in filename:
-                            filename = filename.split(';')[0]
-                            
-                        full_path = os.path.join(output_path, current_path, filename)
-                        
-                        if is_directory:
-                            # Create directory
-                            os.makedirs(full_path, exist_ok=True)
-                            # Recursively extract directory contents
-                            if file_size > 0:
-                                self._extract_iso_files(iso_file, file_lba, file_size, output_path, 
-                                                      os.path.join(current_path, filename))
-                        else:
-                            # Extract file
-                            if file_size > 0:
-                                self._extract_file(iso_file, file_lba, file_size, full_path)
-                                file_count += 1
-                                
-                                # Update progress periodically
-                                if file_count % 10 == 0:
-                                    progress = 25 + min(40, (file_count / 100) * 40)
-                                    self._update_progress(progress, f"Extracting files... ({file_count} files)")
-                
-                offset += record_length
-                
-        except Exception as e:
-            print(f"Error extracting ISO files: {e}")
-            
-    def _extract_file(self, iso_file, file_lba, file_size, output_path):
-        """Extract a single file from ISO"""
-        try:
-            # Create directory if it doesn't exist
-            os.makedirs(os.path.dirname(output_path), exist_ok=True)
-            
-            # Read file data from ISO
-            iso_file.seek(file_lba * 2048)
-            
-            with open(output_path, 'wb') as output_file:
-                remaining = file_size
-                while remaining > 0:
-                    chunk_size = min(8192, remaining)
-                    chunk = iso_file.read(chunk_size)
-                    if not chunk:
-                        break
-                    output_file.write(chunk)
-                    remaining -= len(chunk)
-                    
-        except Exception as e:
-            print(f"Error extracting file {output_path}: {e}")
+    def _extract_iso_files(self, iso_file, output_path, start=25, end=65, label="Extracting files...", journal=None,
+                           leaves=None):
+        """Extract files from ISO in LBA order, planned from the directory walker"""
+        scheduler = self._create_scheduler(iso_file, output_path, start, end, label, journal, leaves)
+
+        # Collect every extent first, then read the image front to back
+        for entry in iter_iso_entries(iso_file):
+            scheduler.add_iso_entry(entry)
+
+        return self._run_scheduler(scheduler)
             
     def _copy_directory_contents(self, src_path, dst_path):
         """Copy directory contents with progress updates"""
+        pool = SmallFilePool(self.extract_workers) if self.extract_workers > 1 else None
+        small_stats = StageStats("Small files")
+        large_stats = StageStats("Large files")
+
         try:
             # Count total files first
             total_files = sum(1 for root, dirs, files in os.walk(src_path) for file in files)
@@ -392,16 +1265,36 @@ exit
                     # Ensure destination directory exists
                     os.makedirs(os.path.dirname(dst_file), exist_ok=True)
                     
-                    # Copy file
-                    shutil.copy2(src_file, dst_file)
+                    # Copy file, small ones fan out to the pool
+                    file_size = os.path.getsize(src_file)
+                    if pool is not None and file_size <= self.small_file_threshold:
+                        pool.submit(shutil.copy2, src_file, dst_file)
+                        small_stats.files += 1
+                        small_stats.bytes += file_size
+                    else:
+                        started = time.perf_counter()
+                        shutil.copy2(src_file, dst_file)
+                        large_stats.seconds += time.perf_counter() - started
+                        large_stats.files += 1
+                        large_stats.bytes += file_size
                     copied_files += 1
                     
                     # Update progress
                     if total_files > 0:
                         progress = 25 + (copied_files / total_files) * 40
                         self._update_progress(progress, f"Extracting files... ({copied_files}/{total_files})")
+
+            if pool is not None:
+                small_stats.seconds = pool.join()
+                pool = None
+
+            for stats in (small_stats, large_stats):
+                if stats.files:
+                    print(stats)
                         
         except Exception as e:
+            if pool is not None:
+                pool.shutdown()
             print(f"Error copying directory contents: {e}")
             raise e
             
@@ -445,8 +1338,30 @@ exit
             print(f"Error copying to USB drive: {e}")
             return False
             
-    def _copy_iso_to_usb_direct(self, iso_path, drive_letter):
-        """Copy files directly from mounted ISO to USB drive using xcopy"""
+    def _copy_iso_to_usb_direct(self, iso_path, drive_letter, journal=None, leaves=None):
+        """Copy files directly from the ISO to USB drive, mounting it for xcopy only as a fallback
+
+        With a journal or a LeafHasher the files are always streamed in process, which
+        records finished files, skips the ones an interrupted run completed and hashes
+        the data as it goes.
+        """
+        # Stream UDF images straight out of the file, no mount or temp staging
+        if has_udf(iso_path):
+            self._update_progress(30, "Copying files from ISO to USB...")
+            try:
+                if self._extract_udf(iso_path, f"{drive_letter}:\\", journal, leaves):
+                    self._update_progress(70, "Files copied successfully")
+                    return True
+            except Exception as e:
+                print(f"Error reading UDF file system, falling back to mount: {e}")
+        elif journal is not None or leaves is not None:
+            self._update_progress(30, "Copying files from ISO to USB...")
+            with open(iso_path, 'rb') as iso_file:
+                if self._extract_iso_files(iso_file, f"{drive_letter}:\\", 30, 70, "Copying files...", journal,
+                                           leaves):
+                    self._update_progress(70, "Files copied successfully")
+                    return True
+
         try:
             # Mount ISO using PowerShell
             mount_cmd = [
@@ -509,30 +1424,17 @@ exit
             finally:
                 self.temp_dir = None
                 
-    def _make_bootable_standalone(self, drive_letter, target_system):
+    def _make_bootable_standalone(self, drive_letter, target_system, boot_profile=None):
         """Make the USB drive bootable using only Windows tools"""
         try:
-            drive_path = f"{drive_letter}:\\"
-            
-            # Check for different boot methods
-            boot_files_found = []
-            
-            # Check for Windows boot files
-            if os.path.exists(os.path.join(drive_path, "bootmgr")):
-                boot_files_found.append("bootmgr")
-            if os.path.exists(os.path.join(drive_path, "boot")):
-                boot_files_found.append("boot_folder")
-            if os.path.exists(os.path.join(drive_path, "efi")):
-                boot_files_found.append("efi")
-            if os.path.exists(os.path.join(drive_path, "isolinux")):
-                boot_files_found.append("isolinux")
-                
-            # Make partition active using diskpart
-            self._make_partition_active(drive_letter)
+            # UEFI-only drives are GPT and boot from the EFI loader, there is no active flag
+            if target_system != "UEFI":
+                # Make partition active using diskpart
+                self._make_partition_active(drive_letter)
             
-            # If we have boot files, the drive should be bootable
-            if boot_files_found:
-                print(f"Boot files found: {boot_files_found}")
+            # The boot method was classified from the ISO before writing
+            if boot_profile is not None and boot_profile.kind != 'unknown':
+                print(f"Boot profile: {boot_profile}")
                 return True
             else:
                 print("No specific boot files found, but partition is marked as active")
@@ -540,10 +1442,18 @@ exit
                 
         except Exception as e:
             print(f"Error making drive bootable: {e}")
-            return True  # Don't fail the entire process for boot setup issues
+            return False
             
     def _make_partition_active(self, drive_letter):
         """Mark the partition as active using diskpart"""
+        if self.direct_partitioning:
+            try:
+                # A single sector write, no diskpart round trip
+                set_active_partition(f"\\\\.\\PhysicalDrive{self._get_disk_number(drive_letter)}")
+                return True
+            except Exception as e:
+                print(f"Error setting the active flag directly, using diskpart: {e}")
+
         try:
             disk_num = self._get_disk_number(drive_letter)
             
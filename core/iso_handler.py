@@ -1,12 +1,858 @@
 import os
+import bisect
+import calendar
+import heapq
 import struct
 import subprocess
+from array import array
+from collections import deque
 from pathlib import Path
 
+from core.cache import MetadataCache, file_cache_key
+from core.udf_reader import UDFReader
+
+# ISO 9660 logical sector size
+SECTOR_SIZE = 2048
+
+# Directory record file flags
+FLAG_HIDDEN = 0x01
+FLAG_DIRECTORY = 0x02
+FLAG_MULTI_EXTENT = 0x80
+
+# Joliet escape sequences (UCS-2 level 1, 2 and 3)
+JOLIET_ESCAPES = (b'%/@', b'%/C', b'%/E')
+
+# Identifiers found in the volume descriptor set and the UDF recognition sequence
+VOLUME_DESCRIPTOR_IDS = (b'CD001', b'BEA01', b'NSR02', b'NSR03', b'BOOT2', b'CDW02')
+
+
+def normalize_iso_path(path):
+    """Normalize a path for catalog lookups (case-insensitive, '/' separated)"""
+    return path.replace('\\', '/').strip('/').lower()
+
+
+def parse_dir_record(data, offset):
+    """Parse one directory record, returns (length, lba, size, flags, raw_name, system_use)"""
+    record_length = data[offset]
+    if record_length == 0:
+        return 0, 0, 0, 0, b'', b''
+
+    file_lba = struct.unpack_from('<L', data, offset + 2)[0]
+    file_size = struct.unpack_from('<L', data, offset + 10)[0]
+    file_flags = data[offset + 25]
+    name_len = data[offset + 32]
+    raw_name = bytes(data[offset + 33:offset + 33 + name_len])
+
+    # System use area follows the name (padded to an even offset)
+    su_start = offset + 33 + name_len + (1 - name_len % 2)
+    system_use = bytes(data[su_start:offset + record_length])
+
+    return record_length, file_lba, file_size, file_flags, raw_name, system_use
+
+
+def decode_rock_ridge_name(system_use, read_continuation=None):
+    """Decode a Rock Ridge alternate name (NM entries) from a system use area"""
+    name = b''
+    found = False
+    area = system_use
+    offset = 0
+
+    while offset + 4 <= len(area):
+        signature = area[offset:offset + 2]
+        entry_len = area[offset + 2]
+        if entry_len < 4 or offset + entry_len > len(area):
+            break
+
+        if signature == b'NM':
+            flags = area[offset + 4]
+            # Skip "." and ".." aliases
+            if not flags & 0x06:
+                name += area[offset + 5:offset + entry_len]
+                found = True
+        elif signature == b'CE' and read_continuation is not None:
+            # Continuation area: lba, offset and length (both-endian)
+            ce_lba = struct.unpack_from('<L', area, offset + 4)[0]
+            ce_offset = struct.unpack_from('<L', area, offset + 12)[0]
+            ce_len = struct.unpack_from('<L', area, offset + 20)[0]
+            area = read_continuation(ce_lba, ce_offset, ce_len)
+            offset = 0
+            read_continuation = None
+            continue
+        elif signature == b'ST':
+            break
+
+        offset += entry_len
+
+    if not found:
+        return None
+    return name.decode('utf-8', errors='replace')
+
+
+def decode_iso_name(raw_name, joliet=False):
+    """Decode an ISO 9660 / Joliet file identifier and strip the version suffix"""
+    if joliet:
+        name = raw_name.decode('utf-16-be', errors='ignore')
+    else:
+        name = raw_name.decode('ascii', errors='ignore')
+
+    if ';' in name:
+        name = name.split(';')[0]
+
+    # Plain ISO 9660 names without extension carry a trailing dot
+    if not joliet and name.endswith('.'):
+        name = name[:-1]
+
+    return name
+
+
+def decode_record_date(data):
+    """Decode the 7 byte recording date of a directory record to a POSIX timestamp, None if unset"""
+    if len(data) < 7 or not any(data[:6]):
+        return None
+    year, month, day, hour, minute, second = data[0] + 1900, data[1], data[2], data[3], data[4], data[5]
+    if not 1 <= month <= 12 or not 1 <= day <= 31 or hour > 23 or minute > 59 or second > 60:
+        return None
+    # Offset from GMT in 15 minute intervals
+    gmt_offset = struct.unpack('b', data[6:7])[0] * 15 * 60
+    return calendar.timegm((year, month, day, hour, minute, second, 0, 0, 0)) - gmt_offset
+
+
+class ISOEntry:
+    """Lightweight view of one catalog entry"""
+    __slots__ = ('path', 'lba', 'size', 'flags', 'extents', 'mtime')
+
+    def __init__(self, path, lba, size, flags, extents=None, mtime=None):
+        self.path = path
+        self.lba = lba
+        self.size = size
+        self.flags = flags
+        self.extents = extents if extents is not None else ((lba, size),)
+        # Recording date as a POSIX timestamp, None when the walker did not read it
+        self.mtime = mtime
+
+    @property
+    def is_dir(self):
+        return (self.flags & FLAG_DIRECTORY) != 0
+
+    @property
+    def name(self):
+        return self.path.rsplit('/', 1)[-1]
+
+    def __repr__(self):
+        return f"ISOEntry({self.path!r}, lba={self.lba}, size={self.size}, flags={self.flags:#x})"
+
+
+class ISOTree:
+    """The directory tree to read: Rock Ridge, Joliet or plain ISO 9660 names"""
+    __slots__ = ('descriptor', 'name_format', 'volume_name', 'root_lba', 'root_size')
+
+    def __init__(self, descriptor, name_format, volume_name):
+        self.descriptor = descriptor
+        self.name_format = name_format
+        self.volume_name = volume_name
+        self.root_lba = struct.unpack('<L', descriptor[158:162])[0]
+        self.root_size = struct.unpack('<L', descriptor[166:170])[0]
+
+    @classmethod
+    def open(cls, f):
+        """Read the volume descriptor set and pick the best naming of the tree"""
+        pvd = None
+        joliet_svd = None
+
+        sector = 16
+        while True:
+            f.seek(sector * SECTOR_SIZE)
+            descriptor = f.read(SECTOR_SIZE)
+            if len(descriptor) < SECTOR_SIZE or descriptor[1:6] != b'CD001':
+                break
+            if descriptor[0] == 1 and pvd is None:
+                pvd = descriptor
+            elif descriptor[0] == 2 and descriptor[88:91] in JOLIET_ESCAPES and joliet_svd is None:
+                joliet_svd = descriptor
+            elif descriptor[0] == 255:
+                break
+            sector += 1
+
+        if pvd is None:
+            raise Exception("Invalid ISO format")
+
+        volume_name = pvd[40:72].decode('ascii', errors='ignore').strip() or None
+
+        # Rock Ridge is flagged by an SUSP "SP" entry in the root "." record
+        root_lba = struct.unpack('<L', pvd[158:162])[0]
+        f.seek(root_lba * SECTOR_SIZE)
+        root_sector = f.read(SECTOR_SIZE)
+        rock_ridge = False
+        if root_sector and root_sector[0]:
+            system_use = parse_dir_record(root_sector, 0)[5]
+            rock_ridge = system_use[:2] == b'SP' and system_use[4:6] == b'\xbe\xef'
+
+        # Rock Ridge names win (long, case preserving), then Joliet, then plain ISO 9660
+        if rock_ridge:
+            return cls(pvd, 'rockridge', volume_name)
+        if joliet_svd is not None:
+            return cls(joliet_svd, 'joliet', volume_name)
+        return cls(pvd, 'iso9660', volume_name)
+
+    def record_name(self, raw_name, system_use, read_continuation=None):
+        """Decode the name of a directory record in this tree's naming"""
+        if self.name_format == 'rockridge':
+            name = decode_rock_ridge_name(system_use, read_continuation)
+            if name:
+                return name
+        return decode_iso_name(raw_name, self.name_format == 'joliet')
+
+
+def iter_iso_entries(iso_file, tree=None):
+    """Walk the directory tree without recursion, yielding one ISOEntry at a time"""
+    if tree is None:
+        tree = ISOTree.open(iso_file)
+
+    def read_continuation(lba, offset, length):
+        iso_file.seek(lba * SECTOR_SIZE + offset)
+        return iso_file.read(length)
+
+    pending = deque([('', tree.root_lba, tree.root_size)])
+    visited = set()
+
+    while pending:
+        dir_path, dir_lba, dir_size = pending.popleft()
+        # Guard against directory loops in corrupted images
+        if dir_lba in visited:
+            continue
+        visited.add(dir_lba)
+
+        # Read one sector at a time, records never span sectors
+        multi_extent = None
+        for sector_index in range((dir_size + SECTOR_SIZE - 1) // SECTOR_SIZE):
+            iso_file.seek((dir_lba + sector_index) * SECTOR_SIZE)
+            sector = iso_file.read(SECTOR_SIZE)
+            if len(sector) < SECTOR_SIZE:
+                raise Exception(f"Directory extent at sector {dir_lba} is truncated")
+
+            entries = []
+            offset = 0
+            while offset + 33 <= SECTOR_SIZE:
+                record_length, file_lba, file_size, file_flags, raw_name, system_use = parse_dir_record(sector, offset)
+                if record_length == 0:
+                    break
+                if offset + record_length > SECTOR_SIZE:
+                    raise Exception(f"Corrupted directory record at sector {dir_lba + sector_index}")
+                mtime = decode_record_date(sector[offset + 18:offset + 25])
+                offset += record_length
+
+                # Skip . and .. entries
+                if raw_name in (b'\x00', b'\x01'):
+                    continue
+
+                name = tree.record_name(raw_name, system_use, read_continuation)
+                path = f"{dir_path}/{name}" if dir_path else name
+
+                # Files > 4 GiB are split into several records with the multi-extent flag
+                if multi_extent is not None:
+                    multi_extent.append((file_lba, file_size))
+                    if file_flags & FLAG_MULTI_EXTENT:
+                        continue
+                    extents = multi_extent
+                    multi_extent = None
+                    entries.append(ISOEntry(path, extents[0][0], sum(size for _, size in extents),
+                                            file_flags & ~FLAG_MULTI_EXTENT, tuple(extents), mtime))
+                    continue
+                if file_flags & FLAG_MULTI_EXTENT and not file_flags & FLAG_DIRECTORY:
+                    multi_extent = [(file_lba, file_size)]
+                    continue
+
+                entries.append(ISOEntry(path, file_lba, file_size, file_flags, mtime=mtime))
+                if file_flags & FLAG_DIRECTORY:
+                    pending.append((path, file_lba, file_size))
+
+            # Yield after the sector is parsed, the caller may move the file position
+            for entry in entries:
+                yield entry
+
+
+class ISOCatalog:
+    """Indexed catalog of every file and directory in an ISO 9660 image"""
+
+    def __init__(self, iso_path):
+        self.iso_path = iso_path
+        self.volume_name = None
+        self.name_format = 'iso9660'
+
+        # Array-backed entry storage, one slot per entry
+        self._paths = []
+        self._lbas = array('L')
+        self._sizes = array('Q')
+        self._flags = array('B')
+
+        # Only multi-extent files (> 4 GiB) need an explicit extent list
+        self._extents = {}
+
+        self._index = {}
+        self._sorted_keys = []
+        self._sorted_ids = []
+        self._children = {}
+        self._total_size = 0
+        self._file_count = 0
+
+    def __len__(self):
+        return len(self._paths)
+
+    def __contains__(self, path):
+        return normalize_iso_path(path) in self._index
+
+    def _entry(self, entry_id):
+        return ISOEntry(
+            self._paths[entry_id],
+            self._lbas[entry_id],
+            self._sizes[entry_id],
+            self._flags[entry_id],
+            self._extents.get(entry_id)
+        )
+
+    def lookup(self, path):
+        """Get the entry for a path, or None if it doesn't exist"""
+        entry_id = self._index.get(normalize_iso_path(path))
+        if entry_id is None:
+            return None
+        return self._entry(entry_id)
+
+    def list_dir(self, path=''):
+        """List the direct children of a directory"""
+        key = normalize_iso_path(path)
+        if key and key not in self._index:
+            return []
+        return [self._entry(entry_id) for entry_id in self._children.get(key, [])]
+
+    def iter_prefix(self, path):
+        """Iterate every entry below a directory using the sorted path index"""
+        prefix = normalize_iso_path(path)
+        if prefix:
+            prefix += '/'
+        position = bisect.bisect_left(self._sorted_keys, prefix)
+        while position < len(self._sorted_keys) and self._sorted_keys[position].startswith(prefix):
+            yield self._entry(self._sorted_ids[position])
+            position += 1
+
+    def entries(self):
+        """Iterate every entry in catalog order"""
+        for entry_id in range(len(self._paths)):
+            yield self._entry(entry_id)
+
+    def files(self):
+        """Iterate every file entry"""
+        for entry_id in range(len(self._paths)):
+            if not self._flags[entry_id] & FLAG_DIRECTORY:
+                yield self._entry(entry_id)
+
+    def directories(self):
+        """Iterate every directory entry"""
+        for entry_id in range(len(self._paths)):
+            if self._flags[entry_id] & FLAG_DIRECTORY:
+                yield self._entry(entry_id)
+
+    @property
+    def total_size(self):
+        """Total size of all files in bytes"""
+        return self._total_size
+
+    @property
+    def file_count(self):
+        return self._file_count
+
+    def _add(self, path, lba, size, flags, extents=None):
+        entry_id = len(self._paths)
+        self._paths.append(path)
+        self._lbas.append(lba)
+        self._sizes.append(size)
+        self._flags.append(flags)
+        if extents is not None and len(extents) > 1:
+            self._extents[entry_id] = tuple(extents)
+        if not flags & FLAG_DIRECTORY:
+            self._total_size += size
+            self._file_count += 1
+        return entry_id
+
+    def _finalize(self):
+        """Build the lookup indexes once all entries are known"""
+        self._index = {}
+        self._children = {}
+        for entry_id, path in enumerate(self._paths):
+            key = path.lower()
+            self._index[key] = entry_id
+            parent = key.rsplit('/', 1)[0] if '/' in key else ''
+            self._children.setdefault(parent, []).append(entry_id)
+
+        order = sorted(self._index.items())
+        self._sorted_keys = [key for key, _ in order]
+        self._sorted_ids = array('L', (entry_id for _, entry_id in order))
+
+    @classmethod
+    def build(cls, iso_path):
+        """Build a catalog with a single pass over the volume descriptors and directory extents"""
+        catalog = cls(iso_path)
+
+        with open(iso_path, 'rb') as f:
+            tree = ISOTree.open(f)
+            catalog.volume_name = tree.volume_name
+            catalog.name_format = tree.name_format
+            descriptor = tree.descriptor
+            root_lba = tree.root_lba
+            root_size = tree.root_size
+
+            def read_continuation(lba, offset, length):
+                f.seek(lba * SECTOR_SIZE + offset)
+                return f.read(length)
+
+            # The path table lists every directory extent up front
+            directory_lbas = catalog._read_path_table(f, descriptor)
+            if root_lba not in directory_lbas:
+                directory_lbas.add(root_lba)
+
+            sizes = {root_lba: root_size}
+            pending = []
+
+            # Visit directory extents strictly in LBA order
+            visited = set()
+            queue = sorted(directory_lbas)
+            while queue:
+                dir_lba = heapq.heappop(queue)
+                if dir_lba in visited:
+                    continue
+                visited.add(dir_lba)
+
+                f.seek(dir_lba * SECTOR_SIZE)
+                first_sector = f.read(SECTOR_SIZE)
+                if not first_sector or first_sector[0] == 0:
+                    continue
+
+                # The "." record carries the real extent size
+                dir_size = sizes.get(dir_lba) or parse_dir_record(first_sector, 0)[2]
+                dir_data = first_sector + f.read(max(0, dir_size - SECTOR_SIZE))
+
+                discovered = catalog._scan_directory(dir_data, dir_lba, tree, read_continuation, pending)
+                for child_lba, child_size in discovered:
+                    sizes.setdefault(child_lba, child_size)
+                    if child_lba not in visited:
+                        # Directories missing from the path table are read afterwards
+                        heapq.heappush(queue, child_lba)
+
+            catalog._resolve_paths(pending)
+
+        catalog._finalize()
+        return catalog
+
+    def _read_path_table(self, f, descriptor):
+        """Read the little-endian path table, returns the set of directory LBAs"""
+        table_size = struct.unpack('<L', descriptor[132:136])[0]
+        table_lba = struct.unpack('<L', descriptor[140:144])[0]
+        lbas = set()
+
+        if not table_size or not table_lba:
+            return lbas
+
+        f.seek(table_lba * SECTOR_SIZE)
+        table = f.read(table_size)
+        offset = 0
+        while offset + 8 <= len(table):
+            name_len = table[offset]
+            if name_len == 0:
+                break
+            lbas.add(struct.unpack_from('<L', table, offset + 2)[0])
+            offset += 8 + name_len + (name_len % 2)
+
+        return lbas
+
+    def _scan_directory(self, dir_data, dir_lba, tree, read_continuation, pending):
+        """Collect the records of one directory extent, returns discovered subdirectories"""
+        discovered = []
+        offset = 0
+        multi_extent = None
+
+        while offset < len(dir_data):
+            if offset + 33 > len(dir_data):
+                break
+
+            record_length, file_lba, file_size, file_flags, raw_name, system_use = parse_dir_record(dir_data, offset)
+            if record_length == 0:
+                # Records never span sectors, skip the padding
+                offset = (offset // SECTOR_SIZE + 1) * SECTOR_SIZE
+                continue
+            if offset + record_length > len(dir_data):
+                break
+            offset += record_length
+
+            # Skip . and .. entries
+            if raw_name in (b'\x00', b'\x01'):
+                continue
+
+            name = tree.record_name(raw_name, system_use, read_continuation)
+
+            # Files > 4 GiB are split into several records with the multi-extent flag
+            if multi_extent is not None:
+                multi_extent[2].append((file_lba, file_size))
+                if file_flags & FLAG_MULTI_EXTENT:
+                    continue
+                name, flags, extents = multi_extent
+                multi_extent = None
+                pending.append((dir_lba, name, extents[0][0], sum(size for _, size in extents),
+                                flags & ~FLAG_MULTI_EXTENT, extents))
+                continue
+            if file_flags & FLAG_MULTI_EXTENT and not file_flags & FLAG_DIRECTORY:
+                multi_extent = (name, file_flags, [(file_lba, file_size)])
+                continue
+
+            pending.append((dir_lba, name, file_lba, file_size, file_flags, None))
+            if file_flags & FLAG_DIRECTORY:
+                discovered.append((file_lba, file_size))
+
+        return discovered
+
+    def _resolve_paths(self, pending):
+        """Turn (parent lba, name) records into full paths"""
+        directory_paths = {}
+
+        # Directory records name their own extent, which maps an extent to its path
+        parents = {}
+        names = {}
+        for dir_lba, name, file_lba, _, file_flags, _ in pending:
+            if file_flags & FLAG_DIRECTORY and file_lba not in names:
+                parents[file_lba] = dir_lba
+                names[file_lba] = name
+
+        def directory_path(lba):
+            chain = []
+            seen = set()
+            while lba in names and lba not in directory_paths and lba not in seen:
+                seen.add(lba)
+                chain.append(lba)
+                lba = parents[lba]
+            base = directory_paths.get(lba, '')
+            for item in reversed(chain):
+                base = f"{base}/{names[item]}" if base else names[item]
+                directory_paths[item] = base
+            return base
+
+        for dir_lba, name, file_lba, file_size, file_flags, extents in pending:
+            parent_path = directory_path(dir_lba)
+            path = f"{parent_path}/{name}" if parent_path else name
+            self._add(path, file_lba, file_size, file_flags, extents)
+
+
+# El Torito platform identifiers
+PLATFORM_X86 = 0x00
+PLATFORM_PPC = 0x01
+PLATFORM_MAC = 0x02
+PLATFORM_EFI = 0xEF
+
+# El Torito boot media (emulation) types
+EMULATION_TYPES = {
+    0: 'no emulation',
+    1: '1.2M floppy',
+    2: '1.44M floppy',
+    3: '2.88M floppy',
+    4: 'hard disk'
+}
+
+
+class BootEntry:
+    """One initial/section entry of an El Torito boot catalog"""
+    __slots__ = ('platform_id', 'bootable', 'emulation', 'load_segment', 'system_type',
+                 'sector_count', 'lba')
+
+    def __init__(self, platform_id, data):
+        self.platform_id = platform_id
+        self.bootable = data[0] == 0x88
+        self.emulation = data[1] & 0x0F
+        self.load_segment = struct.unpack_from('<H', data, 2)[0]
+        self.system_type = data[4]
+        # Load size is counted in 512 byte virtual sectors
+        self.sector_count = struct.unpack_from('<H', data, 6)[0]
+        self.lba = struct.unpack_from('<L', data, 8)[0]
+
+    @property
+    def is_efi(self):
+        return self.platform_id == PLATFORM_EFI
+
+    @property
+    def emulation_name(self):
+        return EMULATION_TYPES.get(self.emulation, 'unknown')
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data):
+        entry = cls.__new__(cls)
+        for name in cls.__slots__:
+            setattr(entry, name, data[name])
+        return entry
+
+    def __repr__(self):
+        return (f"BootEntry(platform={self.platform_id:#x}, bootable={self.bootable}, "
+                f"emulation={self.emulation_name!r}, lba={self.lba}, sectors={self.sector_count})")
+
+
+def parse_boot_catalog(data):
+    """Parse an El Torito boot catalog, returns (validation platform id, id string, entries)"""
+    if len(data) < 64:
+        raise Exception("Boot catalog is too short")
+
+    # Validation entry: header 0x01, key bytes 0x55 0xAA and a zero word checksum
+    validation = data[:32]
+    if validation[0] != 0x01 or validation[30:32] != b'\x55\xAA':
+        raise Exception("Invalid boot catalog validation entry")
+    if sum(struct.unpack('<16H', validation)) & 0xFFFF != 0:
+        raise Exception("Boot catalog checksum mismatch")
+
+    platform_id = validation[1]
+    id_string = validation[4:28].rstrip(b'\x00 ').decode('ascii', errors='ignore')
+
+    # The initial/default entry uses the platform of the validation entry
+    entries = [BootEntry(platform_id, data[32:64])]
+
+    offset = 64
+    while offset + 32 <= len(data):
+        header = data[offset]
+        if header not in (0x90, 0x91):
+            break
+
+        section_platform = data[offset + 1]
+        entry_count = struct.unpack_from('<H', data, offset + 2)[0]
+        offset += 32
+
+        for _ in range(entry_count):
+            if offset + 32 > len(data):
+                break
+            media_type = data[offset + 1]
+            entries.append(BootEntry(section_platform, data[offset:offset + 32]))
+            offset += 32
+
+            # Extension entries (0x44) follow entries with bit 5 of the media type set
+            if media_type & 0x20:
+                while offset + 32 <= len(data) and data[offset] == 0x44:
+                    more = data[offset + 1] & 0x20
+                    offset += 32
+                    if not more:
+                        break
+
+        # 0x91 marks the final section header
+        if header == 0x91:
+            break
+
+    return platform_id, id_string, entries
+
+
+class BootProfile:
+    """Boot classification of an ISO, decided before anything is written"""
+    __slots__ = ('kind', 'loader', 'bios', 'uefi', 'hybrid', 'entries')
+
+    def __init__(self, kind='unknown', loader=None, bios=False, uefi=False, hybrid=False, entries=None):
+        # windows, isolinux, grub, efi, hybrid or unknown
+        self.kind = kind
+        # Boot loader file found in the ISO catalog
+        self.loader = loader
+        self.bios = bios
+        self.uefi = uefi
+        self.hybrid = hybrid
+        self.entries = entries or []
+
+    @property
+    def target_system(self):
+        """Target system value understood by ISOFlasher.flash_iso"""
+        if self.uefi and not self.bios:
+            return "UEFI"
+        if self.bios and not self.uefi:
+            return "BIOS (Legacy)"
+        return "BIOS or UEFI"
+
+    @property
+    def partition_scheme(self):
+        return "GPT" if self.target_system == "UEFI" else "MBR"
+
+    def to_dict(self):
+        data = {name: getattr(self, name) for name in self.__slots__}
+        data['entries'] = [entry.to_dict() for entry in self.entries]
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        """Rebuild a cached profile, None if it was written by an older version"""
+        if any(name not in data for name in cls.__slots__):
+            return None
+        try:
+            entries = [BootEntry.from_dict(entry) for entry in data['entries']]
+        except KeyError:
+            return None
+        return cls(data['kind'], data['loader'], data['bios'], data['uefi'], data['hybrid'], entries)
+
+    def __repr__(self):
+        return (f"BootProfile(kind={self.kind!r}, loader={self.loader!r}, bios={self.bios}, "
+                f"uefi={self.uefi}, hybrid={self.hybrid})")
+
+
+# Loader files that identify the boot method, first match wins
+BOOT_LOADERS = (
+    ('windows', 'bootmgr'),
+    ('windows', 'bootmgr.efi'),
+    ('isolinux', 'isolinux/isolinux.bin'),
+    ('isolinux', 'boot/isolinux/isolinux.bin'),
+    ('isolinux', 'syslinux/isolinux.bin'),
+    ('isolinux', 'isolinux.bin'),
+    ('grub', 'boot/grub/i386-pc/eltorito.img'),
+    ('grub', 'boot/grub/grub.cfg'),
+    ('grub', 'boot/grub2/grub.cfg'),
+    ('grub', 'efi/boot/grub.cfg'),
+)
+
+# Removable media fallback loaders of UEFI firmware
+EFI_LOADERS = ('efi/boot/bootx64.efi', 'efi/boot/bootia32.efi', 'efi/boot/bootaa64.efi')
+
+
+def detect_partition_table(system_area):
+    """Detect an MBR or GPT partition table in the first sectors of an image"""
+    if len(system_area) < 512 or system_area[510:512] != b'\x55\xAA':
+        return None
+
+    # GPT header lives in LBA 1 behind a protective MBR
+    if system_area[512:520] == b'EFI PART':
+        return 'gpt'
+
+    for index in range(4):
+        entry = system_area[446 + 16 * index:446 + 16 * (index + 1)]
+        # Boot indicator must be 0x00 or 0x80 and the type must be set
+        if entry[0] in (0x00, 0x80) and entry[4] != 0:
+            if entry[4] == 0xEE and system_area[4096:4104] == b'EFI PART':
+                # 4K sector GPT
+                return 'gpt'
+            return 'mbr'
+
+    return None
+
+
+class ISOProbe:
+    """Everything known about an ISO from its system area and volume descriptor set"""
+    __slots__ = ('size', 'valid', 'bootable', 'volume_name', 'creation_date',
+                 'joliet', 'udf', 'boot_catalog_lba', 'partition_table')
+
+    def __init__(self, size=0, valid=False, bootable=False, volume_name=None, creation_date=None,
+                 joliet=False, udf=False, boot_catalog_lba=None, partition_table=None):
+        self.size = size
+        self.valid = valid
+        self.bootable = bootable
+        self.volume_name = volume_name
+        self.creation_date = creation_date
+        self.joliet = joliet
+        self.udf = udf
+        self.boot_catalog_lba = boot_catalog_lba
+        # 'mbr' or 'gpt' when sector 0 carries a partition table
+        self.partition_table = partition_table
+
+    @property
+    def hybrid(self):
+        """Isohybrid image: an ISO 9660 file system plus an MBR/GPT for block copies"""
+        return self.valid and self.partition_table is not None
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Rebuild a cached probe, None if it was written by an older version"""
+        if any(name not in data for name in cls.__slots__):
+            return None
+        return cls(**{name: data[name] for name in cls.__slots__})
+
+    @classmethod
+    def parse(cls, data, size, system_area=b''):
+        """Parse the volume descriptor area (sector 16 onwards) and the system area before it"""
+        probe = cls(size=size)
+        probe.partition_table = detect_partition_table(system_area)
+
+        for offset in range(0, len(data) - SECTOR_SIZE + 1, SECTOR_SIZE):
+            descriptor = data[offset:offset + SECTOR_SIZE]
+            identifier = descriptor[1:6]
+
+            # UDF volume recognition sequence follows the ISO 9660 descriptors
+            if identifier in (b'NSR02', b'NSR03'):
+                probe.udf = True
+                continue
+            if identifier != b'CD001':
+                if identifier in VOLUME_DESCRIPTOR_IDS:
+                    continue
+                break
+
+            descriptor_type = descriptor[0]
+            if descriptor_type == 0:
+                # El Torito boot record
+                if b'EL TORITO SPECIFICATION' in descriptor[7:39]:
+                    probe.bootable = True
+                    probe.boot_catalog_lba = struct.unpack_from('<L', descriptor, 71)[0]
+            elif descriptor_type == 1 and not probe.valid:
+                probe.valid = True
+                # Volume identifier is at offset 40, 32 bytes long
+                probe.volume_name = descriptor[40:72].decode('ascii', errors='ignore').strip() or None
+                # Creation date is at offset 813, 17 bytes
+                probe.creation_date = descriptor[813:830].decode('ascii', errors='ignore')
+            elif descriptor_type == 2 and descriptor[88:91] in JOLIET_ESCAPES:
+                probe.joliet = True
+
+        # Alternative check for boot signature (0x55AA at end of boot sector)
+        if not probe.bootable and len(data) >= 512 and data[510:512] == b'\x55\xAA':
+            probe.bootable = True
+
+        return probe
+
+
 class ISOHandler:
+    # Sectors 16..31 hold the whole descriptor set of practically every image
+    PROBE_SECTORS = 16
+
+    # The system area (sectors 0..15) precedes the descriptor set
+    SYSTEM_AREA_SIZE = 16 * SECTOR_SIZE
+
     def __init__(self):
-        pass
+        self._catalogs = {}
+        self._probes = {}
+        self._probe_cache = MetadataCache('iso_probe.json')
+        self._boot_profiles = {}
+        self._boot_profile_cache = MetadataCache('iso_boot_profile.json')
         
+    def probe(self, iso_path):
+        """Read the volume descriptor set once and cache the result on disk"""
+        stat = os.stat(iso_path)
+        key = file_cache_key(iso_path, stat)
+
+        # In memory, then on disk: re-selecting an ISO costs no reads
+        probe = self._probes.get(key)
+        if probe is not None:
+            return probe
+
+        cached = self._probe_cache.get(key)
+        if cached is not None:
+            probe = ISOProbe.from_dict(cached)
+            if probe is not None:
+                self._probes[key] = probe
+                return probe
+
+        with open(iso_path, 'rb') as f:
+            # System area and descriptor set in one read
+            data = f.read(self.SYSTEM_AREA_SIZE + self.PROBE_SECTORS * SECTOR_SIZE)
+            system_area = data[:self.SYSTEM_AREA_SIZE]
+            data = data[self.SYSTEM_AREA_SIZE:]
+
+            # Unusually long descriptor sets continue past the first window
+            while len(data) >= SECTOR_SIZE and data[-SECTOR_SIZE + 1:-SECTOR_SIZE + 6] in VOLUME_DESCRIPTOR_IDS:
+                more = f.read(self.PROBE_SECTORS * SECTOR_SIZE)
+                if not more:
+                    break
+                data += more
+
+        probe = ISOProbe.parse(data, stat.st_size, system_area)
+        self._probes[key] = probe
+        self._probe_cache.put(key, probe.to_dict())
+        return probe
+
     def validate_iso(self, iso_path):
         """Validate if the file is a valid ISO"""
         try:
@@ -18,16 +864,7 @@ class ISOHandler:
                 return False
                 
             # Check ISO signature
-            with open(iso_path, 'rb') as f:
-                # Skip to sector 16 (ISO 9660 primary volume descriptor)
-                f.seek(16 * 2048)
-                data = f.read(6)
-                
-                # Check for ISO 9660 signature
-                if data[1:6] == b'CD001':
-                    return True
-                    
-            return False
+            return self.probe(iso_path).valid
             
         except Exception:
             return False
@@ -35,43 +872,23 @@ class ISOHandler:
     def is_bootable(self, iso_path):
         """Check if ISO is bootable"""
         try:
-            with open(iso_path, 'rb') as f:
-                # Check for El Torito boot record
-                f.seek(17 * 2048)  # Boot record volume descriptor
-                data = f.read(2048)
-                
-                # Look for El Torito signature
-                if b'EL TORITO SPECIFICATION' in data:
-                    return True
-                    
-                # Alternative check for boot signature
-                f.seek(0x8000)  # Common boot sector location
-                boot_data = f.read(512)
-                
-                # Check for boot signature (0x55AA at end of boot sector)
-                if len(boot_data) >= 512 and boot_data[510:512] == b'\x55\xAA':
-                    return True
-                    
+            return self.probe(iso_path).bootable
+            
+        except Exception:
             return False
             
+    def is_hybrid(self, iso_path):
+        """Check if the ISO is an isohybrid image meant to be written block for block"""
+        try:
+            return self.probe(iso_path).hybrid
+            
         except Exception:
             return False
             
     def get_volume_name(self, iso_path):
         """Extract volume name from ISO"""
         try:
-            with open(iso_path, 'rb') as f:
-                # Go to primary volume descriptor
-                f.seek(16 * 2048)
-                data = f.read(2048)
-                
-                # Volume identifier is at offset 40, 32 bytes long
-                if len(data) >= 72:
-                    volume_name = data[40:72].decode('ascii', errors='ignore').strip()
-                    if volume_name:
-                        return volume_name
-                        
-            return None
+            return self.probe(iso_path).volume_name
             
         except Exception:
             return None
@@ -90,32 +907,160 @@ class ISOHandler:
             if not os.path.exists(iso_path):
                 return info
                 
-            # Basic file info
-            stat = os.stat(iso_path)
-            info['size'] = stat.st_size
-            
-            # Validate ISO
-            info['valid'] = self.validate_iso(iso_path)
+            probe = self.probe(iso_path)
+            info['size'] = probe.size
+            info['valid'] = probe.valid
             if not info['valid']:
                 return info
                 
-            # Check if bootable
-            info['bootable'] = self.is_bootable(iso_path)
-            
-            # Get volume name
-            info['volume_name'] = self.get_volume_name(iso_path)
-            
-            # Get creation date from ISO
-            with open(iso_path, 'rb') as f:
-                f.seek(16 * 2048)
-                data = f.read(2048)
-                
-                # Creation date is at offset 813, 17 bytes
-                if len(data) >= 830:
-                    date_str = data[813:830].decode('ascii', errors='ignore')
-                    info['creation_date'] = date_str
+            info['bootable'] = probe.bootable
+            info['volume_name'] = probe.volume_name
+            info['creation_date'] = probe.creation_date
                     
         except Exception as e:
             print(f"Error getting ISO info: {e}")
             
-        return info
\ No newline at end of file
+        return info
+
+    def iter_entries(self, iso_path):
+        """Lazily list the files and directories of an ISO, from UDF when present"""
+        if self.probe(iso_path).udf:
+            with UDFReader(iso_path) as reader:
+                yield from reader.walk()
+            return
+
+        with open(iso_path, 'rb') as f:
+            yield from iter_iso_entries(f)
+
+    def plan_extraction(self, iso_path):
+        """Count the files, directories and bytes an extraction will write"""
+        plan = {
+            'files': 0,
+            'directories': 0,
+            'total_bytes': 0
+        }
+
+        for entry in self.iter_entries(iso_path):
+            if entry.is_dir:
+                plan['directories'] += 1
+            else:
+                plan['files'] += 1
+                plan['total_bytes'] += entry.size
+
+        return plan
+
+    def get_catalog(self, iso_path):
+        """Get the indexed catalog for an ISO, reusing it while the file is unchanged"""
+        stat = os.stat(iso_path)
+        key = (os.path.abspath(iso_path), stat.st_size, stat.st_mtime_ns)
+
+        catalog = self._catalogs.get(key)
+        if catalog is None:
+            catalog = ISOCatalog.build(iso_path)
+            self._catalogs = {key: catalog}
+
+        return catalog
+
+    def get_boot_catalog(self, iso_path):
+        """Read and parse the El Torito boot catalog, or None for non El Torito images"""
+        probe = self.probe(iso_path)
+        if not probe.boot_catalog_lba:
+            return None
+
+        with open(iso_path, 'rb') as f:
+            f.seek(probe.boot_catalog_lba * SECTOR_SIZE)
+            data = f.read(SECTOR_SIZE)
+
+        return parse_boot_catalog(data)
+
+    def get_boot_profile(self, iso_path):
+        """Classify how an ISO boots, cached on disk under the same key as the probe"""
+        key = file_cache_key(iso_path)
+
+        # The classification walks the whole catalog, re-selecting an ISO must not repeat it
+        profile = self._boot_profiles.get(key)
+        if profile is not None:
+            return profile
+
+        cached = self._boot_profile_cache.get(key)
+        if cached is not None:
+            profile = BootProfile.from_dict(cached)
+            if profile is not None:
+                self._boot_profiles[key] = profile
+                return profile
+
+        profile, complete = self._classify_boot(iso_path)
+        self._boot_profiles[key] = profile
+        # A classification cut short by a read error is not worth keeping
+        if complete:
+            self._boot_profile_cache.put(key, profile.to_dict())
+        return profile
+
+    def _classify_boot(self, iso_path):
+        """Classify how an ISO boots from its boot catalog and file catalog, and whether every read succeeded"""
+        complete = True
+        entries = []
+        try:
+            catalog_info = self.get_boot_catalog(iso_path)
+            if catalog_info:
+                entries = catalog_info[2]
+        except Exception as e:
+            print(f"Error parsing boot catalog: {e}")
+            complete = False
+
+        bootable_entries = [entry for entry in entries if entry.bootable]
+        bios = any(entry.platform_id == PLATFORM_X86 for entry in bootable_entries)
+        uefi = any(entry.is_efi for entry in bootable_entries)
+
+        # Isohybrid images carry an MBR/GPT partition table in sector 0
+        hybrid = self.probe(iso_path).hybrid
+
+        kind = None
+        loader = None
+        try:
+            catalog = self.get_catalog(iso_path)
+            for loader_kind, path in BOOT_LOADERS:
+                if path in catalog:
+                    kind = loader_kind
+                    loader = path
+                    break
+
+            # Firmware falls back to \EFI\BOOT\BOOTx64.EFI on removable media
+            if any(path in catalog for path in EFI_LOADERS):
+                uefi = True
+        except Exception as e:
+            print(f"Error reading ISO catalog: {e}")
+            complete = False
+
+        # Windows media often only lists its files in the UDF file system
+        if kind is None and self.probe(iso_path).udf:
+            try:
+                kind, loader = self._find_udf_loader(iso_path)
+            except Exception as e:
+                print(f"Error reading UDF file system: {e}")
+                complete = False
+
+        if kind is None:
+            if uefi and not bios:
+                kind = 'efi'
+            elif hybrid:
+                kind = 'hybrid'
+            else:
+                kind = 'unknown'
+
+        return BootProfile(kind, loader, bios, uefi, hybrid, entries), complete
+
+    def _find_udf_loader(self, iso_path):
+        """Look for a known boot loader in the root of the UDF file system"""
+        loaders = {path: loader_kind for loader_kind, path in BOOT_LOADERS if '/' not in path}
+
+        with UDFReader(iso_path) as reader:
+            for entry in reader.walk():
+                # Root entries come first, stop once the walk goes deeper
+                if '/' in entry.path:
+                    break
+                loader_kind = loaders.get(entry.path.lower())
+                if loader_kind is not None:
+                    return loader_kind, entry.path.lower()
+
+        return None, None
@@ -0,0 +1,278 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import threading
+
+from core.cache import file_cache_key, get_cache_dir
+from core.checksum import CHECKSUM_CHUNK_SIZE, default_hash, get_hash
+
+JOURNAL_VERSION = 1
+
+# Seconds between journal writes, work done since the last write is redone after a crash
+JOURNAL_INTERVAL = 2.0
+
+
+def flush_files(root, paths):
+    """Flush copied files to the device, with a single flush of the volume where the platform allows it"""
+    if sys.platform.startswith('win'):
+        try:
+            import win32con
+            import win32file
+
+            # Flushing a volume handle writes out every file of it, this needs administrator rights
+            drive = os.path.splitdrive(os.path.abspath(root))[0]
+            handle = win32file.CreateFile(
+                f"\\\\.\\{drive}",
+                win32con.GENERIC_WRITE,
+                win32con.FILE_SHARE_READ | win32con.FILE_SHARE_WRITE,
+                None,
+                win32con.OPEN_EXISTING,
+                0,
+                None
+            )
+            try:
+                win32file.FlushFileBuffers(handle)
+            finally:
+                handle.Close()
+            return
+        except Exception:
+            pass
+    elif hasattr(os, 'sync'):
+        os.sync()
+        return
+
+    for path in paths:
+        fd = os.open(path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class FlashJournal:
+    """Completed work of one flash, kept on the host so an interrupted run can continue
+
+    Raw writes record the byte ranges that reached the target, plus a digest of the
+    last block to check on resume that the target still holds what was written. File
+    copies record every finished file with its size, hash and target mtime. A journal
+    only matches the same source file (path, size, mtime), target, mode and options.
+    """
+
+    def __init__(self, path, header):
+        self.path = path
+        self.header = header
+        # Sorted, merged [start, end) byte ranges written to a raw target
+        self.ranges = []
+        # (offset, length, algorithm, hex digest) of the last journaled raw block
+        self.tail = None
+        # Relative path -> [size, hex digest, target mtime_ns] of copied files
+        self.files = {}
+        # Set once the target has been formatted for a file copy
+        self.formatted = False
+        # Identity of the formatted volume (its serial number), None if unknown
+        self.volume_id = None
+
+        self._lock = threading.Lock()
+        # Pool threads record files concurrently, one of them writes at a time
+        self._save_lock = threading.Lock()
+        self._last_save = 0
+        # (relative path, target path, file entry) of copied files not flushed yet
+        self._unflushed = []
+        self._checkpoint_lock = threading.Lock()
+        self._last_checkpoint = time.monotonic()
+
+    @classmethod
+    def open(cls, source_path, target, mode, options=None, journal_dir=None):
+        """Load the journal of a source/target pair, or start an empty one"""
+        header = {
+            'version': JOURNAL_VERSION,
+            'source': file_cache_key(source_path),
+            'target': target,
+            'mode': mode,
+            'options': options or {},
+        }
+        name = hashlib.sha1(f"{header['source']}|{target}|{mode}".encode('utf-8')).hexdigest()
+        path = os.path.join(journal_dir or os.path.join(get_cache_dir(), 'journals'), f"{name}.json")
+
+        journal = cls(path, header)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            # Anything else written under the same name describes a different flash
+            if data.get('header') == header:
+                journal.ranges = [list(item) for item in data.get('ranges', [])]
+                journal.tail = tuple(data['tail']) if data.get('tail') else None
+                journal.files = data.get('files', {})
+                journal.formatted = bool(data.get('formatted'))
+                journal.volume_id = data.get('volume_id')
+        except Exception:
+            pass
+        return journal
+
+    @property
+    def resumable(self):
+        return bool(self.ranges or self.files or self.formatted)
+
+    @property
+    def completed_bytes(self):
+        return sum(end - start for start, end in self.ranges)
+
+    def add_range(self, offset, length):
+        """Record a written raw byte range"""
+        if length <= 0:
+            return
+        with self._lock:
+            ranges = self.ranges + [[offset, offset + length]]
+            ranges.sort()
+            merged = []
+            for start, end in ranges:
+                if merged and start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            self.ranges = merged
+
+    def covers(self, offset, length):
+        """Check if a raw byte range was written completely"""
+        for start, end in self.ranges:
+            if start <= offset and offset + length <= end:
+                return True
+            if start > offset:
+                break
+        return False
+
+    def first_gap(self):
+        """Offset of the first byte not written yet"""
+        if self.ranges and self.ranges[0][0] == 0:
+            return self.ranges[0][1]
+        return 0
+
+    def discard(self, offset, length):
+        """Forget a raw byte range that was overwritten behind the journal's back"""
+        with self._lock:
+            kept = []
+            for start, end in self.ranges:
+                if end <= offset or start >= offset + length:
+                    kept.append([start, end])
+                    continue
+                if start < offset:
+                    kept.append([start, offset])
+                if end > offset + length:
+                    kept.append([offset + length, end])
+            self.ranges = kept
+            if self.tail and not self.covers(self.tail[0], self.tail[1]):
+                self.tail = None
+
+    def add_file(self, path, size, digest, mtime_ns):
+        """Record a copied file"""
+        with self._lock:
+            self.files[path] = [size, digest, mtime_ns]
+
+    def queue_file(self, path, target, chunks):
+        """Hash a copied file from its source data given as chunks, it is recorded at the next checkpoint"""
+        algorithm = default_hash()
+        hasher = get_hash(algorithm)()
+        size = 0
+        for chunk in chunks:
+            hasher.update(chunk)
+            size += len(chunk)
+        entry = (size, f"{algorithm}:{hasher.hexdigest()}", os.stat(target).st_mtime_ns)
+        with self._lock:
+            self._unflushed.append((path, target, entry))
+
+    def checkpoint(self, root, force=False):
+        """Flush the queued files under root to the device in one go, then record and save them
+
+        Runs at most every JOURNAL_INTERVAL seconds unless forced, so a crash redoes the
+        files of the last interval instead of paying a flush for every single file.
+        """
+        with self._checkpoint_lock:
+            now = time.monotonic()
+            if not force and now - self._last_checkpoint < JOURNAL_INTERVAL:
+                return False
+            self._last_checkpoint = now
+
+            with self._lock:
+                pending, self._unflushed = self._unflushed, []
+            if pending:
+                try:
+                    flush_files(root, [target for _, target, _ in pending])
+                except Exception as e:
+                    # Files that may not have reached the device are never recorded
+                    print(f"Error flushing {len(pending)} files for the journal: {e}")
+                    pending = []
+                for path, _, entry in pending:
+                    self.add_file(path, *entry)
+            return self.save(force=True)
+
+    def has_file(self, path, target, size):
+        """Check that a journaled file is still complete on the target"""
+        entry = self.files.get(path)
+        if entry is None or entry[0] != size:
+            return False
+        try:
+            stat = os.stat(target)
+        except OSError:
+            return False
+        if stat.st_size != size:
+            return False
+        if stat.st_mtime_ns == entry[2]:
+            return True
+
+        # Touched since it was recorded, only the content can tell
+        algorithm, _, digest = entry[1].partition(':')
+        hasher = get_hash(algorithm)()
+        with open(target, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHECKSUM_CHUNK_SIZE), b''):
+                hasher.update(chunk)
+        return hasher.hexdigest() == digest
+
+    def reset(self):
+        """Throw the recorded progress away, the next run starts from scratch"""
+        with self._lock:
+            self.ranges = []
+            self.tail = None
+            self.files = {}
+            self.formatted = False
+            self.volume_id = None
+        self.save(force=True)
+
+    def save(self, force=False):
+        """Write the journal, at most every JOURNAL_INTERVAL seconds unless forced"""
+        with self._save_lock:
+            now = time.monotonic()
+            if not force and now - self._last_save < JOURNAL_INTERVAL:
+                return False
+            self._last_save = now
+
+            with self._lock:
+                data = {
+                    'header': self.header,
+                    'ranges': self.ranges,
+                    'tail': list(self.tail) if self.tail else None,
+                    'files': dict(self.files),
+                    'formatted': self.formatted,
+                    'volume_id': self.volume_id,
+                }
+
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                temp_path = self.path + '.tmp'
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_path, self.path)
+                return True
+            except Exception as e:
+                print(f"Error writing journal {self.path}: {e}")
+                return False
+
+    def remove(self):
+        """Delete the journal once the flash completed"""
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
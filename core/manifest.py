@@ -0,0 +1,462 @@
+import os
+import json
+import time
+import random
+import threading
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from core.cache import MetadataCache, file_cache_key
+from core.checksum import default_hash, get_hash
+from core.extent_reader import ExtentReader
+from core.scheduler import DEFAULT_WORKERS, PROGRESS_INTERVAL
+from core.verifier import VERIFY_CHUNK_SIZE, VERIFY_FULL, VERIFY_QUICK, Mismatch, VerifyResult, file_pieces, read_pieces
+
+MANIFEST_VERSION = 1
+
+# File written to the root of a flashed drive
+MANIFEST_NAME = 'lahiri-manifest.json'
+
+# Data covered by one leaf, the same chunks the verifier compares
+MANIFEST_CHUNK_SIZE = VERIFY_CHUNK_SIZE
+
+
+def merkle_levels(leaves, hash_constructor):
+    """Levels of a binary hash tree, leaves first and the single root last
+
+    A node without a sibling moves up unchanged.
+    """
+    levels = [list(leaves)]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        parents = [hash_constructor(level[index] + level[index + 1]).digest()
+                   for index in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            parents.append(level[-1])
+        levels.append(parents)
+    return levels
+
+
+class Manifest:
+    """Merkle tree over the files of a flashed image
+
+    files lists [path, size] in image order, size is None for directories. Every file
+    is split into chunk_size leaves, the root hashes the tree together with the file
+    list so renames, additions and removals change it as well as content does.
+    """
+
+    def __init__(self, algorithm, chunk_size, files, leaves, source=None, options=None):
+        self.algorithm = algorithm
+        self.chunk_size = chunk_size
+        self.files = [list(item) for item in files]
+        self.leaves = list(leaves)
+        # Name and size of the image the manifest was built from, informational
+        self.source = source or {}
+        # Flash options the drive was prepared with
+        self.options = options or {}
+
+        self._hash = get_hash(algorithm)
+        self.levels = merkle_levels(self.leaves, self._hash)
+
+        # First leaf of every file with data, to map a leaf back to a file and offset
+        self._starts = []
+        self._spans = []
+        first = 0
+        for path, size in self.files:
+            if not size:
+                continue
+            count = -(-size // chunk_size)
+            self._starts.append(first)
+            self._spans.append((path, size))
+            first += count
+        if first != len(self.leaves):
+            raise Exception(f"Manifest has {len(self.leaves)} leaves, its files need {first}")
+
+    @property
+    def layout_digest(self):
+        return self._hash(json.dumps(self.files, separators=(',', ':')).encode('utf-8')).digest()
+
+    @property
+    def root(self):
+        tree = self.levels[-1][0] if self.leaves else b''
+        return self._hash(tree + self.layout_digest).hexdigest()
+
+    def locate(self, index):
+        """(path, offset, length) of the data covered by a leaf"""
+        slot = bisect_right(self._starts, index) - 1
+        path, size = self._spans[slot]
+        offset = (index - self._starts[slot]) * self.chunk_size
+        return path, offset, min(self.chunk_size, size - offset)
+
+    def diff(self, other):
+        """Indices of the leaves that differ from another manifest of the same file list
+
+        Walks down from the root into differing subtrees only, so a few damaged chunks
+        are found in a logarithmic number of comparisons. Returns None when the
+        manifests describe different files and cannot be compared leaf by leaf.
+        """
+        if (self.algorithm != other.algorithm or self.chunk_size != other.chunk_size
+                or self.files != other.files):
+            return None
+        if self.root == other.root:
+            return []
+
+        differing = []
+        top = len(self.levels) - 1
+        pending = [(top, 0)] if self.leaves else []
+        while pending:
+            level, index = pending.pop()
+            if self.levels[level][index] == other.levels[level][index]:
+                continue
+            if level == 0:
+                differing.append(index)
+                continue
+            for child in (index * 2 + 1, index * 2):
+                if child < len(self.levels[level - 1]):
+                    pending.append((level - 1, child))
+        return sorted(differing)
+
+    def to_dict(self):
+        return {
+            'version': MANIFEST_VERSION,
+            'algorithm': self.algorithm,
+            'chunk_size': self.chunk_size,
+            'source': self.source,
+            'options': self.options,
+            'root': self.root,
+            'files': self.files,
+            'leaves': [leaf.hex() for leaf in self.leaves],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        if data.get('version') != MANIFEST_VERSION:
+            raise Exception(f"Unsupported manifest version: {data.get('version')}")
+        manifest = cls(data['algorithm'], data['chunk_size'], data['files'],
+                       [bytes.fromhex(leaf) for leaf in data['leaves']], data.get('source'), data.get('options'))
+        # A root that does not match its own leaves means the manifest file itself is damaged
+        if manifest.root != data.get('root'):
+            raise Exception("Manifest root does not match its leaves")
+        return manifest
+
+
+def _report(progress_callback, done_bytes, total_bytes, state, force=False):
+    if not progress_callback:
+        return
+    now = time.monotonic()
+    if force or now - state[0] >= PROGRESS_INTERVAL:
+        state[0] = now
+        progress_callback(done_bytes, total_bytes)
+
+
+def _hash_chunks(chunks, hash_constructor, workers, progress_callback, total_bytes):
+    """Digests of (key, read function) chunks in order, read on the calling thread and hashed by a pool"""
+    digests = []
+    pending = deque()
+    done_bytes = 0
+    last_report = [0]
+
+    def digest(key, data):
+        return key, hash_constructor(data).digest(), len(data)
+
+    def collect(future):
+        nonlocal done_bytes
+        key, value, length = future.result()
+        digests.append((key, value))
+        done_bytes += length
+        _report(progress_callback, done_bytes, total_bytes, last_report)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='manifest') as executor:
+        for key, read in chunks:
+            pending.append(executor.submit(digest, key, read()))
+            while len(pending) > workers * 2:
+                collect(pending.popleft())
+        while pending:
+            collect(pending.popleft())
+
+    _report(progress_callback, done_bytes, total_bytes, last_report, force=True)
+    return digests
+
+
+class _FileLeaves:
+    """Leaves of one file, fed its data in file order"""
+
+    def __init__(self, hasher, path):
+        self._owner = hasher
+        self.path = path
+        self.leaves = []
+        self._hash = hasher.hash_constructor()
+        self._filled = 0
+
+    def update(self, data):
+        chunk_size = self._owner.chunk_size
+        view = memoryview(data).cast('B')
+        try:
+            position = 0
+            while position < len(view):
+                take = min(len(view) - position, chunk_size - self._filled)
+                self._hash.update(view[position:position + take])
+                self._filled += take
+                position += take
+                if self._filled == chunk_size:
+                    self.leaves.append(self._hash.digest())
+                    self._hash = self._owner.hash_constructor()
+                    self._filled = 0
+        finally:
+            view.release()
+
+    def zeros(self, length):
+        while length > 0:
+            size = min(length, len(self._owner.zero_chunk))
+            self.update(self._owner.zero_chunk[:size])
+            length -= size
+
+    def close(self):
+        if self._filled:
+            self.leaves.append(self._hash.digest())
+        self._owner.add(self.path, self.leaves)
+
+
+class LeafHasher:
+    """Manifest leaves of files hashed while they are written, so the manifest needs no read of the image
+
+    Writers feed each file's data in file order through file(path), or hand over
+    complete files to add_file(). Files that were not streamed (resumed, written in
+    pieces or copied by xcopy) are hashed from the image when the manifest is built.
+    """
+
+    def __init__(self, algorithm=None, chunk_size=MANIFEST_CHUNK_SIZE):
+        self.algorithm = algorithm or default_hash()
+        self.chunk_size = chunk_size
+        self.hash_constructor = get_hash(self.algorithm)
+        self.zero_chunk = memoryview(bytes(chunk_size))
+        # Image path -> leaf digests
+        self.files = {}
+        self._lock = threading.Lock()
+
+    def file(self, path):
+        return _FileLeaves(self, path)
+
+    def add_file(self, path, chunks):
+        """Hash a file given as data chunks in file order"""
+        leaves = self.file(path)
+        for chunk in chunks:
+            leaves.update(chunk)
+        leaves.close()
+
+    def add(self, path, leaves):
+        with self._lock:
+            self.files[path] = leaves
+
+    def manifest(self, iso_path, entries, workers=DEFAULT_WORKERS, progress_callback=None):
+        """Manifest of the image, only files without streamed leaves are read from it"""
+        return build_manifest(iso_path, entries, self.algorithm, self.chunk_size, workers, progress_callback,
+                              known=self.files)
+
+
+def build_manifest(iso_path, entries, algorithm=None, chunk_size=MANIFEST_CHUNK_SIZE,
+                   workers=DEFAULT_WORKERS, progress_callback=None, known=None):
+    """Hash the files of an image (ISOEntry/UDFEntry list) into a Manifest
+
+    known maps image paths to leaves hashed already (LeafHasher.files), those files are not read.
+    """
+    algorithm = algorithm or default_hash()
+    hash_constructor = get_hash(algorithm)
+    known = known or {}
+    entries = list(entries)
+    files = [[entry.path, None if entry.is_dir else entry.size] for entry in entries]
+
+    # Leaves that do not cover their file were streamed incompletely
+    missing = [entry for entry in entries if not entry.is_dir and entry.size
+               and len(known.get(entry.path, ())) != -(-entry.size // chunk_size)]
+    total_bytes = sum(entry.size for entry in missing)
+
+    hashed = {}
+    if missing:
+        with open(iso_path, 'rb') as iso_file, ExtentReader(iso_file) as reader:
+            def chunks():
+                for entry in missing:
+                    pieces = file_pieces(entry)
+                    for offset in range(0, entry.size, chunk_size):
+                        size = min(chunk_size, entry.size - offset)
+                        yield entry.path, lambda pieces=pieces, offset=offset, size=size: read_pieces(
+                            reader, pieces, offset, size)
+
+            for path, value in _hash_chunks(chunks(), hash_constructor, workers, progress_callback, total_bytes):
+                hashed.setdefault(path, []).append(value)
+
+    leaves = []
+    for entry in entries:
+        if not entry.is_dir and entry.size:
+            leaves.extend(hashed[entry.path] if entry.path in hashed else known[entry.path])
+
+    source = {'name': os.path.basename(iso_path), 'size': os.path.getsize(iso_path)}
+    return Manifest(algorithm, chunk_size, files, leaves, source)
+
+
+_manifest_cache = MetadataCache('manifests.json', max_entries=32)
+
+
+def _manifest_key(iso_path, algorithm, chunk_size):
+    return f"{file_cache_key(iso_path)}|{algorithm}|{chunk_size}"
+
+
+def cache_image_manifest(iso_path, manifest):
+    """Keep a manifest built while flashing, later lookups of the image then hash nothing"""
+    _manifest_cache.put(_manifest_key(iso_path, manifest.algorithm, manifest.chunk_size), manifest.to_dict())
+
+
+def cached_image_manifest(iso_path, algorithm=None, chunk_size=MANIFEST_CHUNK_SIZE):
+    """Manifest of an image from the cache, None when it was not hashed yet"""
+    cached = _manifest_cache.get(_manifest_key(iso_path, algorithm or default_hash(), chunk_size))
+    if cached is not None:
+        try:
+            return Manifest.from_dict(cached)
+        except Exception:
+            pass
+    return None
+
+
+def get_image_manifest(iso_path, entries, algorithm=None, chunk_size=MANIFEST_CHUNK_SIZE,
+                       workers=DEFAULT_WORKERS, progress_callback=None):
+    """Manifest of an image, cached by path, size and modification time
+
+    entries is a callable returning the image's entries, only called on a cache miss.
+    """
+    algorithm = algorithm or default_hash()
+    manifest = cached_image_manifest(iso_path, algorithm, chunk_size)
+    if manifest is not None:
+        return manifest
+
+    manifest = build_manifest(iso_path, entries(), algorithm, chunk_size, workers, progress_callback)
+    cache_image_manifest(iso_path, manifest)
+    return manifest
+
+
+def read_manifest(target_root):
+    """Load the manifest stored on a drive, None when it has none or it is damaged"""
+    try:
+        with open(os.path.join(target_root, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+            return Manifest.from_dict(json.load(f))
+    except Exception:
+        return None
+
+
+def write_manifest(manifest, target_root):
+    """Store a manifest on a drive, replacing the previous one only once the new one is complete"""
+    path = os.path.join(target_root, MANIFEST_NAME)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest.to_dict(), f, separators=(',', ':'))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def files_present(manifest, target_root):
+    """Check by size alone that every file of a manifest exists on the drive"""
+    for path, size in manifest.files:
+        target = os.path.join(target_root, *path.split('/'))
+        if size is None:
+            if not os.path.isdir(target):
+                return False
+        elif not os.path.isfile(target) or os.path.getsize(target) != size:
+            return False
+    return True
+
+
+def check_target(manifest, target_root, mode=VERIFY_FULL, coverage=1.0, workers=DEFAULT_WORKERS,
+                 progress_callback=None, seed=None):
+    """Hash the files on a drive against a manifest, only the drive is read, see check_files"""
+    result = VerifyResult(mode, manifest.algorithm)
+    readable = []
+    started = time.perf_counter()
+
+    for path, size in manifest.files:
+        target = os.path.join(target_root, *path.split('/'))
+        if size is None:
+            if not os.path.isdir(target):
+                result.mismatches.append(Mismatch(path, 0, 0, 'missing'))
+        elif not os.path.isfile(target):
+            result.mismatches.append(Mismatch(path, 0, size, 'missing'))
+        elif os.path.getsize(target) != size:
+            result.mismatches.append(Mismatch(path, 0, size, 'size'))
+        elif size:
+            readable.append((path, size))
+        if size:
+            result.total_bytes += size
+
+    def read_file(path, offset, length):
+        return _read_at(os.path.join(target_root, *path.split('/')), offset, length)
+
+    check_files(manifest, read_file, mode, coverage, workers, progress_callback, seed, readable, result)
+    result.seconds = time.perf_counter() - started
+    return result
+
+
+def check_files(manifest, read_file, mode=VERIFY_FULL, coverage=1.0, workers=DEFAULT_WORKERS,
+                progress_callback=None, seed=None, files=None, result=None):
+    """Hash file data against a manifest, read_file(path, offset, length) returns it from wherever the files are
+
+    files lists the (path, size) to read, by default every file of the manifest with
+    data. Quick mode hashes a random sample of the leaves (always the first and last
+    one). The hashed leaves form a manifest of the target, diffing it against the
+    expected one locates the damaged chunks, which end up as the mismatches of the
+    VerifyResult, result when given.
+    """
+    hash_constructor = get_hash(manifest.algorithm)
+    if files is None:
+        files = [(path, size) for path, size in manifest.files if size]
+    if result is None:
+        result = VerifyResult(mode, manifest.algorithm)
+        result.total_bytes = sum(size for _, size in files)
+    sample = random.Random(seed)
+    started = time.perf_counter()
+
+    index = {}
+    first = 0
+    for path, size in manifest.files:
+        if size:
+            index[path] = first
+            first += -(-size // manifest.chunk_size)
+
+    def sampled(leaf):
+        if mode != VERIFY_QUICK or leaf in (0, len(manifest.leaves) - 1):
+            return True
+        return sample.random() < coverage
+
+    def chunks():
+        for path, size in files:
+            for offset in range(0, size, manifest.chunk_size):
+                leaf = index[path] + offset // manifest.chunk_size
+                if sampled(leaf):
+                    length = min(manifest.chunk_size, size - offset)
+                    yield leaf, lambda path=path, offset=offset, length=length: read_file(path, offset, length)
+
+    # Leaves that were not read (unsampled, missing or resized files) keep the expected digest
+    leaves = list(manifest.leaves)
+    for leaf, digest in _hash_chunks(chunks(), hash_constructor, workers, progress_callback, result.total_bytes):
+        result.checked_bytes += manifest.locate(leaf)[2]
+        leaves[leaf] = digest
+
+    found = Manifest(manifest.algorithm, manifest.chunk_size, manifest.files, leaves)
+    for leaf in manifest.diff(found):
+        result.mismatches.append(Mismatch(*manifest.locate(leaf)))
+
+    result.seconds += time.perf_counter() - started
+    return result
+
+
+def _read_at(path, offset, size):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+def remove_manifest(target_root):
+    """Delete the manifest of a drive before its files are changed"""
+    try:
+        os.remove(os.path.join(target_root, MANIFEST_NAME))
+    except OSError:
+        pass
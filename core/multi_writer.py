@@ -0,0 +1,438 @@
+import os
+import mmap
+import time
+import threading
+from collections import deque
+
+from core.checksum import get_hash
+from core.disk_image import hole_ranges, merge_ranges
+from core.raw_writer import (
+    DEFAULT_BLOCK_SIZE, DEFAULT_QUEUE_DEPTH, MAX_BLOCK_SIZE, MIN_BLOCK_SIZE,
+    aligned_buffer, discard_target, get_sector_sizes, open_target, zero_range
+)
+from core.scheduler import PROGRESS_INTERVAL
+
+# How far a target may fall behind the fastest one before it is detached
+DEFAULT_MAX_LAG = 128 * 1024 * 1024
+
+
+class TargetState:
+    """Progress and outcome of one target of a multi target write"""
+
+    def __init__(self, path):
+        self.path = path
+        self.total_bytes = 0
+        self.written_bytes = 0
+        self.seconds = 0.0
+        self.direct_active = False
+        self.sector_size = mmap.PAGESIZE
+        # Ring blocks written while attached
+        self.blocks = 0
+        # End of the data written so far, where a detached target resumes
+        self.position = 0
+        self.attached = False
+        # Fell more than the allowed lag behind and finished reading the source on its own
+        self.detached = False
+        self.finished = False
+        self.error = None
+        # Holes of a sparse image read back as zeros after a discard, otherwise they are zeroed
+        self.discarded = False
+        self.zeroed_bytes = 0
+        self._detach = False
+        self._fd = None
+        self._offset = 0
+        self._holes = deque()
+        self._zero_buffer = None
+
+    @property
+    def ok(self):
+        return self.finished and self.error is None
+
+    @property
+    def progress(self):
+        return self.written_bytes / self.total_bytes if self.total_bytes > 0 else 0.0
+
+    def __str__(self):
+        if self.error is not None:
+            status = f"failed: {self.error}"
+        elif self.finished:
+            status = "done"
+        else:
+            status = f"{self.progress:.0%}"
+        throughput = self.written_bytes / self.seconds / 1e6 if self.seconds > 0 else 0.0
+        detached = ", detached" if self.detached else ""
+        return f"{self.path}: {status}, {self.written_bytes / 1e6:.1f} MB at {throughput:.1f} MB/s{detached}"
+
+
+class MultiTargetWriter:
+    """Write one image to many targets while reading the source once
+
+    A single reader fills a ring of page aligned blocks and every target has its own
+    writer thread draining it. The reader only waits for the slowest attached target,
+    and only until that target is max_lag bytes behind the fastest one: then it is
+    detached, opens the source again and finishes on its own from where it stopped.
+    A failing target records its error and leaves the ring without stopping the others.
+
+    open_source is called without arguments and returns a stream or disk image as
+    accepted by RawBlockWriter; it is called again for every detached target.
+
+    Holes of sparse images are discarded like RawBlockWriter does, and zeroed by the
+    writer of every target that could not be discarded.
+    """
+
+    def __init__(self, target_paths, open_source, block_size=DEFAULT_BLOCK_SIZE, max_lag=DEFAULT_MAX_LAG,
+                 read_ahead=DEFAULT_QUEUE_DEPTH, direct=False, progress_callback=None, hash_algorithm=None):
+        if not MIN_BLOCK_SIZE <= block_size <= MAX_BLOCK_SIZE:
+            raise Exception(f"Block size must be between {MIN_BLOCK_SIZE} and {MAX_BLOCK_SIZE} bytes")
+        if not target_paths:
+            raise Exception("No targets to write to")
+
+        self.targets = [TargetState(path) for path in target_paths]
+        self.open_source = open_source
+        self.block_size = block_size
+        self.max_lag = max_lag
+        self.read_ahead = max(1, read_ahead)
+        self.direct = direct
+        # Called from the calling thread with the list of TargetState objects
+        self.progress_callback = progress_callback
+        self.hash_algorithm = hash_algorithm
+        self._hash = get_hash(hash_algorithm) if hash_algorithm else None
+
+        self.image_size = None
+        # Ranges of a sparse image that are not transferred, for the verification pass
+        self.hole_ranges = []
+        self.total_bytes = 0
+        self.read_bytes = 0
+        self.elapsed = 0.0
+        self.digest = None
+        # (offset, length, digest) of every block, complete unless every target got detached
+        self.block_digests = []
+        self.digests_complete = False
+
+        self._cond = threading.Condition()
+        self._ring = []
+        self._slots = []
+        self._produced = 0
+        self._eof = False
+        self._error = None
+        self._last_report = 0
+
+    @property
+    def lag_blocks(self):
+        return max(1, -(-self.max_lag // self.block_size))
+
+    def write(self):
+        """Write the image to every target, returns the TargetState list
+
+        Errors are reported per target, this only raises when the source cannot be read.
+        """
+        started = time.perf_counter()
+        source = self.open_source()
+        try:
+            self.image_size = source.size
+            extents = source.extents() if hasattr(source, 'extents') else None
+
+            alignment = mmap.PAGESIZE
+            for state in self.targets:
+                try:
+                    state._fd, state.direct_active = open_target(state.path, self.direct)
+                    state.sector_size = get_sector_sizes(state._fd)[1]
+                    alignment = max(alignment, state.sector_size)
+                    state.attached = True
+                except Exception as e:
+                    state.error = e
+
+            # Whole physical sectors of every target keep every write aligned
+            block_size = -(-self.block_size // alignment) * alignment
+            if extents is not None:
+                ranges = merge_ranges(extents, alignment, limit=self.image_size)
+                self.hole_ranges = hole_ranges(ranges, self.image_size)
+                blocks = self._plan(ranges, block_size)
+                self.total_bytes = sum(length for _, length in blocks)
+            else:
+                blocks = None
+                self.hole_ranges = []
+                self.total_bytes = source.size or 0
+
+            for state in self.targets:
+                state.total_bytes = self.total_bytes
+                if state.attached and extents is not None:
+                    # Holes of sparse images read back as zeros where the device supports it
+                    state.discarded = discard_target(state._fd, self.image_size)
+                    if not state.discarded and self.hole_ranges:
+                        state._holes = deque(self.hole_ranges)
+                        state._zero_buffer = aligned_buffer(block_size)
+
+            ring_size = self.lag_blocks + self.read_ahead
+            self._ring = [aligned_buffer(block_size) for _ in range(ring_size)]
+            self._slots = [None] * ring_size
+            self._produced = 0
+            self._eof = False
+            running_hash = self._hash() if self._hash is not None else None
+
+            threads = [threading.Thread(target=self._read_loop, args=(source, blocks, running_hash),
+                                        name='multi-reader', daemon=True)]
+            for index, state in enumerate(self.targets):
+                if state.attached:
+                    threads.append(threading.Thread(target=self._write_loop, args=(state, blocks, block_size),
+                                                    name=f'multi-writer-{index}', daemon=True))
+            for thread in threads:
+                thread.start()
+
+            # Progress is reported from the calling thread only
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(PROGRESS_INTERVAL)
+                    self._report()
+
+            self.digest = running_hash.hexdigest() if running_hash is not None and self.digests_complete else None
+            if self._error is not None and not any(state.ok for state in self.targets):
+                raise self._error
+
+        finally:
+            source.close()
+            for state in self.targets:
+                if state._fd is not None:
+                    os.close(state._fd)
+                    state._fd = None
+                if state._zero_buffer is not None:
+                    state._zero_buffer.close()
+                    state._zero_buffer = None
+            for buffer in self._ring:
+                buffer.close()
+            self._ring = []
+
+        for state in self.targets:
+            # Image files end where the image does, not on the padded sector
+            if state.ok and os.path.isfile(state.path):
+                os.truncate(state.path, self.image_size if extents is not None else state.position)
+
+        self.elapsed = time.perf_counter() - started
+        self._report(force=True)
+        return self.targets
+
+    def _plan(self, ranges, block_size):
+        """(offset, length) blocks covering the allocated ranges of a disk image"""
+        blocks = []
+        for start, length in ranges:
+            for offset in range(start, start + length, block_size):
+                blocks.append((offset, min(block_size, start + length - offset)))
+        return blocks
+
+    def _fill(self, source, buffer, block, position):
+        """Read the next block into buffer, returns (offset, length) with length 0 at the end"""
+        view = memoryview(buffer)
+        try:
+            if block is not None:
+                offset, length = block
+                filled = source.readinto_at(offset, view[:length])
+                if filled != length:
+                    raise Exception(f"Unexpected end of image at offset {offset + filled}")
+                return offset, length
+
+            readinto = getattr(source, 'readinto', None)
+            filled = 0
+            while filled < len(view):
+                if readinto is not None:
+                    count = readinto(view[filled:])
+                else:
+                    data = source.read(len(view) - filled)
+                    count = len(data)
+                    view[filled:filled + count] = data
+                if not count:
+                    break
+                filled += count
+            return position, filled
+        finally:
+            view.release()
+
+    def _read_loop(self, source, blocks, running_hash):
+        ring_size = len(self._ring)
+        sequence = 0
+        position = 0
+        try:
+            while True:
+                with self._cond:
+                    if not self._wait_for_slot(sequence, ring_size):
+                        # Every target left the ring, the detached ones read on their own
+                        return
+
+                if blocks is not None and sequence >= len(blocks):
+                    offset, length = position, 0
+                else:
+                    block = blocks[sequence] if blocks is not None else None
+                    offset, length = self._fill(source, self._ring[sequence % ring_size], block, position)
+
+                if not length:
+                    with self._cond:
+                        self._eof = True
+                        self.digests_complete = True
+                        self._cond.notify_all()
+                    return
+
+                buffer = self._ring[sequence % ring_size]
+                if running_hash is not None:
+                    view = memoryview(buffer)[:length]
+                    try:
+                        running_hash.update(view)
+                        self.block_digests.append((offset, length, self._hash(view).digest()))
+                    finally:
+                        view.release()
+
+                # Zero the tail of a short block up to a whole sector once, for every writer
+                buffer[length:] = bytes(len(buffer) - length)
+
+                self.read_bytes += length
+                position = offset + length
+                with self._cond:
+                    self._slots[sequence % ring_size] = (offset, length)
+                    self._produced = sequence + 1
+                    self._cond.notify_all()
+                sequence += 1
+
+        except Exception as e:
+            with self._cond:
+                self._error = e
+                for state in self.targets:
+                    if state.attached:
+                        state.error = e
+                        state.attached = False
+                self._cond.notify_all()
+
+    def _wait_for_slot(self, sequence, ring_size):
+        """Wait until no attached target still needs the ring slot of sequence, detaching laggards
+
+        Called with the condition held, returns False once no target is attached.
+        """
+        while True:
+            attached = [state for state in self.targets if state.attached]
+            if not attached:
+                return False
+
+            # The slot last held block sequence - ring_size
+            holders = [state for state in attached if state.blocks <= sequence - ring_size]
+            if not holders:
+                return True
+
+            leader = max(state.blocks for state in attached)
+            for state in holders:
+                if leader - state.blocks >= self.lag_blocks:
+                    # Leaves the ring once the block it is writing is done
+                    state._detach = True
+            self._cond.wait(PROGRESS_INTERVAL)
+
+    def _write_loop(self, state, blocks, block_size):
+        ring_size = len(self._ring)
+        started = time.perf_counter()
+        sequence = 0
+        try:
+            while True:
+                with self._cond:
+                    while (not state._detach and sequence >= self._produced
+                           and not self._eof and state.attached):
+                        self._cond.wait(PROGRESS_INTERVAL)
+                    if not state.attached:
+                        # The reader failed
+                        return
+                    if state._detach:
+                        state.attached = False
+                        state.detached = True
+                        self._cond.notify_all()
+                        break
+                    if sequence >= self._produced:
+                        break
+                    offset, length = self._slots[sequence % ring_size]
+
+                self._write_block(state, self._ring[sequence % ring_size], offset, length)
+                sequence += 1
+                with self._cond:
+                    state.blocks = sequence
+                    self._cond.notify_all()
+
+            if state.detached:
+                self._finish_alone(state, blocks, block_size)
+
+            self._zero_holes(state, None)
+            os.fsync(state._fd)
+            state.finished = True
+
+        except Exception as e:
+            with self._cond:
+                state.error = e
+                state.attached = False
+                self._cond.notify_all()
+        finally:
+            state.seconds = time.perf_counter() - started
+
+    def _write_block(self, state, buffer, offset, length):
+        # Short blocks were zero padded by the reader, write whole sectors
+        padded = min(len(buffer), -(-length // state.sector_size) * state.sector_size)
+        self._zero_holes(state, offset)
+        if offset != state._offset:
+            # Positional seek over a hole of a sparse source
+            os.lseek(state._fd, offset, os.SEEK_SET)
+
+        view = memoryview(buffer)
+        try:
+            written = 0
+            while written < padded:
+                written += os.write(state._fd, view[written:padded])
+        finally:
+            view.release()
+
+        state._offset = offset + padded
+        state.position = offset + length
+        state.written_bytes += length
+
+    def _zero_holes(self, state, before):
+        """Zero the holes of a target that was not discarded in front of offset before, all of them for None"""
+        while state._holes and (before is None or state._holes[0][0] < before):
+            offset, length = state._holes.popleft()
+            # Only a trailing hole can end off a sector boundary, its padding is truncated from image files
+            padded = -(-length // state.sector_size) * state.sector_size
+            zero_range(state._fd, offset, padded, state._zero_buffer)
+            state.zeroed_bytes += length
+            state._offset = offset + padded
+
+    def _finish_alone(self, state, blocks, block_size):
+        """Read the rest of the image from a source of its own, no longer held back by or holding back the ring"""
+        resume = state.position
+        source = self.open_source()
+        buffer = aligned_buffer(block_size)
+        try:
+            if blocks is not None:
+                for block in blocks:
+                    if block[0] < resume:
+                        continue
+                    offset, length = self._fill(source, buffer, block, resume)
+                    buffer[length:] = bytes(len(buffer) - length)
+                    self._write_block(state, buffer, offset, length)
+                return
+
+            # Sequential sources are decoded again up to where the target stopped
+            skipped = 0
+            while skipped < resume:
+                data = source.read(min(block_size, resume - skipped))
+                if not data:
+                    raise Exception("Source ended before the resume point")
+                skipped += len(data)
+
+            position = resume
+            while True:
+                offset, length = self._fill(source, buffer, None, position)
+                if not length:
+                    return
+                buffer[length:] = bytes(len(buffer) - length)
+                self._write_block(state, buffer, offset, length)
+                position = offset + length
+        finally:
+            buffer.close()
+            source.close()
+
+    def _report(self, force=False):
+        if not self.progress_callback:
+            return
+        now = time.monotonic()
+        if force or now - self._last_report >= PROGRESS_INTERVAL:
+            self._last_report = now
+            self.progress_callback(self.targets)
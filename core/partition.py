@@ -0,0 +1,417 @@
+import os
+import sys
+import stat
+import uuid
+import zlib
+import struct
+
+from core.raw_writer import get_sector_sizes
+
+# Partitions start on a 1 MiB boundary, like diskpart and every current partitioner
+PARTITION_ALIGNMENT = 1024 * 1024
+
+MBR_SIGNATURE = b'\x55\xAA'
+MBR_BOOT_CODE_SIZE = 440
+MBR_ACTIVE = 0x80
+MBR_PROTECTIVE = 0xEE
+# Boot code that loads the boot sector of the active partition, like the MBR diskpart writes
+MBR_LOADER_PATH = os.path.join('res', 'boot', 'Syslinux 6.04.bin')
+# Largest partition an MBR entry can describe, in sectors
+MBR_MAX_SECTORS = 0xFFFFFFFF
+
+# MBR partition type per file system
+MBR_TYPES = {
+    'FAT32': 0x0C,
+    'NTFS': 0x07,
+    'exFAT': 0x07,
+    'UDF': 0x07,
+    'ext2': 0x83,
+    'ext3': 0x83,
+    'ext4': 0x83,
+}
+
+GPT_SIGNATURE = b'EFI PART'
+GPT_REVISION = 0x00010000
+GPT_HEADER_SIZE = 92
+GPT_ENTRY_COUNT = 128
+GPT_ENTRY_SIZE = 128
+
+GPT_BASIC_DATA = 'EBD0A0A2-B9E5-4433-87C0-68B6B72699C7'
+GPT_EFI_SYSTEM = 'C12A7328-F81F-11D2-BA4B-00A0C93EC93B'
+GPT_LINUX_DATA = '0FC63DAF-8483-4772-8E79-3D69D8477DE4'
+
+# GPT partition type per file system
+GPT_TYPES = {
+    'FAT32': GPT_BASIC_DATA,
+    'NTFS': GPT_BASIC_DATA,
+    'exFAT': GPT_BASIC_DATA,
+    'UDF': GPT_BASIC_DATA,
+    'ext2': GPT_LINUX_DATA,
+    'ext3': GPT_LINUX_DATA,
+    'ext4': GPT_LINUX_DATA,
+}
+
+# Linux block device ioctl asking the kernel to read the new table
+BLKRRPART = 0x125F
+
+# Windows disk ioctls
+IOCTL_DISK_GET_LENGTH_INFO = 0x7405C
+IOCTL_DISK_UPDATE_PROPERTIES = 0x70140
+
+
+class Partition:
+    """One partition of a table, positions in logical sectors"""
+
+    def __init__(self, start_lba, sectors, type_id, bootable=False, name='', guid=None, sector_size=512):
+        self.start_lba = start_lba
+        self.sectors = sectors
+        # MBR type byte or GPT type GUID string
+        self.type_id = type_id
+        self.bootable = bootable
+        self.name = name
+        # Unique partition GUID, GPT only
+        self.guid = guid
+        self.sector_size = sector_size
+
+    @property
+    def end_lba(self):
+        """Last sector of the partition, inclusive"""
+        return self.start_lba + self.sectors - 1
+
+    @property
+    def offset(self):
+        """Byte offset of the partition on the disk"""
+        return self.start_lba * self.sector_size
+
+    @property
+    def size(self):
+        return self.sectors * self.sector_size
+
+    def __repr__(self):
+        type_id = f"{self.type_id:#04x}" if isinstance(self.type_id, int) else self.type_id
+        return f"Partition(start_lba={self.start_lba}, sectors={self.sectors}, type={type_id}, bootable={self.bootable})"
+
+
+def gpt_entry_sectors(sector_size):
+    return GPT_ENTRY_COUNT * GPT_ENTRY_SIZE // sector_size
+
+
+def _chs(lba):
+    """CHS address of a sector for 255 heads and 63 sectors per track, saturating past cylinder 1023"""
+    cylinder, remainder = divmod(lba, 255 * 63)
+    if cylinder > 1023:
+        return b'\xFE\xFF\xFF'
+    head, sector = divmod(remainder, 63)
+    return bytes([head, ((cylinder >> 2) & 0xC0) | (sector + 1), cylinder & 0xFF])
+
+
+def _mbr_entry(status, type_id, start_lba, sectors):
+    return (bytes([status]) + _chs(start_lba) + bytes([type_id]) + _chs(start_lba + sectors - 1)
+            + struct.pack('<II', start_lba, sectors))
+
+
+def build_mbr(partitions, boot_code=None, disk_signature=None):
+    """Sector 0 with up to four primary partitions"""
+    if len(partitions) > 4:
+        raise Exception("An MBR holds at most four primary partitions")
+
+    sector = bytearray(512)
+    if boot_code:
+        sector[:MBR_BOOT_CODE_SIZE] = boot_code[:MBR_BOOT_CODE_SIZE].ljust(MBR_BOOT_CODE_SIZE, b'\0')
+    if disk_signature is None:
+        disk_signature = struct.unpack('<I', os.urandom(4))[0]
+    struct.pack_into('<I', sector, 440, disk_signature)
+
+    for index, partition in enumerate(partitions):
+        if partition.start_lba > MBR_MAX_SECTORS or partition.sectors > MBR_MAX_SECTORS:
+            raise Exception("Partition lies beyond the 2 TiB an MBR can address")
+        status = MBR_ACTIVE if partition.bootable else 0
+        sector[446 + 16 * index:462 + 16 * index] = _mbr_entry(
+            status, partition.type_id, partition.start_lba, partition.sectors)
+
+    sector[510:512] = MBR_SIGNATURE
+    return bytes(sector)
+
+
+def build_protective_mbr(disk_sectors, boot_code=None):
+    """MBR covering the whole disk with one 0xEE entry, keeping MBR-only tools off a GPT disk"""
+    partition = Partition(1, min(disk_sectors - 1, MBR_MAX_SECTORS), MBR_PROTECTIVE)
+    sector = bytearray(build_mbr([partition], boot_code, disk_signature=0))
+    # The protective entry ends at CHS 0xFFFFFF no matter the size
+    sector[446 + 5:446 + 8] = b'\xFF\xFF\xFF'
+    return bytes(sector)
+
+
+def _gpt_header(current_lba, backup_lba, first_usable, last_usable, disk_guid, entries_lba, entries_crc, sector_size):
+    header = bytearray(struct.pack(
+        '<8sIII4xQQQQ16sQIII',
+        GPT_SIGNATURE, GPT_REVISION, GPT_HEADER_SIZE, 0,
+        current_lba, backup_lba, first_usable, last_usable,
+        disk_guid, entries_lba, GPT_ENTRY_COUNT, GPT_ENTRY_SIZE, entries_crc
+    ))
+    struct.pack_into('<I', header, 16, zlib.crc32(header) & 0xFFFFFFFF)
+    return bytes(header).ljust(sector_size, b'\0')
+
+
+def build_gpt(partitions, disk_sectors, sector_size=512, disk_guid=None):
+    """Primary (LBA 1 onwards) and backup (end of disk) GPT structures
+
+    Returns (primary, backup): the primary header followed by the entry array, and the
+    backup entry array followed by the backup header in the last sector.
+    """
+    if len(partitions) > GPT_ENTRY_COUNT:
+        raise Exception(f"A GPT holds at most {GPT_ENTRY_COUNT} partitions")
+
+    entry_sectors = gpt_entry_sectors(sector_size)
+    first_usable = 2 + entry_sectors
+    last_usable = disk_sectors - 2 - entry_sectors
+    disk_guid = disk_guid or uuid.uuid4()
+
+    entries = bytearray(GPT_ENTRY_COUNT * GPT_ENTRY_SIZE)
+    for index, partition in enumerate(partitions):
+        if partition.start_lba < first_usable or partition.end_lba > last_usable:
+            raise Exception("Partition lies outside the usable area of the disk")
+        partition.guid = partition.guid or uuid.uuid4()
+        struct.pack_into(
+            '<16s16sQQQ72s', entries, index * GPT_ENTRY_SIZE,
+            uuid.UUID(partition.type_id).bytes_le, partition.guid.bytes_le,
+            partition.start_lba, partition.end_lba, 0, partition.name.encode('utf-16-le')[:72]
+        )
+    entries = bytes(entries)
+    entries_crc = zlib.crc32(entries) & 0xFFFFFFFF
+
+    backup_lba = disk_sectors - 1
+    primary = _gpt_header(1, backup_lba, first_usable, last_usable, disk_guid.bytes_le,
+                          2, entries_crc, sector_size) + entries
+    backup = entries + _gpt_header(backup_lba, 1, first_usable, last_usable, disk_guid.bytes_le,
+                                   backup_lba - entry_sectors, entries_crc, sector_size)
+    return primary, backup
+
+
+def plan_single_partition(disk_size, sector_size, partition_scheme, file_system, bootable=True):
+    """One partition from the first 1 MiB boundary to the end of the usable area"""
+    disk_sectors = disk_size // sector_size
+    start_lba = PARTITION_ALIGNMENT // sector_size
+
+    if partition_scheme == "GPT":
+        end_lba = disk_sectors - 2 - gpt_entry_sectors(sector_size)
+        type_id = GPT_TYPES.get(file_system, GPT_BASIC_DATA)
+        # GPT has no active flag, firmware finds the EFI loader by itself
+        bootable = False
+    else:
+        end_lba = min(disk_sectors - 1, MBR_MAX_SECTORS)
+        type_id = MBR_TYPES.get(file_system, 0x07)
+
+    # Whole 1 MiB units keep the end aligned too
+    sectors = (end_lba + 1 - start_lba) // start_lba * start_lba
+    if sectors <= 0:
+        raise Exception("Disk is too small to partition")
+    return Partition(start_lba, sectors, type_id, bootable, name='Main Data Partition' if partition_scheme == "GPT" else '',
+                     sector_size=sector_size)
+
+
+def get_device_size(fd):
+    """Size in bytes of an open block device or image file"""
+    info = os.fstat(fd)
+    if stat.S_ISREG(info.st_mode):
+        return info.st_size
+
+    if sys.platform.startswith('win'):
+        import msvcrt
+        import win32file
+        result = win32file.DeviceIoControl(msvcrt.get_osfhandle(fd), IOCTL_DISK_GET_LENGTH_INFO, None, 8)
+        return struct.unpack('<Q', result)[0]
+
+    size = os.lseek(fd, 0, os.SEEK_END)
+    os.lseek(fd, 0, os.SEEK_SET)
+    return size
+
+
+def write_at(fd, data, offset):
+    """Write all of data at a byte offset of an open device or file"""
+    if hasattr(os, 'pwrite'):
+        written = 0
+        while written < len(data):
+            written += os.pwrite(fd, data[written:], offset + written)
+        return
+    os.lseek(fd, offset, os.SEEK_SET)
+    written = 0
+    while written < len(data):
+        written += os.write(fd, data[written:])
+
+
+def read_at(fd, length, offset):
+    """Read up to length bytes at a byte offset of an open device or file"""
+    if hasattr(os, 'pread'):
+        return os.pread(fd, length, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, length)
+
+
+def _reread_partitions(fd):
+    """Tell the operating system the partition table changed"""
+    try:
+        if sys.platform.startswith('win'):
+            import msvcrt
+            import win32file
+            win32file.DeviceIoControl(msvcrt.get_osfhandle(fd), IOCTL_DISK_UPDATE_PROPERTIES, None, 0)
+        elif stat.S_ISBLK(os.fstat(fd).st_mode):
+            import fcntl
+            fcntl.ioctl(fd, BLKRRPART)
+    except Exception as e:
+        print(f"Could not reload the partition table: {e}")
+
+
+def mbr_loader():
+    """MBR boot code of MBR_LOADER_PATH, booting the active partition"""
+    with open(MBR_LOADER_PATH, 'rb') as f:
+        data = f.read(512)
+    if len(data) < 512 or data[510:512] != MBR_SIGNATURE or not any(data[:MBR_BOOT_CODE_SIZE]):
+        raise Exception(f"{MBR_LOADER_PATH} holds no MBR boot code")
+    return data[:MBR_BOOT_CODE_SIZE]
+
+
+def write_partition_table(target_path, partition_scheme, file_system, disk_size=None, bootable=True, boot_code=None,
+                          reload=True, keep_boot_code=False):
+    """Replace the partition table of a device or image file with a single partition
+
+    MBR tables get the active flag on the partition (unless bootable is False). GPT
+    tables get a protective MBR, primary and backup headers with their CRC32s and a
+    backup copy at the end of the disk. Structures of the other scheme are wiped so no
+    stale table is found later. boot_code defaults to the MBR loader for bootable
+    tables and to none otherwise, whatever a clean or an earlier flash left in sector 0
+    is only kept with keep_boot_code. Image files are created or extended to disk_size. With reload False the
+    operating system is not told about the new table yet, see reload_partition_table.
+
+    Returns the Partition written.
+    """
+    if partition_scheme not in ("MBR", "GPT"):
+        raise Exception(f"Unknown partition scheme: {partition_scheme}")
+
+    fd = os.open(target_path, os.O_RDWR | getattr(os, 'O_BINARY', 0) | (
+        os.O_CREAT if not os.path.exists(target_path) else 0), 0o666)
+    try:
+        if disk_size is not None and stat.S_ISREG(os.fstat(fd).st_mode) and os.fstat(fd).st_size < disk_size:
+            os.truncate(target_path, disk_size)
+        disk_size = get_device_size(fd)
+        sector_size = get_sector_sizes(fd)[0]
+        disk_sectors = disk_size // sector_size
+
+        partition = plan_single_partition(disk_size, sector_size, partition_scheme, file_system, bootable)
+        if boot_code is None and keep_boot_code:
+            # Raw disks only take whole sector reads
+            boot_code = read_at(fd, sector_size, 0)[:MBR_BOOT_CODE_SIZE]
+        elif boot_code is None and bootable:
+            boot_code = mbr_loader()
+
+        entry_sectors = gpt_entry_sectors(sector_size)
+        # Everything in front of the partition, and the GPT backup area at the end
+        head = bytearray(partition.start_lba * sector_size)
+        tail_offset = (disk_sectors - 1 - entry_sectors) * sector_size
+        if partition_scheme == "GPT":
+            primary, tail = build_gpt([partition], disk_sectors, sector_size)
+            head[:512] = build_protective_mbr(disk_sectors, boot_code)
+            head[sector_size:sector_size + len(primary)] = primary
+        else:
+            head[:512] = build_mbr([partition], boot_code)
+            # A backup GPT left behind would make tools see a damaged GPT disk, the
+            # partition is about to be formatted so overwriting its last sectors is fine
+            tail = bytes((entry_sectors + 1) * sector_size)
+
+        write_at(fd, bytes(head), 0)
+        write_at(fd, tail, tail_offset)
+        os.fsync(fd)
+        if reload:
+            _reread_partitions(fd)
+        return partition
+    finally:
+        os.close(fd)
+
+
+def reload_partition_table(target_path):
+    """Make the operating system read the partition table of a device again"""
+    fd = os.open(target_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        _reread_partitions(fd)
+    finally:
+        os.close(fd)
+
+
+def _parse_gpt_header(sector):
+    if sector[:8] != GPT_SIGNATURE:
+        return None
+    header_size = struct.unpack_from('<I', sector, 12)[0]
+    header = bytearray(sector[:header_size])
+    crc = struct.unpack_from('<I', header, 16)[0]
+    struct.pack_into('<I', header, 16, 0)
+    if zlib.crc32(header) & 0xFFFFFFFF != crc:
+        return None
+    (current_lba, backup_lba, first_usable, last_usable, disk_guid, entries_lba,
+     count, entry_size, entries_crc) = struct.unpack_from('<QQQQ16sQIII', sector, 24)
+    return entries_lba, count, entry_size, entries_crc
+
+
+def read_partition_table(target_path):
+    """Read the partitions of a device or image file, returns (scheme, [Partition]) or (None, [])
+
+    GPT headers are checked against their CRC32s, the backup is used when the primary is damaged.
+    """
+    fd = os.open(target_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        sector_size = get_sector_sizes(fd)[0]
+        disk_sectors = get_device_size(fd) // sector_size
+        mbr = read_at(fd, sector_size, 0)[:512]
+        if len(mbr) < 512 or mbr[510:512] != MBR_SIGNATURE:
+            return None, []
+
+        entries = [mbr[446 + 16 * index:462 + 16 * index] for index in range(4)]
+        if any(entry[4] == MBR_PROTECTIVE for entry in entries):
+            for lba in (1, disk_sectors - 1):
+                header = _parse_gpt_header(read_at(fd, sector_size, lba * sector_size))
+                if header is None:
+                    continue
+                entries_lba, count, entry_size, entries_crc = header
+                table = read_at(fd, count * entry_size, entries_lba * sector_size)
+                if zlib.crc32(table) & 0xFFFFFFFF != entries_crc:
+                    continue
+                partitions = []
+                for index in range(count):
+                    type_guid, guid, first, last, _, name = struct.unpack_from(
+                        '<16s16sQQQ72s', table, index * entry_size)
+                    if type_guid == bytes(16):
+                        continue
+                    partitions.append(Partition(first, last - first + 1, str(uuid.UUID(bytes_le=type_guid)).upper(),
+                                                name=name.decode('utf-16-le').rstrip('\0'),
+                                                guid=uuid.UUID(bytes_le=guid), sector_size=sector_size))
+                return 'gpt', partitions
+            return None, []
+
+        partitions = []
+        for entry in entries:
+            start_lba, sectors = struct.unpack_from('<II', entry, 8)
+            if entry[4] and sectors:
+                partitions.append(Partition(start_lba, sectors, entry[4], entry[0] == MBR_ACTIVE,
+                                            sector_size=sector_size))
+        return 'mbr', partitions
+    finally:
+        os.close(fd)
+
+
+def set_active_partition(target_path, index=0):
+    """Mark one MBR partition active and clear the flag on the others, a single sector write"""
+    fd = os.open(target_path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+    try:
+        sector_size = get_sector_sizes(fd)[0]
+        sector = bytearray(read_at(fd, sector_size, 0))
+        if len(sector) < sector_size or sector[510:512] != MBR_SIGNATURE:
+            raise Exception("Disk has no MBR")
+        for slot in range(4):
+            entry = 446 + 16 * slot
+            if sector[entry + 4] == MBR_PROTECTIVE:
+                raise Exception("GPT disks have no active partition")
+            sector[entry] = MBR_ACTIVE if slot == index and sector[entry + 4] else 0
+        write_at(fd, bytes(sector), 0)
+        os.fsync(fd)
+        _reread_partitions(fd)
+    finally:
+        os.close(fd)
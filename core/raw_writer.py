@@ -0,0 +1,706 @@
+import os
+import sys
+import mmap
+import stat
+import time
+import queue
+import struct
+import threading
+from collections import deque
+
+from core.checksum import default_hash, get_hash
+from core.disk_image import hole_ranges, merge_ranges
+from core.journal import JOURNAL_INTERVAL
+from core.scheduler import PROGRESS_INTERVAL, StageStats
+
+# Bounds and default of the block size handed to a single write
+MIN_BLOCK_SIZE = 1024 * 1024
+MAX_BLOCK_SIZE = 16 * 1024 * 1024
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Buffers in flight between the reader and the writer
+DEFAULT_QUEUE_DEPTH = 4
+
+# Fallback when the device does not report its sector sizes
+DEFAULT_SECTOR_SIZE = 512
+
+# Granularity of zero run detection, a multiple of every sector size
+ZERO_CHECK_SIZE = 64 * 1024
+
+# Linux block device ioctls
+BLKSSZGET = 0x1268
+BLKPBSZGET = 0x127B
+BLKDISCARD = 0x1277
+BLKZEROOUT = 0x127F
+
+# Windows storage ioctls
+IOCTL_DISK_GET_DRIVE_GEOMETRY = 0x70000
+IOCTL_STORAGE_QUERY_PROPERTY = 0x2D1400
+STORAGE_ACCESS_ALIGNMENT_PROPERTY = 6
+
+
+def aligned_buffer(size):
+    """Allocate a zeroed, page aligned buffer (anonymous mappings start on a page boundary)"""
+    return mmap.mmap(-1, size)
+
+
+def get_sector_sizes(fd):
+    """Get the (logical, physical) sector size of an open block device or file"""
+    info = os.fstat(fd)
+    if not stat.S_ISBLK(info.st_mode) and not sys.platform.startswith('win'):
+        # Plain files only need page cache friendly alignment
+        physical = getattr(info, 'st_blksize', 0) or DEFAULT_SECTOR_SIZE
+        return DEFAULT_SECTOR_SIZE, max(physical, DEFAULT_SECTOR_SIZE)
+
+    try:
+        if sys.platform.startswith('win'):
+            return _get_windows_sector_sizes(fd)
+
+        import fcntl
+        logical = struct.unpack('i', fcntl.ioctl(fd, BLKSSZGET, b'\0' * 4))[0]
+        physical = struct.unpack('I', fcntl.ioctl(fd, BLKPBSZGET, b'\0' * 4))[0]
+        return logical, max(physical, logical)
+
+    except Exception:
+        return DEFAULT_SECTOR_SIZE, DEFAULT_SECTOR_SIZE
+
+
+def _get_windows_sector_sizes(fd):
+    import msvcrt
+    import win32file
+
+    handle = msvcrt.get_osfhandle(fd)
+    try:
+        # STORAGE_PROPERTY_QUERY for the access alignment descriptor
+        query = struct.pack('<II4x', STORAGE_ACCESS_ALIGNMENT_PROPERTY, 0)
+        result = win32file.DeviceIoControl(handle, IOCTL_STORAGE_QUERY_PROPERTY, query, 28)
+        logical, physical = struct.unpack_from('<II', result, 16)
+        if logical:
+            return logical, max(physical, logical)
+    except Exception:
+        pass
+
+    # Regular files and older drivers only know the logical sector size
+    try:
+        result = win32file.DeviceIoControl(handle, IOCTL_DISK_GET_DRIVE_GEOMETRY, None, 24)
+        logical = struct.unpack_from('<I', result, 20)[0]
+        return logical, logical
+    except Exception:
+        return DEFAULT_SECTOR_SIZE, DEFAULT_SECTOR_SIZE
+
+
+def discard_target(fd, length):
+    """Discard (TRIM) the first length bytes of a block device so they read back as zeros
+
+    Returns False when the target or platform cannot discard, skipped zero ranges
+    then have to be repaired by the verification pass.
+    """
+    info = os.fstat(fd)
+    if stat.S_ISREG(info.st_mode):
+        # Freshly truncated image files are all holes already
+        return info.st_size == 0
+    if not stat.S_ISBLK(info.st_mode):
+        return False
+
+    try:
+        import fcntl
+        fcntl.ioctl(fd, BLKDISCARD, struct.pack('QQ', 0, length))
+        return True
+    except Exception:
+        return False
+
+
+def zero_range(fd, offset, length, zero_buffer):
+    """Make a range of the target read back as zeros, leaving the position at its end
+
+    Linux block devices zero it in the kernel (BLKZEROOUT), everything else gets zeros
+    written from zero_buffer, which has to be aligned for direct I/O targets.
+    """
+    if stat.S_ISBLK(os.fstat(fd).st_mode) and not sys.platform.startswith('win'):
+        try:
+            import fcntl
+            fcntl.ioctl(fd, BLKZEROOUT, struct.pack('QQ', offset, length))
+            os.lseek(fd, offset + length, os.SEEK_SET)
+            return
+        except Exception:
+            pass
+
+    os.lseek(fd, offset, os.SEEK_SET)
+    view = memoryview(zero_buffer)
+    try:
+        written = 0
+        while written < length:
+            written += os.write(fd, view[:min(len(view), length - written)])
+    finally:
+        view.release()
+
+
+def zero_runs(buffer, length, granularity=ZERO_CHECK_SIZE):
+    """Split the first length bytes of a buffer into (offset, length, is_zero) runs"""
+    runs = []
+    zero_chunk = bytes(granularity)
+    for offset in range(0, length, granularity):
+        size = min(granularity, length - offset)
+        # Most data chunks fail on their first or last byte, before any copy
+        is_zero = (
+            buffer[offset] == 0 and buffer[offset + size - 1] == 0
+            and buffer[offset:offset + size] == (zero_chunk if size == granularity else bytes(size))
+        )
+        if runs and runs[-1][2] == is_zero:
+            runs[-1][1] += size
+        else:
+            runs.append([offset, size, is_zero])
+    return runs
+
+
+def open_target(target_path, direct=False, truncate=True):
+    """Open a block device or image file for writing, returns (fd, direct I/O active)
+
+    Image files stand in for a device and are created empty, or kept as they are when
+    a write is resumed (truncate=False). Direct I/O silently falls back to buffered
+    writes where the platform or file system refuses it.
+    """
+    create = not os.path.exists(target_path) or os.path.isfile(target_path)
+
+    if direct and sys.platform.startswith('win'):
+        try:
+            return _open_windows_unbuffered(target_path, create, truncate), True
+        except Exception:
+            pass
+
+    flags = os.O_WRONLY | getattr(os, 'O_BINARY', 0)
+    if create:
+        flags |= os.O_CREAT | (os.O_TRUNC if truncate else 0)
+
+    if direct and hasattr(os, 'O_DIRECT'):
+        try:
+            return os.open(target_path, flags | os.O_DIRECT, 0o666), True
+        except OSError:
+            # tmpfs and a few FUSE file systems reject O_DIRECT
+            pass
+
+    return os.open(target_path, flags, 0o666), False
+
+
+def open_readback(target_path, direct=False):
+    """Open a written device or image file for reading back, returns (file, direct I/O active)
+
+    Direct I/O keeps the page cache from answering for the device.
+    """
+    if direct and sys.platform.startswith('win'):
+        try:
+            import msvcrt
+            import win32con
+            import win32file
+            handle = win32file.CreateFile(
+                target_path,
+                win32con.GENERIC_READ,
+                win32con.FILE_SHARE_READ | win32con.FILE_SHARE_WRITE,
+                None,
+                win32con.OPEN_EXISTING,
+                win32file.FILE_FLAG_NO_BUFFERING,
+                None
+            )
+            fd = msvcrt.open_osfhandle(handle.Detach(), os.O_RDONLY | os.O_BINARY)
+            return os.fdopen(fd, 'rb', buffering=0), True
+        except Exception:
+            pass
+
+    flags = os.O_RDONLY | getattr(os, 'O_BINARY', 0)
+    if direct and hasattr(os, 'O_DIRECT'):
+        try:
+            return os.fdopen(os.open(target_path, flags | os.O_DIRECT), 'rb', buffering=0), True
+        except OSError:
+            pass
+
+    fd = os.open(target_path, flags)
+    if hasattr(os, 'posix_fadvise'):
+        # Without direct I/O at least drop what the write left in the cache
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    return os.fdopen(fd, 'rb', buffering=0), False
+
+
+def _open_windows_unbuffered(target_path, create, truncate=True):
+    import msvcrt
+    import win32con
+    import win32file
+
+    handle = win32file.CreateFile(
+        target_path,
+        win32con.GENERIC_WRITE,
+        win32con.FILE_SHARE_READ | win32con.FILE_SHARE_WRITE,
+        None,
+        (win32con.CREATE_ALWAYS if truncate else win32con.OPEN_ALWAYS) if create else win32con.OPEN_EXISTING,
+        win32file.FILE_FLAG_NO_BUFFERING | win32file.FILE_FLAG_WRITE_THROUGH,
+        None
+    )
+    return msvcrt.open_osfhandle(handle.Detach(), os.O_WRONLY | os.O_BINARY)
+
+
+class RawBlockWriter:
+    """Stream an image onto a device with a reader and a writer thread
+
+    The reader fills page aligned buffers while the writer drains them, so the target
+    is written to continuously instead of waiting for every read. Blocks are sized and
+    padded to whole physical sectors, which direct I/O requires.
+
+    With skip_zeros the target is discarded first and, if that worked, all-zero runs
+    are seeked over instead of written. A verification pass afterwards reads those
+    runs back and writes zeros wherever the target did not return them.
+
+    Sources with an extents() map (see core.disk_image) only have their allocated
+    ranges transferred. The target is discarded so the holes read back as zeros, and
+    where that fails the holes are zeroed explicitly: images store zeroed metadata as
+    holes, so stale data there would corrupt the written file systems. hole_ranges
+    lists them for the verification pass.
+
+    With hash_algorithm the reader hashes every block while the writer drains the
+    previous one: digest covers the transferred data in order and, with chunk_digests,
+    block_digests records (offset, length, digest) per block, so a verification pass
+    only has to read the target.
+
+    With a FlashJournal (core.journal) the written ranges are recorded after every
+    fsync, and blocks the journal already covers are neither read (where the source
+    allows random access) nor written again. A resumed target is never discarded.
+    """
+
+    def __init__(self, target_path, block_size=DEFAULT_BLOCK_SIZE, queue_depth=DEFAULT_QUEUE_DEPTH,
+                 direct=False, progress_callback=None, skip_zeros=False, hash_algorithm=None,
+                 chunk_digests=False):
+        if not MIN_BLOCK_SIZE <= block_size <= MAX_BLOCK_SIZE:
+            raise Exception(f"Block size must be between {MIN_BLOCK_SIZE} and {MAX_BLOCK_SIZE} bytes")
+        if queue_depth < 2:
+            raise Exception("Double buffering needs a queue depth of at least 2")
+
+        self.target_path = target_path
+        self.block_size = block_size
+        self.queue_depth = queue_depth
+        self.direct = direct
+        self.progress_callback = progress_callback
+        self.skip_zeros = skip_zeros
+        self.hash_algorithm = hash_algorithm
+        self.chunk_digests = chunk_digests
+        self._hash = get_hash(hash_algorithm) if hash_algorithm else None
+
+        self.logical_sector_size = DEFAULT_SECTOR_SIZE
+        self.physical_sector_size = DEFAULT_SECTOR_SIZE
+        self.direct_active = False
+
+        self.total_bytes = 0
+        self.written_bytes = 0
+        self.read_stats = StageStats("Read")
+        self.write_stats = StageStats("Write")
+        self.hash_stats = StageStats("Hash")
+        self.elapsed = 0.0
+
+        # Virtual size of sparse sources, the ranges left out as holes and the hole bytes zeroed explicitly
+        self.image_size = None
+        self.hole_bytes = 0
+        self.hole_ranges = []
+        self.zeroed_bytes = 0
+
+        # Zero runs that were seeked over, [offset, length]
+        self.skipped_ranges = []
+        self.skipped_bytes = 0
+        self.discarded = False
+        # Skipped bytes that did not read back as zeros and were written after all
+        self.repaired_bytes = 0
+        # Bytes a journal showed to be on the target already
+        self.resumed_bytes = 0
+
+        # Hex digest of the transferred data and (offset, length, digest) of every block
+        self.digest = None
+        self.block_digests = []
+
+        self._free = None
+        self._filled = None
+        self._stop = threading.Event()
+        self._errors = []
+        self._last_report = 0
+        self._skipping = False
+        self._end = 0
+        self._running_hash = None
+        self._journal = None
+        self._journal_pending = []
+        self._last_checkpoint = 0
+        self._holes = []
+        self._zero_buffer = None
+
+    @property
+    def stats(self):
+        if self._hash is not None:
+            return [self.read_stats, self.hash_stats, self.write_stats]
+        return [self.read_stats, self.write_stats]
+
+    @property
+    def utilization(self):
+        """Fraction of the wall time the target was busy writing"""
+        return self.write_stats.seconds / self.elapsed if self.elapsed > 0 else 0.0
+
+    def write(self, source, size=None, journal=None):
+        """Write a path, readable binary file object or disk image to the target from its first byte
+
+        Returns the number of image bytes transferred, not counting sector padding.
+        """
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, 'rb', buffering=0) as source_file:
+                return self.write(source_file, os.fstat(source_file.fileno()).st_size, journal)
+
+        extents = source.extents() if hasattr(source, 'extents') else None
+        if extents is not None:
+            self.image_size = source.size
+            size = sum(length for _, length in extents)
+            self.hole_bytes = self.image_size - size
+        else:
+            self.image_size = None
+            self.hole_bytes = 0
+
+        self.total_bytes = size or 0
+        self.written_bytes = 0
+        self.hole_ranges = []
+        self.zeroed_bytes = 0
+        self._end = 0
+        self.skipped_ranges = []
+        self.skipped_bytes = 0
+        self.repaired_bytes = 0
+        self.resumed_bytes = 0
+        self._journal = journal
+        self._journal_pending = []
+        self._last_checkpoint = time.monotonic()
+        resuming = journal is not None and bool(journal.ranges)
+        self.digest = None
+        self.block_digests = []
+        self._running_hash = self._hash() if self._hash is not None else None
+        self._stop.clear()
+        self._errors = []
+
+        fd, self.direct_active = open_target(self.target_path, self.direct, truncate=not resuming)
+        try:
+            self.logical_sector_size, self.physical_sector_size = get_sector_sizes(fd)
+
+            if resuming:
+                # Discarding would wipe what the interrupted run wrote
+                self.discarded = False
+            elif self.skip_zeros or extents is not None:
+                length = self.image_size or self.total_bytes or os.lseek(fd, 0, os.SEEK_END)
+                os.lseek(fd, 0, os.SEEK_SET)
+                self.discarded = discard_target(fd, length)
+            # Seeking over zeros is only safe on a target that reads back zeros
+            self._skipping = self.skip_zeros and self.discarded
+
+            # Whole physical sectors and whole pages keep every write aligned
+            alignment = max(self.physical_sector_size, mmap.PAGESIZE)
+            block_size = -(-self.block_size // alignment) * alignment
+
+            buffers = [aligned_buffer(block_size) for _ in range(self.queue_depth)]
+            self._free = queue.Queue()
+            self._filled = queue.Queue()
+            for buffer in buffers:
+                self._free.put(buffer)
+
+            if extents is not None:
+                # Direct I/O needs sector aligned offsets, round the extents outward
+                ranges = merge_ranges(extents, alignment, limit=self.image_size)
+                self.hole_ranges = hole_ranges(ranges, self.image_size)
+                read_loop = self._read_extents
+                args = (source, ranges)
+            else:
+                read_loop = self._read_loop
+                args = (source,)
+            # Holes are only known to read back as zeros on a discarded target
+            self._holes = deque() if self.discarded else deque(self.hole_ranges)
+            self._zero_buffer = aligned_buffer(block_size) if self._holes else None
+
+            started = time.perf_counter()
+            reader = threading.Thread(target=self._guard, args=(read_loop, *args),
+                                      name='raw-reader', daemon=True)
+            writer = threading.Thread(target=self._guard, args=(self._write_loop, fd),
+                                      name='raw-writer', daemon=True)
+            reader.start()
+            writer.start()
+
+            # Progress is reported from the calling thread only
+            while writer.is_alive():
+                writer.join(PROGRESS_INTERVAL)
+                self._report()
+            self._stop.set()
+            reader.join()
+            self.elapsed = time.perf_counter() - started
+
+            if self._errors:
+                raise self._errors[0]
+            if self._running_hash is not None and not self.resumed_bytes:
+                # Blocks skipped on resume were never hashed
+                self.digest = self._running_hash.hexdigest()
+
+            self._report(force=True)
+            for buffer in buffers:
+                buffer.close()
+            if self._zero_buffer is not None:
+                self._zero_buffer.close()
+                self._zero_buffer = None
+
+        finally:
+            os.close(fd)
+
+        # Image files end where the image does, not on the padded sector
+        if os.path.isfile(self.target_path):
+            os.truncate(self.target_path, self.image_size if self.image_size is not None else self._end)
+
+        if self.skipped_ranges:
+            self.repaired_bytes = self.verify_skipped_ranges()
+
+        return self.written_bytes
+
+    def verify_skipped_ranges(self):
+        """Check that every skipped range reads back as zeros, writing zeros where it does not
+
+        Returns the number of bytes that had to be written.
+        """
+        zero_chunk = bytes(ZERO_CHECK_SIZE)
+        repaired = 0
+
+        fd = os.open(self.target_path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+        try:
+            for offset, length in self.skipped_ranges:
+                position = offset
+                end = offset + length
+                while position < end:
+                    size = min(ZERO_CHECK_SIZE, end - position)
+                    os.lseek(fd, position, os.SEEK_SET)
+                    data = os.read(fd, size)
+                    if data != zero_chunk[:size]:
+                        os.lseek(fd, position, os.SEEK_SET)
+                        written = 0
+                        while written < size:
+                            written += os.write(fd, zero_chunk[written:size])
+                        repaired += size
+                    position += size
+
+            if repaired:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        return repaired
+
+    def _guard(self, function, *args):
+        try:
+            function(*args)
+        except Exception as e:
+            self._errors.append(e)
+            self._stop.set()
+            # Unblock the other side
+            self._filled.put(None)
+            self._free.put(None)
+
+    def _next(self, buffers):
+        """Take a buffer from a queue, None once the run is stopping"""
+        while not self._stop.is_set():
+            try:
+                return buffers.get(timeout=PROGRESS_INTERVAL)
+            except queue.Empty:
+                continue
+        return None
+
+    def _read_loop(self, source):
+        readinto = getattr(source, 'readinto', None)
+        offset = 0
+        while True:
+            buffer = self._next(self._free)
+            if buffer is None:
+                return
+
+            started = time.perf_counter()
+            view = memoryview(buffer)
+            filled = 0
+            try:
+                # Fill the whole block so only the last write can be short
+                while filled < len(view):
+                    if readinto is not None:
+                        count = readinto(view[filled:])
+                    else:
+                        data = source.read(len(view) - filled)
+                        count = len(data)
+                        view[filled:filled + count] = data
+                    if not count:
+                        break
+                    filled += count
+            finally:
+                view.release()
+            self.read_stats.bytes += filled
+            self.read_stats.seconds += time.perf_counter() - started
+
+            if filled:
+                self._hash_block(buffer, filled, offset)
+                self._filled.put((buffer, filled, offset))
+                offset += filled
+            if filled < len(buffer):
+                self._filled.put(None)
+                return
+
+    def _read_extents(self, source, extents):
+        """Read only the allocated ranges of a disk image, each block tagged with its offset"""
+        for start, length in extents:
+            position = start
+            end = start + length
+            while position < end:
+                size = min(self.block_size, end - position)
+                if self._journal is not None and self._journal.covers(position, size):
+                    # Written by an interrupted run, not even read
+                    self._filled.put((None, size, position))
+                    position += size
+                    continue
+
+                buffer = self._next(self._free)
+                if buffer is None:
+                    return
+
+                started = time.perf_counter()
+                view = memoryview(buffer)
+                try:
+                    filled = source.readinto_at(position, view[:min(len(view), end - position)])
+                finally:
+                    view.release()
+                self.read_stats.bytes += filled
+                self.read_stats.seconds += time.perf_counter() - started
+
+                if not filled:
+                    raise Exception(f"Unexpected end of image at offset {position}")
+                self._hash_block(buffer, filled, position)
+                self._filled.put((buffer, filled, position))
+                position += filled
+
+        self._filled.put(None)
+
+    def _hash_block(self, buffer, length, offset):
+        """Hash a freshly read block on the reader thread, before the writer owns it"""
+        if self._running_hash is None:
+            return
+        started = time.perf_counter()
+        view = memoryview(buffer)[:length]
+        try:
+            self._running_hash.update(view)
+            if self.chunk_digests:
+                self.block_digests.append((offset, length, self._hash(view).digest()))
+        finally:
+            view.release()
+        self.hash_stats.bytes += length
+        self.hash_stats.seconds += time.perf_counter() - started
+
+    def _write_loop(self, fd):
+        sector = self.physical_sector_size
+        position = 0
+        while True:
+            item = self._next(self._filled)
+            if item is None:
+                break
+            buffer, length, block_offset = item
+            if buffer is None or (self._journal is not None and self._journal.covers(block_offset, length)):
+                # Already on the target according to the journal
+                self._end = max(self._end, block_offset + length)
+                self.written_bytes += length
+                self.resumed_bytes += length
+                if buffer is not None:
+                    self._free.put(buffer)
+                continue
+
+            started = time.perf_counter()
+            if self._holes and self._holes[0][0] < block_offset:
+                position = self._zero_holes(fd, block_offset)
+            if block_offset != position:
+                # Positional seek over a hole of a sparse source
+                os.lseek(fd, block_offset, os.SEEK_SET)
+
+            padded = -(-length // sector) * sector
+            if padded > length:
+                # Zero the tail of the last block up to a whole sector
+                buffer[length:padded] = bytes(padded - length)
+
+            if self._skipping:
+                runs = zero_runs(buffer, padded)
+            else:
+                runs = [(0, padded, False)]
+
+            view = memoryview(buffer)
+            try:
+                for run_offset, run_length, is_zero in runs:
+                    if is_zero:
+                        # Positional seek over the run, the discarded target already reads zeros
+                        os.lseek(fd, run_length, os.SEEK_CUR)
+                        self._skip(block_offset + run_offset, min(run_length, length - run_offset))
+                        continue
+                    offset = run_offset
+                    while offset < run_offset + run_length:
+                        offset += os.write(fd, view[offset:run_offset + run_length])
+            finally:
+                view.release()
+
+            position = block_offset + padded
+            self._end = block_offset + length
+            self.written_bytes += length
+            self.write_stats.bytes += length
+            if self._journal is not None:
+                self._journal_pending.append((block_offset, length))
+                if time.monotonic() - self._last_checkpoint >= JOURNAL_INTERVAL:
+                    self._checkpoint(fd, buffer, block_offset, length)
+            self.write_stats.seconds += time.perf_counter() - started
+            self._free.put(buffer)
+
+        if self._stop.is_set():
+            return
+
+        started = time.perf_counter()
+        if self._holes:
+            self._zero_holes(fd, None)
+        os.fsync(fd)
+        if self._journal is not None:
+            self._checkpoint(None, None, 0, 0)
+        self.write_stats.seconds += time.perf_counter() - started
+
+    def _zero_holes(self, fd, before):
+        """Zero the pending holes in front of offset before (all of them for None), returns the position"""
+        sector = self.physical_sector_size
+        position = None
+        while self._holes and (before is None or self._holes[0][0] < before):
+            offset, length = self._holes.popleft()
+            # Only a trailing hole can end off a sector boundary, its padding is truncated from image files
+            padded = -(-length // sector) * sector
+            zero_range(fd, offset, padded, self._zero_buffer)
+            self.zeroed_bytes += length
+            position = offset + padded
+        return position
+
+    def _checkpoint(self, fd, buffer, offset, length):
+        """Flush the target and record everything written since the last checkpoint"""
+        if fd is not None:
+            os.fsync(fd)
+        for pending_offset, pending_length in self._journal_pending:
+            self._journal.add_range(pending_offset, pending_length)
+        self._journal_pending = []
+
+        if buffer is not None:
+            # Lets a resumed run check that the target still holds the last block
+            algorithm = default_hash()
+            view = memoryview(buffer)[:length]
+            try:
+                self._journal.tail = (offset, length, algorithm, get_hash(algorithm)(view).hexdigest())
+            finally:
+                view.release()
+        self._journal.save(force=True)
+        self._last_checkpoint = time.monotonic()
+
+    def _skip(self, offset, length):
+        if self.skipped_ranges and sum(self.skipped_ranges[-1]) == offset:
+            self.skipped_ranges[-1][1] += length
+        else:
+            self.skipped_ranges.append([offset, length])
+        self.skipped_bytes += length
+
+    def _report(self, force=False):
+        if not self.progress_callback:
+            return
+        now = time.monotonic()
+        if force or now - self._last_report >= PROGRESS_INTERVAL:
+            self._last_report = now
+            self.progress_callback(self.written_bytes, self.total_bytes)
@@ -0,0 +1,427 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from core.extent_reader import COPY_CHUNK_SIZE, ExtentReader
+from core.iso_handler import SECTOR_SIZE
+
+# Minimum delay between two progress reports
+PROGRESS_INTERVAL = 0.1
+
+# Files up to this size are written by the small file pool
+SMALL_FILE_THRESHOLD = 256 * 1024
+
+# Worker threads of the small file pool (1 disables the pool)
+DEFAULT_WORKERS = min(8, (os.cpu_count() or 1) * 2)
+
+
+class StageStats:
+    """Files, bytes and elapsed time of one extraction stage"""
+
+    def __init__(self, name):
+        self.name = name
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    @property
+    def throughput(self):
+        """Bytes per second"""
+        return self.bytes / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self):
+        files = f"{self.files} files, " if self.files else ""
+        return (f"{self.name}: {files}{self.bytes / 1e6:.1f} MB in "
+                f"{self.seconds:.2f} s ({self.throughput / 1e6:.1f} MB/s)")
+
+
+class SmallFilePool:
+    """Bounded thread pool that fans out many small file writes"""
+
+    def __init__(self, workers, max_pending=None):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='small-files')
+        # Bound the queue so collecting work never outruns the writers
+        self._slots = threading.BoundedSemaphore(max_pending or workers * 4)
+        self._errors = []
+        self._started = None
+
+    def submit(self, function, *args):
+        """Queue one write, blocking while the queue is full"""
+        if self._errors:
+            raise self._errors[0]
+        if self._started is None:
+            self._started = time.perf_counter()
+
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(function, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        self._slots.release()
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            self._errors.append(error)
+
+    def join(self):
+        """Wait for every queued write, returns the wall time spent since the first one"""
+        self._executor.shutdown(wait=True)
+        if self._errors:
+            raise self._errors[0]
+        if self._started is None:
+            return 0.0
+        return time.perf_counter() - self._started
+
+    def shutdown(self):
+        """Drop queued work after an error elsewhere"""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+class ExtractionScheduler:
+    """Extract image files in source order so the image is read strictly front to back
+
+    With a FlashJournal (core.journal) finished files are flushed to the device in one
+    batch every JOURNAL_INTERVAL and only then recorded, and files the journal shows
+    complete on the target are skipped. A file in several extents counts as finished
+    once its last extent is written, files without data on the source once the
+    extents are done.
+
+    With a LeafHasher (core.manifest) files are hashed from the mapped image right
+    after their data is copied, while it is still cached, so neither verification nor
+    the manifest has to read the image again.
+    """
+
+    def __init__(self, source_file, output_path, progress_callback=None,
+                 small_file_threshold=SMALL_FILE_THRESHOLD, workers=DEFAULT_WORKERS, journal=None, leaves=None):
+        self.source_file = source_file
+        self.output_path = output_path
+        self.progress_callback = progress_callback
+        self.small_file_threshold = small_file_threshold
+        self.workers = workers
+        self.journal = journal
+        self.leaves = leaves
+        # Target path -> path in the image, for the journal and the leaves
+        self._image_paths = {}
+        # Target path -> modification time of the file in the image
+        self._mtimes = {}
+        # Target path -> (file offset, source offset or None for zeros, length) of files in several extents
+        self._pieces = {}
+        # Target path -> extents of a file in several extents not written yet
+        self._remaining = {}
+        self._sizes = {}
+
+        self.directories = []
+        # (source offset, file offset, length, target path)
+        self.extents = []
+        # Files without data on the source (empty, sparse or embedded)
+        self.inline_files = []
+        self.multi_extent_paths = set()
+
+        self.total_bytes = 0
+        self.total_files = 0
+        self.copied_bytes = 0
+        self.copied_files = 0
+        # Files left alone because an interrupted run had finished them
+        self.resumed_files = 0
+        self._last_report = 0
+        self._lock = threading.Lock()
+
+        self.small_stats = StageStats("Small files")
+        self.large_stats = StageStats("Large files")
+
+    def _target_path(self, path):
+        parts = path.split('/')
+        if any(part in ('', '.', '..') for part in parts):
+            raise Exception(f"Unsafe path in image: {path}")
+        return os.path.join(self.output_path, *parts)
+
+    def add_directory(self, path):
+        self.directories.append(self._target_path(path))
+
+    def add_file(self, path, extents, size):
+        """Queue a file given as (source byte offset or None for zeros, length) extents"""
+        target = self._target_path(path)
+        self.total_files += 1
+        if self.journal is not None and self.journal.has_file(path, target, size):
+            self.copied_files += 1
+            self.resumed_files += 1
+            return
+        self._image_paths[target] = path
+
+        recorded = [(offset, length) for offset, length in extents if length > 0]
+        if not recorded:
+            self.inline_files.append((target, b'', size))
+            return
+
+        if len(recorded) > 1:
+            self.multi_extent_paths.add(target)
+            self._pieces[target] = []
+            self._remaining[target] = 0
+            self._sizes[target] = size
+
+        file_offset = 0
+        remaining = size
+        for offset, length in recorded:
+            length = min(length, remaining)
+            if length <= 0:
+                break
+            if offset is None:
+                # Unrecorded extents read back as zeros, the file is sized afterwards
+                self.inline_files.append((target, None, size))
+            else:
+                self.extents.append((offset, file_offset, length, target))
+                self.total_bytes += length
+                if target in self._remaining:
+                    self._remaining[target] += 1
+            if target in self._pieces:
+                self._pieces[target].append((file_offset, offset, length))
+            file_offset += length
+            remaining -= length
+
+    def add_inline_file(self, path, data):
+        """Queue a file whose data is already in memory"""
+        target = self._target_path(path)
+        self.total_files += 1
+        if self.journal is not None and self.journal.has_file(path, target, len(data)):
+            self.copied_files += 1
+            self.resumed_files += 1
+            return
+        self._image_paths[target] = path
+        self.inline_files.append((target, data, len(data)))
+
+    def add_iso_entry(self, entry):
+        """Queue an ISOEntry from the ISO 9660 walker or catalog"""
+        if entry.is_dir:
+            self.add_directory(entry.path)
+        else:
+            self._keep_mtime(entry)
+            extents = [(lba * SECTOR_SIZE, size) for lba, size in entry.extents]
+            self.add_file(entry.path, extents, entry.size)
+
+    def add_udf_entry(self, entry):
+        """Queue a UDFEntry from the UDF reader"""
+        if entry.is_dir:
+            self.add_directory(entry.path)
+        elif entry.inline is not None:
+            self._keep_mtime(entry)
+            self.add_inline_file(entry.path, entry.inline[:entry.size])
+        else:
+            self._keep_mtime(entry)
+            self.add_file(entry.path, entry.extents, entry.size)
+
+    def add_entry(self, entry):
+        """Queue an ISOEntry or UDFEntry"""
+        if hasattr(entry, 'inline'):
+            self.add_udf_entry(entry)
+        else:
+            self.add_iso_entry(entry)
+
+    def _keep_mtime(self, entry):
+        # Written files carry the image's timestamps, which lets a later delta update trust them
+        if getattr(entry, 'mtime', None) is not None:
+            self._mtimes[self._target_path(entry.path)] = entry.mtime
+
+    def _stamp(self, target):
+        mtime = self._mtimes.get(target)
+        if mtime is not None:
+            try:
+                os.utime(target, (mtime, mtime))
+            except OSError:
+                pass
+
+    def _report(self, force=False):
+        if not self.progress_callback:
+            return
+        now = time.monotonic()
+        if force or now - self._last_report >= PROGRESS_INTERVAL:
+            self._last_report = now
+            self.progress_callback(self.copied_bytes, self.total_bytes, self.copied_files, self.total_files)
+
+    def run(self):
+        """Create the tree, then stream every extent in ascending source offset"""
+        for directory in self.directories:
+            os.makedirs(directory, exist_ok=True)
+
+        # Sorting by source offset turns extraction into one sequential sweep
+        self.extents.sort()
+
+        with ExtentReader(self.source_file) as reader:
+            pool = SmallFilePool(self.workers) if self.workers > 1 else None
+            try:
+                self._copy_extents(reader, pool)
+            except Exception:
+                if pool is not None:
+                    pool.shutdown()
+                if self.journal is not None:
+                    # Files finished so far are kept for the next run
+                    self.journal.checkpoint(self.output_path, force=True)
+                raise
+            try:
+                if pool is not None:
+                    self.small_stats.seconds = pool.join()
+            finally:
+                if self.journal is not None:
+                    self.journal.checkpoint(self.output_path, force=True)
+
+        # Empty, embedded and partially unrecorded files
+        for target, data, size in self.inline_files:
+            if data is None:
+                mode = 'r+b' if os.path.exists(target) else 'wb'
+                with open(target, mode) as output_file:
+                    output_file.truncate(size)
+                if target not in self.multi_extent_paths:
+                    self.copied_files += 1
+                continue
+            with open(target, 'wb') as output_file:
+                output_file.write(data)
+            if self.leaves is not None:
+                self.leaves.add_file(self._image_paths[target], [data])
+            self.copied_files += 1
+
+        # Files written in pieces or sized afterwards get their timestamps last
+        for target in self.multi_extent_paths:
+            self._stamp(target)
+        for target, _, _ in self.inline_files:
+            self._stamp(target)
+
+        if self.journal is not None:
+            # Files with data on the source were journaled as their last extent was written
+            journaled = {target for _, _, _, target in self.extents}
+            for target, data, size in self.inline_files:
+                if target in journaled:
+                    continue
+                journaled.add(target)
+                chunks = [data] if data is not None else self._file_chunks(None, target, size)
+                self.journal.queue_file(self._image_paths[target], target, chunks)
+            self.journal.checkpoint(self.output_path, force=True)
+
+        self.copied_files += len(self.multi_extent_paths)
+        self.large_stats.files += len(self.multi_extent_paths)
+        self._report(force=True)
+        return True
+
+    @property
+    def stats(self):
+        return [self.small_stats, self.large_stats]
+
+    def _copy_extents(self, reader, pool):
+        """Copy the sorted extents, small files through the pool, large ones in line"""
+        opened = set()
+        for source_offset, file_offset, length, target in self.extents:
+            if pool is not None and length <= self.small_file_threshold and target not in self.multi_extent_paths:
+                pool.submit(self._write_small_file, reader, source_offset, length, target)
+                self._report()
+                continue
+
+            started = time.perf_counter()
+            if target in self.multi_extent_paths:
+                # Extents of one file may arrive in any order, only the first open truncates
+                flags = os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+                if target not in opened:
+                    flags |= os.O_TRUNC
+                    opened.add(target)
+                fd = os.open(target, flags, 0o666)
+                with os.fdopen(fd, 'wb') as output_file:
+                    output_file.seek(file_offset)
+                    reader.copy_extent(source_offset, length, output_file, self._advance)
+                self._remaining[target] -= 1
+                if not self._remaining[target] and self.journal is not None:
+                    self._finish_pieces(reader, target)
+            else:
+                with open(target, 'wb') as output_file:
+                    if self.leaves is not None:
+                        self._copy_hashed(reader, source_offset, length, output_file, self._image_paths[target])
+                    else:
+                        reader.copy_extent(source_offset, length, output_file, self._advance)
+                self._stamp(target)
+                if self.journal is not None:
+                    self._journal_file(target, self._source_chunks(reader, source_offset, length))
+                with self._lock:
+                    self.copied_files += 1
+                    self.large_stats.files += 1
+
+            self.large_stats.bytes += length
+            self.large_stats.seconds += time.perf_counter() - started
+            self._report()
+
+    def _write_small_file(self, reader, source_offset, length, target):
+        """Write one small file, runs on a pool worker"""
+        data = reader.extent(source_offset, length)
+        try:
+            with open(target, 'wb') as output_file:
+                output_file.write(data)
+            self._stamp(target)
+            if self.journal is not None:
+                self._journal_file(target, [data])
+            if self.leaves is not None:
+                self.leaves.add_file(self._image_paths[target], [data])
+        finally:
+            data.release()
+
+        with self._lock:
+            self.copied_bytes += length
+            self.copied_files += 1
+            self.small_stats.files += 1
+            self.small_stats.bytes += length
+
+    def _journal_file(self, target, chunks):
+        self.journal.queue_file(self._image_paths[target], target, chunks)
+        self.journal.checkpoint(self.output_path)
+
+    def _finish_pieces(self, reader, target):
+        """Size and stamp a file whose last extent was written, then journal it"""
+        size = self._sizes[target]
+        with open(target, 'r+b') as output_file:
+            # Unrecorded extents and the tail read back as zeros
+            output_file.truncate(size)
+        self._stamp(target)
+        self._journal_file(target, self._file_chunks(reader, target, size))
+
+    def _file_chunks(self, reader, target, size):
+        """Data of a file in file order, zeros where the source records none"""
+        position = 0
+        for file_offset, source_offset, length in sorted(self._pieces.get(target, []), key=lambda piece: piece[0]):
+            yield from self._zero_chunks(file_offset - position)
+            if source_offset is None:
+                yield from self._zero_chunks(length)
+            else:
+                yield from self._source_chunks(reader, source_offset, length)
+            position = file_offset + length
+        yield from self._zero_chunks(size - position)
+
+    def _zero_chunks(self, length):
+        zeros = bytes(min(COPY_CHUNK_SIZE, max(length, 0)))
+        for start in range(0, length, COPY_CHUNK_SIZE):
+            yield zeros[:min(COPY_CHUNK_SIZE, length - start)]
+
+    def _copy_hashed(self, reader, offset, length, output_file, path):
+        """Copy a single extent file chunk by chunk, hashing every chunk right after it was copied"""
+        leaves = self.leaves.file(path)
+        for start in range(offset, offset + length, COPY_CHUNK_SIZE):
+            size = min(COPY_CHUNK_SIZE, offset + length - start)
+            reader.copy_extent(start, size, output_file, self._advance)
+            view = reader.extent(start, size)
+            try:
+                leaves.update(view)
+            finally:
+                view.release()
+        leaves.close()
+
+    def _source_chunks(self, reader, offset, length):
+        for start in range(offset, offset + length, COPY_CHUNK_SIZE):
+            view = reader.extent(start, min(COPY_CHUNK_SIZE, offset + length - start))
+            try:
+                yield view
+            finally:
+                view.release()
+
+    def _advance(self, count):
+        with self._lock:
+            self.copied_bytes += count
+        self._report()
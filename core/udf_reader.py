@@ -0,0 +1,434 @@
+import os
+import struct
+import calendar
+
+# UDF logical sector size on optical media and ISO images
+SECTOR_SIZE = 2048
+
+# Anchor volume descriptor pointer locations (sector 256 is mandatory)
+ANCHOR_SECTORS = (256,)
+
+# Descriptor tag identifiers
+TAG_PRIMARY_VOLUME = 1
+TAG_ANCHOR = 2
+TAG_VOLUME_POINTER = 3
+TAG_PARTITION = 5
+TAG_LOGICAL_VOLUME = 6
+TAG_TERMINATING = 8
+TAG_FILE_SET = 256
+TAG_FILE_IDENTIFIER = 257
+TAG_ALLOCATION_EXTENT = 258
+TAG_FILE_ENTRY = 261
+TAG_EXTENDED_FILE_ENTRY = 266
+
+# ICB file types
+FILE_TYPE_DIRECTORY = 4
+
+# File identifier characteristics
+FID_HIDDEN = 0x01
+FID_DIRECTORY = 0x02
+FID_DELETED = 0x04
+FID_PARENT = 0x08
+
+# Allocation descriptor extent types (top two bits of the length)
+EXTENT_RECORDED = 0
+EXTENT_NEXT = 3
+
+# Copy buffer size for streaming file data out of the image
+COPY_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+def has_udf(iso_path):
+    """Check the volume recognition sequence for an NSR (UDF) descriptor"""
+    try:
+        with open(iso_path, 'rb') as f:
+            f.seek(16 * SECTOR_SIZE)
+            data = f.read(16 * SECTOR_SIZE)
+
+        for sector in range(0, len(data), SECTOR_SIZE):
+            identifier = data[sector + 1:sector + 6]
+            if identifier in (b'NSR02', b'NSR03'):
+                return True
+            if identifier == b'TEA01':
+                break
+
+        return False
+
+    except Exception:
+        return False
+
+
+def decode_timestamp(data, offset):
+    """Decode a 12 byte UDF timestamp to a POSIX timestamp, None if unset"""
+    type_and_zone, year, month, day, hour, minute, second, centiseconds, hundreds, microseconds = \
+        struct.unpack_from('<HhBBBBBBBB', data, offset)
+    if not 1 <= month <= 12 or not 1 <= day <= 31 or hour > 23 or minute > 59 or second > 59:
+        return None
+
+    timestamp = calendar.timegm((year, month, day, hour, minute, second, 0, 0, 0))
+    timestamp += centiseconds / 100 + hundreds / 10000 + microseconds / 1000000
+    # Offset from UTC in minutes (12 bit signed), -2047 when unspecified
+    zone = type_and_zone & 0x0FFF
+    if zone & 0x0800:
+        zone -= 0x1000
+    if type_and_zone >> 12 == 1 and zone != -2047:
+        timestamp -= zone * 60
+    return timestamp
+
+
+def decode_dstring(data):
+    """Decode an OSTA CS0 compressed unicode string"""
+    if not data:
+        return ''
+
+    compression = data[0]
+    if compression in (8, 254):
+        return data[1:].decode('latin-1')
+    if compression in (16, 255):
+        return data[1:len(data) - (len(data) - 1) % 2].decode('utf-16-be', errors='replace')
+
+    return data[1:].decode('ascii', errors='ignore')
+
+
+class UDFEntry:
+    """A file or directory inside a UDF image"""
+    __slots__ = ('path', 'size', 'is_dir', 'hidden', 'extents', 'inline', 'mtime')
+
+    def __init__(self, path, size, is_dir, hidden, extents, inline=None, mtime=None):
+        self.path = path
+        self.size = size
+        self.is_dir = is_dir
+        self.hidden = hidden
+        # List of (byte offset in image or None for sparse, length)
+        self.extents = extents
+        # Small files may be embedded in the file entry itself
+        self.inline = inline
+        # Modification time as a POSIX timestamp, None if unset
+        self.mtime = mtime
+
+    def __repr__(self):
+        return f"UDFEntry({self.path!r}, size={self.size}, dir={self.is_dir})"
+
+
+class UDFReader:
+    """Streaming UDF 1.02 - 2.50 reader that works directly on the image file"""
+
+    def __init__(self, iso_path):
+        self.iso_path = iso_path
+        self.volume_name = None
+        self.block_size = SECTOR_SIZE
+
+        self._file = None
+        # Partition reference -> partition start sector (physical maps)
+        self._partitions = {}
+        # Partition reference -> metadata file extents (UDF 2.50 metadata maps)
+        self._metadata_maps = {}
+        self._root_icb = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        """Open the image and read the volume structures"""
+        self._file = open(self.iso_path, 'rb')
+        try:
+            self._read_volume_structures()
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _read(self, offset, length):
+        self._file.seek(offset)
+        return self._file.read(length)
+
+    def _read_descriptor(self, sector, expected_tag=None):
+        """Read one descriptor and check its tag"""
+        data = self._read(sector * self.block_size, self.block_size)
+        if len(data) < 16:
+            raise Exception(f"Truncated UDF descriptor at sector {sector}")
+
+        tag_id = struct.unpack_from('<H', data, 0)[0]
+        checksum = (sum(data[0:4]) + sum(data[5:16])) & 0xFF
+        if checksum != data[4]:
+            raise Exception(f"Bad UDF descriptor tag checksum at sector {sector}")
+        if expected_tag is not None and tag_id != expected_tag:
+            raise Exception(f"Unexpected UDF descriptor {tag_id} at sector {sector}")
+
+        return tag_id, data
+
+    def _read_volume_structures(self):
+        """Locate the anchor, walk the volume descriptor sequence and find the root"""
+        anchor = None
+        for sector in ANCHOR_SECTORS:
+            try:
+                _, anchor = self._read_descriptor(sector, TAG_ANCHOR)
+                break
+            except Exception:
+                continue
+
+        if anchor is None:
+            raise Exception("No UDF anchor volume descriptor found")
+
+        # Main volume descriptor sequence extent
+        vds_length, vds_location = struct.unpack_from('<LL', anchor, 16)
+
+        partition_starts = {}
+        logical_volume = None
+
+        sector = vds_location
+        end = vds_location + max(1, vds_length // self.block_size)
+        while sector < end:
+            tag_id, data = self._read_descriptor(sector)
+
+            if tag_id == TAG_PARTITION:
+                partition_number = struct.unpack_from('<H', data, 22)[0]
+                partition_starts[partition_number] = struct.unpack_from('<L', data, 188)[0]
+            elif tag_id == TAG_LOGICAL_VOLUME:
+                logical_volume = data
+            elif tag_id == TAG_VOLUME_POINTER:
+                # Continue the sequence at a new extent
+                next_length, next_location = struct.unpack_from('<LL', data, 20)
+                sector = next_location
+                end = next_location + max(1, next_length // self.block_size)
+                continue
+            elif tag_id == TAG_TERMINATING:
+                break
+
+            sector += 1
+
+        if logical_volume is None:
+            raise Exception("No UDF logical volume descriptor found")
+
+        self.block_size = struct.unpack_from('<L', logical_volume, 212)[0] or SECTOR_SIZE
+        self.volume_name = decode_dstring(
+            logical_volume[84:84 + logical_volume[84 + 127]]
+        ).strip() or None
+
+        # Resolve partition maps to partition reference numbers
+        map_count = struct.unpack_from('<L', logical_volume, 268)[0]
+        offset = 440
+        metadata_files = {}
+        for reference in range(map_count):
+            map_type = logical_volume[offset]
+            map_length = logical_volume[offset + 1]
+            if map_type == 1:
+                partition_number = struct.unpack_from('<H', logical_volume, offset + 4)[0]
+                self._partitions[reference] = partition_starts[partition_number]
+            elif map_type == 2:
+                identifier = logical_volume[offset + 5:offset + 28].rstrip(b'\x00')
+                partition_number = struct.unpack_from('<H', logical_volume, offset + 38)[0]
+                self._partitions[reference] = partition_starts[partition_number]
+                if identifier == b'*UDF Metadata Partition':
+                    metadata_files[reference] = struct.unpack_from('<L', logical_volume, offset + 40)[0]
+            if map_length == 0:
+                break
+            offset += map_length
+
+        # Metadata partitions map their blocks through the metadata file
+        for reference, location in metadata_files.items():
+            entry = self._read_file_entry_at(self._partitions[reference] + location, reference)
+            self._metadata_maps[reference] = entry[3]
+
+        # File set descriptor gives the root directory ICB
+        fsd_length, fsd_block, fsd_partition = struct.unpack_from('<LLH', logical_volume, 248)
+        _, fsd = self._read_descriptor(self._block_sector(fsd_partition, fsd_block), TAG_FILE_SET)
+        root_block, root_partition = struct.unpack_from('<LH', fsd, 404)
+        self._root_icb = (root_partition, root_block)
+
+    def _block_sector(self, partition, block):
+        """Translate a logical block address to an absolute sector"""
+        extents = self._metadata_maps.get(partition)
+        if extents is not None:
+            byte_offset = block * self.block_size
+            for extent_offset, extent_length in extents:
+                if byte_offset < extent_length:
+                    return (extent_offset + byte_offset) // self.block_size
+                byte_offset -= extent_length
+            raise Exception(f"Metadata block {block} out of range")
+
+        return self._partitions[partition] + block
+
+    def _read_file_entry_at(self, sector, partition, file_data=False):
+        """Read a (extended) file entry, returns (file type, size, inline data, extents, mtime)"""
+        tag_id, data = self._read_descriptor(sector)
+        if tag_id == TAG_FILE_ENTRY:
+            ea_offset = 168
+            mtime = decode_timestamp(data, 84)
+        elif tag_id == TAG_EXTENDED_FILE_ENTRY:
+            ea_offset = 208
+            mtime = decode_timestamp(data, 92)
+        else:
+            raise Exception(f"Expected UDF file entry at sector {sector}, found {tag_id}")
+
+        file_type = data[16 + 11]
+        icb_flags = struct.unpack_from('<H', data, 16 + 18)[0]
+        size = struct.unpack_from('<Q', data, 56)[0]
+        ea_length, ad_length = struct.unpack_from('<LL', data, ea_offset)
+        ad_start = ea_offset + 8 + ea_length
+        descriptors = data[ad_start:ad_start + ad_length]
+
+        ad_type = icb_flags & 0x07
+        if ad_type == 3:
+            # Data is embedded in the file entry itself
+            return file_type, size, descriptors[:size], [], mtime
+
+        # File data never lives in a metadata partition, short_ads then address the physical one
+        physical = file_data and partition in self._metadata_maps
+        extents = self._parse_allocation_descriptors(descriptors, ad_type, partition, physical)
+        return file_type, size, None, extents, mtime
+
+    def _parse_allocation_descriptors(self, descriptors, ad_type, partition, physical=False):
+        """Turn short/long allocation descriptors into (byte offset, length) extents"""
+        extents = []
+        if ad_type == 0:
+            ad_size = 8
+        elif ad_type == 1:
+            ad_size = 16
+        else:
+            raise Exception("Unsupported UDF allocation descriptor type")
+
+        offset = 0
+        while offset + ad_size <= len(descriptors):
+            raw_length, block = struct.unpack_from('<LL', descriptors, offset)
+            extent_partition = partition
+            if ad_type == 1:
+                extent_partition = struct.unpack_from('<H', descriptors, offset + 8)[0]
+            offset += ad_size
+
+            extent_type = raw_length >> 30
+            length = raw_length & 0x3FFFFFFF
+            if length == 0:
+                break
+
+            if extent_type == EXTENT_NEXT:
+                # Allocation descriptors continue in an allocation extent descriptor
+                sector = self._block_sector(extent_partition, block)
+                _, next_data = self._read_descriptor(sector, TAG_ALLOCATION_EXTENT)
+                next_length = struct.unpack_from('<L', next_data, 20)[0]
+                descriptors = next_data[24:24 + next_length]
+                offset = 0
+                continue
+
+            if extent_type == EXTENT_RECORDED:
+                if physical and ad_type == 0:
+                    sector = self._partitions[extent_partition] + block
+                else:
+                    sector = self._block_sector(extent_partition, block)
+                extents.append((sector * self.block_size, length))
+            else:
+                # Allocated but unrecorded or sparse extents read back as zeros
+                extents.append((None, length))
+
+        return extents
+
+    def _read_extents(self, extents, size):
+        """Read a small extent list (directory data) into memory"""
+        data = bytearray()
+        for offset, length in extents:
+            length = min(length, size - len(data))
+            if length <= 0:
+                break
+            if offset is None:
+                data += bytes(length)
+            else:
+                data += self._read(offset, length)
+        return bytes(data)
+
+    def walk(self):
+        """Yield every entry in the image, parents before children"""
+        stack = [('', self._root_icb)]
+
+        while stack:
+            dir_path, (partition, block) = stack.pop()
+            file_type, size, inline, extents, _ = self._read_file_entry_at(
+                self._block_sector(partition, block), partition
+            )
+            directory = inline if inline is not None else self._read_extents(extents, size)
+
+            subdirectories = []
+            offset = 0
+            while offset + 38 <= len(directory):
+                tag_id = struct.unpack_from('<H', directory, offset)[0]
+                if tag_id != TAG_FILE_IDENTIFIER:
+                    break
+
+                characteristics = directory[offset + 18]
+                name_length = directory[offset + 19]
+                icb_block, icb_partition = struct.unpack_from('<LH', directory, offset + 24)
+                impl_length = struct.unpack_from('<H', directory, offset + 36)[0]
+                name_start = offset + 38 + impl_length
+                raw_name = directory[name_start:name_start + name_length]
+                offset += (38 + impl_length + name_length + 3) & ~3
+
+                if characteristics & (FID_PARENT | FID_DELETED):
+                    continue
+
+                name = decode_dstring(raw_name)
+                path = f"{dir_path}/{name}" if dir_path else name
+                hidden = bool(characteristics & FID_HIDDEN)
+
+                if characteristics & FID_DIRECTORY:
+                    subdirectories.append((path, (icb_partition, icb_block)))
+                    yield UDFEntry(path, 0, True, hidden, [])
+                else:
+                    _, file_size, file_inline, file_extents, file_mtime = self._read_file_entry_at(
+                        self._block_sector(icb_partition, icb_block), icb_partition, file_data=True
+                    )
+                    yield UDFEntry(path, file_size, False, hidden, file_extents, file_inline, file_mtime)
+
+            # Depth-first, visiting subdirectories in on-disc order
+            stack.extend(reversed(subdirectories))
+
+    def files(self):
+        """Yield only file entries"""
+        for entry in self.walk():
+            if not entry.is_dir:
+                yield entry
+
+    def iter_chunks(self, entry, chunk_size=COPY_BUFFER_SIZE):
+        """Stream the data of a file entry in chunks"""
+        if entry.inline is not None:
+            yield entry.inline[:entry.size]
+            return
+
+        remaining = entry.size
+        for offset, length in entry.extents:
+            if remaining <= 0:
+                break
+
+            length = min(length, remaining)
+            remaining -= length
+
+            if offset is None:
+                while length > 0:
+                    piece = min(chunk_size, length)
+                    yield bytes(piece)
+                    length -= piece
+                continue
+
+            self._file.seek(offset)
+            while length > 0:
+                chunk = self._file.read(min(chunk_size, length))
+                if not chunk:
+                    raise Exception(f"Unexpected end of image while reading {entry.path}")
+                yield chunk
+                length -= len(chunk)
+
+        if remaining > 0:
+            raise Exception(f"Allocation descriptors of {entry.path} are shorter than the file")
+
+    def extract_file(self, entry, output_path):
+        """Stream one file out of the image to the given path"""
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+        with open(output_path, 'wb') as output_file:
+            for chunk in self.iter_chunks(entry):
+                output_file.write(chunk)
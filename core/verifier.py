@@ -0,0 +1,419 @@
+import os
+import mmap
+import time
+import random
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from core.checksum import default_hash, get_hash
+from core.compressed_source import CompressedSource, detect_compression
+from core.disk_image import hole_ranges, merge_ranges, open_disk_image
+from core.extent_reader import ExtentReader
+from core.iso_handler import SECTOR_SIZE
+from core.raw_writer import aligned_buffer, get_sector_sizes, open_readback
+from core.scheduler import DEFAULT_WORKERS, PROGRESS_INTERVAL
+
+VERIFY_OFF = "off"
+# Sampled chunks covering a fraction of the data
+VERIFY_QUICK = "quick"
+# Every byte
+VERIFY_FULL = "full"
+
+# Fraction of the chunks compared in quick mode
+DEFAULT_COVERAGE = 0.05
+
+# Unit of reading, hashing and sampling
+VERIFY_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Mismatching chunks are narrowed down to exact byte ranges in steps of this size
+DIFF_BLOCK_SIZE = 4096
+
+
+class Mismatch:
+    """Byte range that differs between source and target, path is None for raw images"""
+    __slots__ = ('path', 'offset', 'length', 'reason')
+
+    def __init__(self, path, offset, length, reason='content'):
+        self.path = path
+        self.offset = offset
+        self.length = length
+        # 'content', 'missing' or 'size'
+        self.reason = reason
+
+    def __str__(self):
+        where = f"{self.path}: " if self.path is not None else ""
+        if self.reason == 'missing':
+            return f"{where}missing on target"
+        if self.reason == 'size':
+            return f"{where}size differs"
+        return f"{where}bytes {self.offset}-{self.offset + self.length - 1} differ"
+
+    def __repr__(self):
+        return f"Mismatch({self.path!r}, offset={self.offset}, length={self.length}, reason={self.reason!r})"
+
+
+class VerifyResult:
+    """Outcome of one verification run"""
+
+    def __init__(self, mode, algorithm):
+        self.mode = mode
+        self.algorithm = algorithm
+        self.total_bytes = 0
+        self.checked_bytes = 0
+        self.seconds = 0.0
+        self.mismatches = []
+
+    @property
+    def ok(self):
+        return not self.mismatches
+
+    @property
+    def coverage(self):
+        """Fraction of the data actually compared"""
+        return self.checked_bytes / self.total_bytes if self.total_bytes > 0 else 1.0
+
+    @property
+    def throughput(self):
+        return self.checked_bytes / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self):
+        status = "OK" if self.ok else f"{len(self.mismatches)} mismatches"
+        return (f"Verify ({self.mode}, {self.algorithm}): {status}, {self.checked_bytes / 1e6:.1f} MB checked "
+                f"({self.coverage:.1%} coverage) in {self.seconds:.2f} s ({self.throughput / 1e6:.1f} MB/s)")
+
+
+def diff_ranges(expected, actual, base=0):
+    """Exact (offset, length) ranges where two equally long buffers differ"""
+    expected = memoryview(expected)
+    actual = memoryview(actual)
+    ranges = []
+    for block in range(0, len(expected), DIFF_BLOCK_SIZE):
+        end = min(block + DIFF_BLOCK_SIZE, len(expected))
+        if expected[block:end] == actual[block:end]:
+            continue
+        for index in range(block, end):
+            if expected[index] == actual[index]:
+                continue
+            if ranges and ranges[-1][0] + ranges[-1][1] == base + index:
+                ranges[-1][1] += 1
+            else:
+                ranges.append([base + index, 1])
+    return [(offset, length) for offset, length in ranges]
+
+
+def file_pieces(entry):
+    """(file offset, image offset or None for zeros or bytes, length) pieces of an ISOEntry/UDFEntry"""
+    if getattr(entry, 'inline', None) is not None:
+        return [(0, bytes(entry.inline[:entry.size]), entry.size)]
+
+    if hasattr(entry, 'inline'):
+        extents = entry.extents
+    else:
+        extents = [(lba * SECTOR_SIZE, size) for lba, size in entry.extents]
+
+    pieces = []
+    file_offset = 0
+    for source_offset, length in extents:
+        length = min(length, entry.size - file_offset)
+        if length <= 0:
+            break
+        pieces.append((file_offset, source_offset, length))
+        file_offset += length
+    return pieces
+
+
+def read_pieces(reader, pieces, offset, size):
+    """Bytes [offset, offset + size) of a file from its pieces, read through an ExtentReader"""
+    data = bytearray(size)
+    for file_offset, source, length in pieces:
+        start = max(offset, file_offset)
+        end = min(offset + size, file_offset + length)
+        if start >= end:
+            continue
+        if isinstance(source, bytes):
+            data[start - offset:end - offset] = source[start - file_offset:end - file_offset]
+        elif source is not None:
+            view = reader.extent(source + start - file_offset, end - start)
+            try:
+                data[start - offset:end - offset] = view
+            finally:
+                view.release()
+    return data
+
+
+class Verifier:
+    """Read the target back and compare it with the source
+
+    The calling thread reads source and target chunks in order while a pool hashes and
+    compares the previous ones. Quick mode compares a random sample of the chunks
+    (always including the first and last one, where partition tables live).
+    """
+
+    def __init__(self, mode=VERIFY_FULL, coverage=DEFAULT_COVERAGE, algorithm=None,
+                 chunk_size=VERIFY_CHUNK_SIZE, workers=DEFAULT_WORKERS, progress_callback=None,
+                 direct=True, seed=None):
+        if mode not in (VERIFY_QUICK, VERIFY_FULL):
+            raise Exception(f"Unknown verification mode: {mode}")
+        if not 0 < coverage <= 1:
+            raise Exception("Coverage must be a fraction between 0 and 1")
+
+        self.mode = mode
+        self.coverage = coverage if mode == VERIFY_QUICK else 1.0
+        self.algorithm = algorithm or default_hash()
+        self._hash = get_hash(self.algorithm)
+        self.chunk_size = chunk_size
+        self.workers = max(1, workers)
+        self.progress_callback = progress_callback
+        self.direct = direct
+        # Recorded so a quick run can be repeated on the same sample
+        self.seed = seed if seed is not None else random.randrange(1 << 32)
+        self._random = random.Random(self.seed)
+        self._last_report = 0
+
+    def _sampled(self, first, last):
+        if self.mode == VERIFY_FULL or first or last:
+            return True
+        return self._random.random() < self.coverage
+
+    def _report(self, checked_bytes, total_bytes, force=False):
+        if not self.progress_callback:
+            return
+        now = time.monotonic()
+        if force or now - self._last_report >= PROGRESS_INTERVAL:
+            self._last_report = now
+            self.progress_callback(checked_bytes, total_bytes)
+
+    def _compare(self, path, offset, expected, actual):
+        """Hash both sides on a worker, narrow differing chunks down to byte ranges"""
+        if self._hash(expected).digest() == self._hash(actual).digest():
+            return []
+        if len(expected) != len(actual):
+            return [Mismatch(path, offset, max(len(expected), len(actual)))]
+        return [Mismatch(path, start, length) for start, length in diff_ranges(expected, actual, offset)]
+
+    def _run(self, result, jobs, compare_chunk=None):
+        """Feed (path, offset, read function) jobs through the hashing pool"""
+        compare_chunk = compare_chunk or self._compare
+        started = time.perf_counter() - result.seconds
+        pending = deque()
+
+        def collect(future):
+            mismatches, length = future.result()
+            result.mismatches.extend(mismatches)
+            result.checked_bytes += length
+
+        def compare(path, offset, expected, actual):
+            return compare_chunk(path, offset, expected, actual), len(actual)
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='verify') as executor:
+            for path, offset, read in jobs:
+                expected, actual = read()
+                pending.append(executor.submit(compare, path, offset, expected, actual))
+
+                # Enough chunks in flight to keep every worker hashing
+                while len(pending) > self.workers * 2:
+                    collect(pending.popleft())
+                self._report(result.checked_bytes, result.total_bytes)
+
+            while pending:
+                collect(pending.popleft())
+
+        result.seconds = time.perf_counter() - started
+        self._report(result.checked_bytes, result.total_bytes, force=True)
+        return result
+
+    def verify_image(self, source, target_path, digests=None, holes=None):
+        """Compare a raw written image (path, disk image or compressed source) with the target
+
+        digests are the (offset, length, digest) blocks hashed with this verifier's
+        algorithm while writing (RawBlockWriter.block_digests). Only the target is read
+        then, the source is opened just to narrow down mismatching blocks.
+
+        holes are the (offset, length) ranges of a sparse image that were not transferred
+        (RawBlockWriter.hole_ranges), checked to read back as zeros. Without digests they
+        default to the gaps of the source's extents.
+        """
+        owned = isinstance(source, (str, os.PathLike))
+        if owned:
+            path = source
+            source = None if digests is not None else self._open_source(path)
+
+        result = VerifyResult(self.mode, self.algorithm)
+        target, direct = open_readback(target_path, self.direct)
+        try:
+            # Direct I/O reads whole aligned blocks into aligned buffers
+            alignment = max(get_sector_sizes(target.fileno())[1], mmap.PAGESIZE)
+
+            if digests is not None:
+                result.total_bytes = sum(length for _, length, _ in digests)
+                lock = threading.Lock()
+                sources = [source]
+
+                def compare(path_, offset, digest, actual):
+                    if self._hash(actual).digest() == digest:
+                        return []
+                    with lock:
+                        if sources[0] is None:
+                            sources[0] = self._open_source(path)
+                        expected = sources[0].read_at(offset, len(actual)) if hasattr(sources[0], 'read_at') else None
+                    if expected is None or len(expected) != len(actual):
+                        return [Mismatch(None, offset, len(actual))]
+                    return [Mismatch(None, start, length) for start, length in diff_ranges(expected, actual, offset)]
+
+                try:
+                    result.total_bytes += sum(length for _, length in holes or [])
+                    self._run(result, self._digest_jobs(target, digests, alignment), compare)
+                finally:
+                    source = sources[0]
+                return self._verify_holes(result, target, holes, alignment)
+
+            if hasattr(source, 'extents'):
+                ranges = source.extents()
+                if holes is None:
+                    holes = hole_ranges(merge_ranges(ranges, alignment, limit=source.size), source.size)
+            else:
+                ranges = [(0, source.size)] if source.size is not None else None
+
+            if ranges is not None:
+                result.total_bytes = sum(length for _, length in ranges) + sum(length for _, length in holes or [])
+            jobs = self._image_jobs(source, target, ranges, alignment)
+            self._run(result, jobs)
+            return self._verify_holes(result, target, holes, alignment)
+        finally:
+            target.close()
+            if owned and source is not None:
+                source.close()
+
+    def _verify_holes(self, result, target, holes, alignment):
+        """Check that the holes of a sparse image read back as zeros"""
+        if not holes:
+            return result
+        zero_chunk = memoryview(bytes(self.chunk_size))
+
+        def compare(path, offset, expected, actual):
+            if actual == expected:
+                return []
+            return [Mismatch(None, start, length) for start, length in diff_ranges(expected, actual, offset)]
+
+        def jobs():
+            for start, length in holes:
+                for offset in range(start, start + length, self.chunk_size):
+                    size = min(self.chunk_size, start + length - offset)
+                    if self._sampled(False, False):
+                        yield None, offset, lambda offset=offset, size=size: (
+                            zero_chunk[:size], self._read_target(target, offset, size, alignment))
+
+        return self._run(result, jobs(), compare)
+
+    def _open_source(self, path):
+        return CompressedSource(path) if detect_compression(path) else open_disk_image(path)
+
+    def _read_target(self, target, offset, length, alignment):
+        start = offset - offset % alignment
+        padded = -(-(offset + length - start) // alignment) * alignment
+        buffer = aligned_buffer(padded)
+        target.seek(start)
+        filled = 0
+        while filled < padded:
+            count = target.readinto(memoryview(buffer)[filled:])
+            if not count:
+                break
+            filled += count
+        return buffer[offset - start:offset - start + length]
+
+    def _digest_jobs(self, target, digests, alignment):
+        for index, (offset, length, digest) in enumerate(digests):
+            if self._sampled(index == 0, index == len(digests) - 1):
+                yield None, offset, lambda offset=offset, length=length, digest=digest: (
+                    digest, self._read_target(target, offset, length, alignment))
+
+    def _image_jobs(self, source, target, ranges, alignment):
+        def read_target(offset, length):
+            return self._read_target(target, offset, length, alignment)
+
+        if ranges is None:
+            # Streams of unknown length are read sequentially until they end
+            offset = 0
+            first = True
+            while True:
+                expected = source.read(self.chunk_size)
+                if not expected:
+                    return
+                if self._sampled(first, False):
+                    yield None, offset, lambda offset=offset, expected=expected: (
+                        expected, read_target(offset, len(expected)))
+                offset += len(expected)
+                first = False
+
+        streaming = not hasattr(source, 'readinto_at')
+        position = 0
+        for index, (start, length) in enumerate(ranges):
+            for offset in range(start, start + length, self.chunk_size):
+                size = min(self.chunk_size, start + length - offset)
+                first = index == 0 and offset == start
+                last = index == len(ranges) - 1 and offset + size == start + length
+                sampled = self._sampled(first, last)
+
+                if streaming:
+                    # Sequential sources have to be decoded past unsampled chunks
+                    if offset > position:
+                        self._skip(source, offset - position)
+                    expected = source.read(size)
+                    position = offset + len(expected)
+                    if sampled:
+                        yield None, offset, lambda offset=offset, expected=expected: (
+                            expected, read_target(offset, len(expected)))
+                elif sampled:
+                    yield None, offset, lambda offset=offset, size=size: (
+                        source.read_at(offset, size), read_target(offset, size))
+
+    def _skip(self, source, length):
+        while length > 0:
+            data = source.read(min(self.chunk_size, length))
+            if not data:
+                return
+            length -= len(data)
+
+    def verify_files(self, iso_path, target_root, entries):
+        """Compare extracted files under target_root with the ISOEntry/UDFEntry list of the image"""
+        result = VerifyResult(self.mode, self.algorithm)
+        entries = list(entries)
+        result.total_bytes = sum(entry.size for entry in entries if not entry.is_dir)
+
+        with open(iso_path, 'rb') as iso_file, ExtentReader(iso_file) as reader:
+            jobs = self._file_jobs(reader, target_root, entries, result)
+            return self._run(result, jobs)
+
+    def _file_jobs(self, reader, target_root, entries, result):
+        files = [entry for entry in entries if not entry.is_dir]
+        for entry in entries:
+            target = os.path.join(target_root, *entry.path.split('/'))
+            if entry.is_dir:
+                if not os.path.isdir(target):
+                    result.mismatches.append(Mismatch(entry.path, 0, 0, 'missing'))
+                continue
+
+            if not os.path.isfile(target):
+                result.mismatches.append(Mismatch(entry.path, 0, entry.size, 'missing'))
+                continue
+            if os.path.getsize(target) != entry.size:
+                result.mismatches.append(Mismatch(entry.path, 0, entry.size, 'size'))
+                continue
+
+            pieces = file_pieces(entry)
+            is_first_file = entry is files[0]
+            is_last_file = entry is files[-1]
+            for offset in range(0, entry.size, self.chunk_size):
+                size = min(self.chunk_size, entry.size - offset)
+                first = is_first_file and offset == 0
+                last = is_last_file and offset + size == entry.size
+                if not self._sampled(first, last):
+                    continue
+                yield entry.path, offset, lambda target=target, pieces=pieces, offset=offset, size=size: (
+                    read_pieces(reader, pieces, offset, size), self._read_file(target, offset, size))
+
+    def _read_file(self, path, offset, size):
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
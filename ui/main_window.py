@@ -11,7 +11,8 @@ from PIL import Image
 
 from core.iso_handler import ISOHandler
 from core.usb_handler import USBHandler
-from core.flasher import ISOFlasher
+from core.compressed_source import detect_compression
+from core.flasher import ISOFlasher, WRITE_MODE_FILES, WRITE_MODE_RAW, parse_cluster_size
 from ui.about_window import AboutWindow
 
 class MainWindow(ctk.CTk):
@@ -70,6 +71,7 @@ class MainWindow(ctk.CTk):
         self.partition_scheme = "MBR"
         self.file_system = "FAT32"
         self.original_drive_letter = None  # Store original drive letter
+        self.write_mode = WRITE_MODE_FILES  # Raw (DD) writes for isohybrid images
         
         # Layer completion status
         self.layer_completed = {
@@ -758,10 +760,24 @@ class MainWindow(ctk.CTk):
 
         file_path = filedialog.askopenfilename(
             title="Select ISO File",
-            filetypes=[("ISO files", "*.iso"), ("All files", "*.*")]
+            filetypes=[
+                ("ISO files", "*.iso"),
+                ("Disk images", "*.img *.vhd *.qcow2 *.iso.gz *.iso.xz *.iso.bz2 *.iso.zst *.img.gz *.img.xz *.img.bz2 *.img.zst"),
+                ("All files", "*.*")
+            ]
         )
 
-        if file_path:
+        # Compressed and plain disk images can only be written block for block
+        raw_only = bool(file_path) and (
+            detect_compression(file_path) is not None or not self.iso_handler.validate_iso(file_path)
+        ) and self.flasher.is_raw_image(file_path)
+
+        if raw_only:
+            self.selected_iso = file_path
+            self.iso_path_var.set(os.path.basename(file_path))
+            self.layer_completed[2] = True
+            self.write_mode = WRITE_MODE_RAW
+        elif file_path:
             # Validate ISO file
             if self.iso_handler.validate_iso(file_path):
                 self.selected_iso = file_path
@@ -769,6 +785,26 @@ class MainWindow(ctk.CTk):
                 self.iso_path_var.set(filename)
                 self.layer_completed[2] = True
 
+                # Pick target system and partition scheme from the boot catalog
+                try:
+                    boot_profile = self.iso_handler.get_boot_profile(file_path)
+                    self.target_var.set(boot_profile.target_system)
+                    self.partition_var.set(boot_profile.partition_scheme)
+                except Exception as e:
+                    print(f"Error classifying ISO boot method: {e}")
+
+                # Isohybrid images can be written block for block instead
+                self.write_mode = WRITE_MODE_FILES
+                if self.iso_handler.is_hybrid(file_path):
+                    use_raw = messagebox.askyesno(
+                        "Hybrid ISO Detected",
+                        "The selected ISO is an isohybrid image.\n\n"
+                        "Write it in DD image mode (block for block, recommended for most Linux images)?\n"
+                        "Choose No to format the drive and copy the files instead."
+                    )
+                    if use_raw:
+                        self.write_mode = WRITE_MODE_RAW
+
                 # Check if ISO is bootable
                 if not self.iso_handler.is_bootable(file_path):
                     messagebox.showwarning(
@@ -786,6 +822,9 @@ class MainWindow(ctk.CTk):
             self.iso_path_var.set("ISO Image (Please Select)")
             self.layer_completed[2] = False
 
+        if not self.selected_iso:
+            self.write_mode = WRITE_MODE_FILES
+
         # Reset subsequent layers if ISO changes
         if not self.layer_completed[2]:
             self.layer_completed[3] = False
@@ -840,6 +879,8 @@ class MainWindow(ctk.CTk):
 
         # Confirm action
         iso_info = f"ISO: {os.path.basename(self.selected_iso)}\n" if self.selected_iso else "Mode: Non Bootable (Format Only)\n"
+        if self.selected_iso and self.write_mode == WRITE_MODE_RAW:
+            iso_info += "Mode: DD Image (partition and file system settings come from the image)\n"
         result = messagebox.askyesno(
             "Confirm Flash",
             f"This will erase all data on drive {self.selected_drive}.\n"
@@ -847,7 +888,8 @@ class MainWindow(ctk.CTk):
             f"Volume: {self.volume_var.get()}\n"
             f"Partition: {self.partition_var.get()}\n"
             f"Target: {self.target_var.get()}\n"
-            f"File system: {self.system_var.get()}\n\n"
+            f"File system: {self.system_var.get()}\n"
+            f"Cluster size: {self.cluster_var.get()}\n\n"
             "Are you sure you want to continue?"
         )
         
@@ -891,7 +933,9 @@ class MainWindow(ctk.CTk):
                 partition_scheme=self.partition_var.get(),
                 target_system=self.target_var.get(),
                 file_system=self.system_var.get(),
-                progress_callback=self.update_progress
+                progress_callback=self.update_progress,
+                write_mode=self.write_mode if self.selected_iso else WRITE_MODE_FILES,
+                cluster_size=parse_cluster_size(self.cluster_var.get())
             )
             
             if success: